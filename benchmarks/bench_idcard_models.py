@@ -0,0 +1,70 @@
+# GiG
+# Compares the cost of validating and serializing fetch ID data responses with
+# the per IDCardType models against the old flat FetchIDCardResponse, which
+# had every field of every type on one model.
+# Run with: python -m benchmarks.bench_idcard_models
+
+import json
+import timeit
+from typing import Optional
+
+from pydantic import create_model
+
+from digio.web_services.idcard_routers import (
+    ID_CARD_RESPONSE_TYPES,
+    IDCardType,
+    fetch_id_card_response_adapter,
+)
+
+ROUNDS = 20_000
+
+
+def build_flat_model():
+    fields = {}
+    for response_type in ID_CARD_RESPONSE_TYPES.values():
+        for name, field_info in response_type.model_fields.items():
+            if name != "id_type":
+                fields[name] = (Optional[field_info.annotation], None)
+    return create_model("FlatFetchIDCardResponse", **fields)
+
+
+def build_payload(id_type: IDCardType) -> dict:
+    response_type = ID_CARD_RESPONSE_TYPES[id_type]
+    payload = {}
+    for name, field_info in response_type.model_fields.items():
+        if name == "id_type":
+            continue
+        if field_info.annotation == Optional[dict]:
+            payload[name] = {"issue_date": "01-01-2020", "expiry_date": "01-01-2040"}
+        else:
+            payload[name] = name
+    return payload
+
+
+def main():
+    flat_model = build_flat_model()
+    print(f"Flat model fields: {len(flat_model.model_fields)}")
+    for id_type, response_type in ID_CARD_RESPONSE_TYPES.items():
+        payload = build_payload(id_type)
+
+        def old():
+            response = flat_model.model_validate(payload)
+            return json.dumps(response.model_dump(mode="json"))
+
+        def new():
+            response = response_type.model_validate(payload)
+            return fetch_id_card_response_adapter.dump_json(response, exclude_none=True)
+
+        old_time = timeit.timeit(old, number=ROUNDS)
+        new_time = timeit.timeit(new, number=ROUNDS)
+        print(
+            f"{id_type.value:16} fields {len(response_type.model_fields):3}  "
+            f"flat {old_time / ROUNDS * 1e6:7.2f}us  "
+            f"per type {new_time / ROUNDS * 1e6:7.2f}us  "
+            f"speedup {old_time / new_time:5.2f}x  "
+            f"bytes {len(old())} -> {len(new())}"
+        )
+
+
+if __name__ == "__main__":
+    main()
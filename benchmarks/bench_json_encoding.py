@@ -0,0 +1,105 @@
+# GiG
+# Compares encoding a KYCResponse through FastAPI's default response path
+# (model -> dict -> validate -> jsonable dict -> json.dumps) with returning
+# a FastJSONResponse, for responses with a growing number of actions.
+# Run with: python -m benchmarks.bench_json_encoding
+
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from digio.web_services.digio_routers import KYCResponse
+from digio.web_services.responses import FastJSONResponse
+
+ROUNDS = 2_000
+ACTION_COUNTS = [1, 10, 50, 200]
+
+
+def build_response(action_count: int) -> KYCResponse:
+    created_at = datetime(2024, 10, 1, 9, 30, tzinfo=timezone.utc)
+    actions = [
+        {
+            "id": f"ACT{index:06}",
+            "action_ref": f"ref_{index}",
+            "type": "digilocker" if index % 2 else "selfie",
+            "status": "success",
+            "file_id": f"FILE{index:06}",
+            "execution_request_id": f"EXE{index:06}",
+            "validation_result": {
+                "name": {
+                    "type": "fuzzy_match",
+                    "validation_attributes": {"name": "John Doe"},
+                    "match_result": "matched",
+                    "confidence": 0.97,
+                }
+            },
+            "completed_at": created_at + timedelta(minutes=index),
+            "face_match_obj_type": "match_required",
+            "face_match_status": "done",
+            "method": "otp_text",
+            "processing_done": True,
+            "retry_count": index % 3,
+        }
+        for index in range(action_count)
+    ]
+    return KYCResponse.model_validate(
+        {
+            "id": "KID241001093000000ABCDEFGHIJKLMN",
+            "created_at": created_at,
+            "status": "approved",
+            "customer_identifier": "john@example.com",
+            "actions": actions,
+            "reference_id": "REF-1",
+            "transaction_id": "TXN-1",
+            "customer_name": "John Doe",
+            "expire_in_days": 10,
+            "reminder_registered": False,
+            "access_token": {
+                "created_at": created_at,
+                "entity_id": "KID241001093000000ABCDEFGHIJKLMN",
+                "id": "GWT241001093000000ABCDEFGHIJKLMN",
+                "valid_till": created_at + timedelta(days=10),
+            },
+            "auto_approved": False,
+        }
+    )
+
+
+async def time_default_path(response: KYCResponse) -> float:
+    field = create_response_field(name="Response", type_=KYCResponse)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        content = await serialize_response(
+            field=field, response_content=response, is_coroutine=True
+        )
+        JSONResponse(content)
+    return time.perf_counter() - start
+
+
+def time_fast_path(response: KYCResponse) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        FastJSONResponse(response)
+    return time.perf_counter() - start
+
+
+def main():
+    for action_count in ACTION_COUNTS:
+        response = build_response(action_count)
+        default_time = asyncio.run(time_default_path(response))
+        fast_time = time_fast_path(response)
+        print(
+            f"actions {action_count:4}  "
+            f"default {default_time / ROUNDS * 1e6:9.2f}us  "
+            f"fast {fast_time / ROUNDS * 1e6:9.2f}us  "
+            f"speedup {default_time / fast_time:5.2f}x  "
+            f"bytes {len(FastJSONResponse(response).body)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+# GiG
+# End to end load test of the web app. The app is booted against a temp
+# SQLite DB seeded with a roster and the in-process fake Digio, then driven
+# at a fixed concurrency with a mix of fetch ID data, KYC requests, roster
+# listing and roster imports. Reports RPS and p50/p95/p99 per scenario and
+# writes them to a JSON file that can be compared with an earlier run.
+#
+# python -m benchmarks.load_test --concurrency 32 --duration 20 --output after.json
+# python -m benchmarks.load_test --baseline before.json --threshold 0.1
+#
+# By default the app runs in a uvicorn subprocess and is called over HTTP,
+# --in-process calls it through an httpx.ASGITransport instead, which
+# leaves out the HTTP server but is quicker to set up.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from digio.models.config_models import CONFIG_PATH_ENV_VAR
+
+CONFIG_TEMPLATE = """
+data_dir = "{data_dir}"
+
+[db_configs]
+db_file_path = "{db_path}"
+db_prefix = "sqlite:///"
+
+[password_hasher_configs]
+executor = "thread"
+max_workers = 1
+
+[auth_configs]
+secret_key = "load-test"
+
+[fake_digio_configs]
+in_process = true
+latency_distribution = "lognormal"
+latency_ms = {upstream_latency_ms}
+latency_spread = 0.3
+error_rate = {upstream_error_rate}
+seed = 1
+
+# The load test measures the app, not the vendor's limits
+[upstream_governor_configs.default_limits]
+per_second = 1000000.0
+burst = 1000000
+"""
+
+SCENARIOS = ["fetch_id_data", "create_request", "list_students", "import_students"]
+DEFAULT_MIX = "fetch_id_data=6,create_request=2,list_students=3,import_students=1"
+ROSTER_BATCHES = 20
+STUDENTS_PER_BATCH = 50
+# Imports are for admins only, the load test logs in as this faculty
+ADMIN_USERNAME = "load_admin"
+ADMIN_PASSWORD = "load-test"
+
+
+class Scenario:
+    def __init__(self, id_pool: int, rng: random.Random):
+        self.id_pool = id_pool
+        self.rng = rng
+        self.counter = 0
+
+    def next_id(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    async def fetch_id_data(self, client: httpx.AsyncClient) -> httpx.Response:
+        # A smaller pool means more ID card cache hits
+        id_no = f"ABCDE{self.rng.randrange(self.id_pool):05}F"
+        return await client.post(
+            "/fetch_id_data/",
+            params={"types": "PAN"},
+            json={"id_no": id_no, "unique_request_id": None},
+        )
+
+    async def create_request(self, client: httpx.AsyncClient) -> httpx.Response:
+        request_no = self.next_id()
+        return await client.post(
+            "/integration/create_request/",
+            json={
+                "customer_identifier": f"customer{request_no}@example.com",
+                "notify_customer": False,
+                "customer_name": "Load Test",
+                "reference_id": f"REF{os.getpid()}_{request_no}",
+                "transaction_id": f"TXN{os.getpid()}_{request_no}",
+                "template_name": "LOAD_TEST",
+                "message": "load test",
+            },
+        )
+
+    async def list_students(self, client: httpx.AsyncClient) -> httpx.Response:
+        return await client.get(
+            "/list/students",
+            params={"batch_id": self.rng.randint(1, ROSTER_BATCHES), "limit": 50},
+        )
+
+    async def import_students(self, client: httpx.AsyncClient) -> httpx.Response:
+        lines = []
+        for _ in range(10):
+            student_no = self.next_id()
+            lines.append(
+                json.dumps(
+                    {
+                        "username": f"load_{os.getpid()}_{student_no}",
+                        "first_name": "Load",
+                        "last_name": None,
+                        "email_id": None,
+                        "phone_number": None,
+                        "college_id": 1,
+                        "department_id": 1,
+                        "batch_id": self.rng.randint(1, ROSTER_BATCHES),
+                    }
+                )
+            )
+        return await client.post(
+            "/import/students",
+            content="\n".join(lines),
+            headers={"content-type": "application/x-ndjson"},
+        )
+
+
+# Imports answer 200 with the rows that failed listed in errors,
+# which is a failure for the load test
+def get_status(response: httpx.Response) -> str:
+    if response.is_success and response.request.url.path.startswith("/import/"):
+        if response.json().get("errors"):
+            return "row_errors"
+    return str(response.status_code)
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name}, expected one of {SCENARIOS}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def write_configs(temp_dir: Path, args: argparse.Namespace) -> Path:
+    config_path = temp_dir / "configs.toml"
+    config_path.write_text(
+        CONFIG_TEMPLATE.format(
+            data_dir=temp_dir / "data",
+            db_path=temp_dir / "load_test.sqlite",
+            upstream_latency_ms=args.upstream_latency_ms,
+            upstream_error_rate=args.upstream_error_rate,
+        )
+    )
+    return config_path
+
+
+def seed_db(config_path: Path):
+    from digio.models import auth_models, db_base_ops
+    from digio.models.config_models import GlobalConfigs
+    from digio.models.db_engine import initialize_dbs
+    from digio.models.db_schemas import Batch, College, Department, Faculty, Student
+    from sqlmodel import Session
+
+    engine = initialize_dbs(GlobalConfigs.load_from_path(config_path).db_configs)
+    with Session(engine) as session:
+        results = []
+        results.append(
+            db_base_ops.bulk_create_entities(
+                session, College, [{"name": "Load Test College", "short_name": "LTC"}]
+            )
+        )
+        results.append(
+            db_base_ops.bulk_create_entities(
+                session,
+                Department,
+                [{"name": "Computer Science", "short_name": "CS", "college_id": 1}],
+            )
+        )
+        results.append(
+            db_base_ops.bulk_create_entities(
+                session,
+                Batch,
+                [
+                    {
+                        "name": f"Batch {batch_no}",
+                        "short_name": f"B{batch_no}",
+                        "college_id": 1,
+                        "department_id": 1,
+                    }
+                    for batch_no in range(1, ROSTER_BATCHES + 1)
+                ],
+            )
+        )
+        results.append(
+            db_base_ops.bulk_create_entities(
+                session,
+                Student,
+                [
+                    {
+                        "username": f"student_{batch_no}_{student_no}",
+                        "first_name": "Student",
+                        "last_name": None,
+                        "email_id": None,
+                        "phone_number": None,
+                        "college_id": 1,
+                        "department_id": 1,
+                        "batch_id": batch_no,
+                    }
+                    for batch_no in range(1, ROSTER_BATCHES + 1)
+                    for student_no in range(STUDENTS_PER_BATCH)
+                ],
+            )
+        )
+        results.append(
+            db_base_ops.bulk_create_entities(
+                session,
+                Faculty,
+                [
+                    {
+                        "username": ADMIN_USERNAME,
+                        "hashed_pwd": auth_models.get_password_hash(ADMIN_PASSWORD),
+                        "first_name": "Admin",
+                        "last_name": None,
+                        "email_id": None,
+                        "phone_number": None,
+                        "college_id": 1,
+                        "department_id": 1,
+                        "is_admin": True,
+                    }
+                ],
+            )
+        )
+    # A roster that was not seeded would make the listing scenarios page an empty table
+    errors = [error for result in results for error in result.errors]
+    assert not errors, f"Seeding the load test DB failed: {errors[:3]}"
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def start_app(
+    config_path: Path, in_process: bool, concurrency: int
+) -> AsyncIterator[httpx.AsyncClient]:
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    timeout = httpx.Timeout(60.0)
+    if in_process:
+        os.environ[CONFIG_PATH_ENV_VAR] = str(config_path)
+        seed_db(config_path)
+        from digio.web_services.web_server import app, lifespan
+
+        async with lifespan(app):
+            transport = httpx.ASGITransport(app=app)  # type: ignore
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://app", timeout=timeout
+            ) as client:
+                yield client
+        return
+
+    port = get_free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.load_test", "--serve", "--port", str(port)],
+        env={**os.environ, CONFIG_PATH_ENV_VAR: str(config_path)},
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=timeout
+        ) as client:
+            for _ in range(300):
+                if server.poll() is not None:
+                    raise SystemExit("The app exited while starting")
+                try:
+                    await client.get("/openapi.json")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("The app did not start in 30s")
+            yield client
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+async def log_in(client: httpx.AsyncClient):
+    response = await client.post(
+        "/token",
+        data={
+            "username": ADMIN_USERNAME,
+            "password": ADMIN_PASSWORD,
+            "user_type": "faculty",
+        },
+    )
+    response.raise_for_status()
+    client.headers["authorization"] = f"Bearer {response.json()['access_token']}"
+
+
+def serve(port: int):
+    # Runs in the subprocess, the DB is created here as main.py would
+    import uvicorn
+
+    from digio.web_services.web_server import app
+
+    seed_db(Path(os.environ[CONFIG_PATH_ENV_VAR]))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    weights: Dict[str, int],
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    id_pool: int,
+) -> Tuple[Dict[str, List[float]], Dict[str, Dict[str, int]], float]:
+    scenario = Scenario(id_pool, random.Random(1))
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+    latencies: Dict[str, List[float]] = {name: [] for name in names}
+    statuses: Dict[str, Dict[str, int]] = {name: {} for name in names}
+    start_time = time.perf_counter()
+    measure_from = start_time + warmup
+    stop_at = measure_from + duration
+
+    async def worker():
+        rng = random.Random()
+        while True:
+            name = rng.choices(names, name_weights)[0]
+            call: Callable = getattr(scenario, name)
+            request_start = time.perf_counter()
+            if request_start >= stop_at:
+                return
+            try:
+                status_code = get_status(await call(client))
+            except httpx.HTTPError as e:
+                status_code = type(e).__name__
+            request_end = time.perf_counter()
+            if request_start >= measure_from and request_end <= stop_at:
+                latencies[name].append((request_end - request_start) * 1000)
+                statuses[name][status_code] = statuses[name].get(status_code, 0) + 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, duration
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return round(sorted_values[index], 3)
+
+
+def summarize(
+    latencies: List[float], statuses: Dict[str, int], duration: float
+) -> dict:
+    values = sorted(latencies)
+    errors = sum(
+        count for status, count in statuses.items() if not status.startswith("2")
+    )
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "rps": round(len(values) / duration, 2),
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": round(values[-1], 3) if values else 0.0,
+        "statuses": statuses,
+    }
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Returns the regressions, a scenario regresses when its p95 grew or its RPS
+# dropped by more than the threshold
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit')} at {baseline.get('started_at')}")
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        for metric, worse_if_higher in [
+            ("p95_ms", True),
+            ("p99_ms", True),
+            ("rps", False),
+        ]:
+            before, after = previous[metric], current[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            regressed = change > threshold if worse_if_higher else change < -threshold
+            marker = "REGRESSED" if regressed else ""
+            print(
+                f"{name:16} {metric:7} {before:10.2f} -> {after:10.2f} {change:+7.1%} {marker}"
+            )
+            if regressed:
+                regressions.append(f"{name} {metric}")
+    return regressions
+
+
+def print_results(results: dict):
+    print(
+        f"{'scenario':16} {'requests':>8} {'errors':>6} {'rps':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for name, summary in {**results["scenarios"], "total": results["total"]}.items():
+        print(
+            f"{name:16} {summary['requests']:8} {summary['errors']:6} {summary['rps']:9.1f} "
+            f"{summary['p50_ms']:8.2f} {summary['p95_ms']:8.2f} {summary['p99_ms']:8.2f} "
+            f"{summary['max_ms']:8.2f}"
+        )
+
+
+async def run(args: argparse.Namespace) -> int:
+    weights = parse_mix(args.mix)
+    started_at = datetime.now(timezone.utc).isoformat()
+    with tempfile.TemporaryDirectory(prefix="digio_load_test_") as temp_dir:
+        config_path = write_configs(Path(temp_dir), args)
+        async with start_app(config_path, args.in_process, args.concurrency) as client:
+            await log_in(client)
+            latencies, statuses, duration = await run_load(
+                client,
+                weights,
+                args.concurrency,
+                args.duration,
+                args.warmup,
+                args.id_pool,
+            )
+
+    scenarios = {
+        name: summarize(latencies[name], statuses[name], duration) for name in weights
+    }
+    total_statuses: Dict[str, int] = {}
+    for name in weights:
+        for status_code, count in statuses[name].items():
+            total_statuses[status_code] = total_statuses.get(status_code, 0) + count
+    results = {
+        "commit": get_git_commit(),
+        "started_at": started_at,
+        "parameters": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "mix": weights,
+            "id_pool": args.id_pool,
+            "upstream_latency_ms": args.upstream_latency_ms,
+            "upstream_error_rate": args.upstream_error_rate,
+            "in_process": args.in_process,
+        },
+        "scenarios": scenarios,
+        "total": summarize(
+            [value for values in latencies.values() for value in values],
+            total_statuses,
+            duration,
+        ),
+    }
+    print_results(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+        print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("parameters") != results["parameters"]:
+            print(
+                "\nThe baseline was run with other parameters, the numbers may not compare"
+            )
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the Digio web app")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="In seconds")
+    parser.add_argument(
+        "--warmup", type=float, default=2.0, help="Seconds not measured at the start"
+    )
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario=weight,...")
+    parser.add_argument(
+        "--id-pool", type=int, default=500, help="Distinct ID numbers to look up"
+    )
+    parser.add_argument("--upstream-latency-ms", type=float, default=80.0)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    parser.add_argument("--in-process", action="store_true")
+    parser.add_argument("--output", type=Path, help="Write the results here")
+    parser.add_argument("--baseline", type=Path, help="Results of an earlier run")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Allowed change, 0.1 is 10%%"
+    )
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.port)
+        return 0
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
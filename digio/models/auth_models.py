@@ -1,155 +1,478 @@
 # GiG
-
-
-from datetime import datetime, timedelta, timezone
-from typing import Annotated
-
+# bcrypt is meant to be slow, a hash at cost 12 is ~250ms of CPU, so hashing
+# and verifying on the event loop would stall every other request.
+# PasswordHasher runs them in a bounded pool of worker processes and refuses
+# new work with a 503 once too many are waiting, so a burst of logins cannot
+# take the service down with it.
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Annotated,
+    Any,
+    Callable,
+    Dict,
+    Literal,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+import orjson
 from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+from fastapi.security import OAuth2PasswordBearer
+from loguru import logger
+from pydantic import BaseModel, ConfigDict
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
 
+from digio.models import db_engine
+from digio.models.config_models import (
+    AuthConfigs,
+    PasswordHasherConfigs,
+    get_launcher_secret_key,
+)
+from digio.models.db_schemas import Faculty, Student
+from digio.utils.ttl_cache import CacheStats, TTLCache
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
 
-# to get a string like this run:
-# openssl rand -hex 32
-# SECRET_KEY = "018d55df26d269ec31347f0efd532da70f750dbbce8c638c3b42757bdd2674fc"
-# ALGORITHM = "HS256"
-# ACCESS_TOKEN_EXPIRE_MINUTES = 5
-# oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+DEFAULT_BCRYPT_ROUNDS = 12
 
-# def create_access_token(data: dict, expires_delta: timedelta | None = None):
-#     to_encode = data.copy()
-#     if expires_delta:
-#         expire = datetime.now(timezone.utc) + expires_delta
-#     else:
-#         expire = datetime.now(timezone.utc) + timedelta(
-#             minutes=ACCESS_TOKEN_EXPIRE_MINUTES
-#         )
-#     to_encode.update({"exp": expire})
-#     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-#     return encoded_jwt
+# passlib is imported on first use, with the process executor that is
+# in the hasher's workers only and never in the web server's workers
+pwd_context: Optional["CryptContext"] = None
+pwd_context_rounds = DEFAULT_BCRYPT_ROUNDS
 
 
-# fake_users_db = {
-#     "johndoe": {
-#         "username": "johndoe",
-#         "full_name": "John Doe",
-#         "email": "johndoe@example.com",
-#         "hashed_password": "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",
-#         "disabled": False,
-#     }
-# }
+def set_bcrypt_rounds(bcrypt_rounds: int):
+    global pwd_context, pwd_context_rounds
+    pwd_context_rounds = bcrypt_rounds
+    pwd_context = None
 
 
-# class Token(BaseModel):
-#     access_token: str
-#     token_type: str
+def get_pwd_context() -> "CryptContext":
+    global pwd_context
+    if pwd_context is None:
+        from passlib.context import CryptContext
 
+        # Hashes made with any other cost are reported by needs_update
+        pwd_context = CryptContext(
+            schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=pwd_context_rounds
+        )
+    return pwd_context
 
-# class TokenData(BaseModel):
-#     username: str | None = None
 
+def configure_pwd_context(bcrypt_rounds: int):
+    set_bcrypt_rounds(bcrypt_rounds)
+    get_pwd_context()
 
-# class User(BaseModel):
-#     username: str
-#     email: str | None = None
-#     full_name: str | None = None
-#     disabled: bool | None = None
 
-
-# class UserInDB(User):
-#     hashed_password: str
+def get_password_hash(password):
+    return get_pwd_context().hash(password)
 
 
-# def get_user(db, username: str):
-#     if username in db:
-#         user_dict = db[username]
-#         return UserInDB(**user_dict)
+def verify_password(plain_password, hashed_password):
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+
+# Returns the new hash when the password is right but the hash is outdated
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> Tuple[bool, Optional[str]]:
+    return get_pwd_context().verify_and_update(plain_password, hashed_password)
+
+
+class PasswordHasherStats(BaseModel):
+    workers: int
+    bcrypt_rounds: int
+    # Submitted and not finished yet, running or waiting for a worker
+    pending: int
+    peak_pending: int
+    max_pending: int
+    completed: int
+    rejected: int
+    rehashed: int
+    mean_ms: float
+    max_ms: float
+
+
+class PasswordHasher:
+    def __init__(self, configs: PasswordHasherConfigs, server_workers: int = 1):
+        self.configs = configs
+        # Every server worker has its own pool, so the CPUs are shared out
+        self.workers = configs.max_workers or max(
+            1, (os.cpu_count() or 1) // server_workers
+        )
+        self.max_pending = self.workers + configs.max_queue_depth
+        set_bcrypt_rounds(configs.bcrypt_rounds)
+        self.executor: Executor
+        if configs.executor == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(configs.start_method),
+                initializer=configure_pwd_context,
+                initargs=(configs.bcrypt_rounds,),
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="password_hasher"
+            )
+        # Only changed from the event loop, so no lock is needed
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress, please retry",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        start_time = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        finally:
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            self.pending -= 1
+            self.completed += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, password, hashed_password)
+
+    async def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        return await self._run(verify_and_update_password, password, hashed_password)
+
+    # Workers are started on demand, start them all up front so that
+    # the first logins do not wait for the processes to import the app
+    async def warm_up(self):
+        await asyncio.gather(
+            *(
+                self._run(configure_pwd_context, self.configs.bcrypt_rounds)
+                for _ in range(self.workers)
+            )
+        )
+        self.completed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> PasswordHasherStats:
+        return PasswordHasherStats(
+            workers=self.workers,
+            bcrypt_rounds=self.configs.bcrypt_rounds,
+            pending=self.pending,
+            peak_pending=self.peak_pending,
+            max_pending=self.max_pending,
+            completed=self.completed,
+            rejected=self.rejected,
+            rehashed=self.rehashed,
+            mean_ms=round(self.total_ms / self.completed, 3) if self.completed else 0.0,
+            max_ms=round(self.max_ms, 3),
+        )
+
+
+password_hasher: Optional[PasswordHasher] = None
+
+
+def start_password_hasher(
+    configs: PasswordHasherConfigs, server_workers: int = 1
+) -> PasswordHasher:
+    global password_hasher
+    password_hasher = PasswordHasher(configs, server_workers)
+    return password_hasher
+
+
+def stop_password_hasher():
+    global password_hasher
+    if password_hasher is not None:
+        password_hasher.shutdown()
+    password_hasher = None
+
+
+def get_password_hasher() -> PasswordHasher:
+    if password_hasher is None:
+        raise RuntimeError("Password hasher is not started")
+    return password_hasher
+
+
+User = Union[Faculty, Student]
+
+
+def _get_user(user_type: Type[User], username: str) -> Optional[User]:
+    with Session(db_engine.engine) as session:
+        return session.exec(
+            select(user_type).where(user_type.username == username)
+        ).first()
+
+
+def _save_hashed_pwd(user_type: Type[User], user_id: int, hashed_pwd: str):
+    with Session(db_engine.engine) as session:
+        user = session.get(user_type, user_id)
+        if user is not None:
+            user.hashed_pwd = hashed_pwd
+            session.add(user)
+            session.commit()
+
+
+async def authenticate_user(
+    user_type: Type[User], username: str, password: str
+) -> Optional[User]:
+    hasher = get_password_hasher()
+    user = await run_in_threadpool(_get_user, user_type, username)
+    if user is None or not user.hashed_pwd:
+        # Hash anyway so that unknown usernames take as long as wrong passwords
+        await hasher.hash(password)
+        return None
+    is_valid, new_hash = await hasher.verify_and_update(password, user.hashed_pwd)
+    if not is_valid:
+        return None
+    if new_hash is not None:
+        assert user.id is not None
+        await run_in_threadpool(_save_hashed_pwd, user_type, user.id, new_hash)
+        hasher.rehashed += 1
+        logger.info(f"Rehashed the password of {user_type.__tablename__} {username}")
+        user.hashed_pwd = new_hash
+    return user
+
+
+# Tokens are HS256/384/512 JWTs. The HMAC key and the encoded header are
+# computed once, so signing and verifying is a copy of a keyed hash, and a
+# token that was verified recently is served from token_cache without
+# decoding it or touching the DB, which takes a few microseconds.
+
+JWT_HASHES = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+USER_TYPES: Dict[str, Type[User]] = {"faculty": Faculty, "student": Student}
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+    expires_in: int
+
+
+# What a request knows about its user, without hashed_pwd and the rest of the row
+class Principal(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    user_type: Literal["faculty", "student"]
+    id: int
+    username: str
+    first_name: str
+    college_id: int
+    department_id: int
+    batch_id: Optional[int] = None
+    is_admin: bool = False
+
+
+class TokenStats(BaseModel):
+    tokens: CacheStats
+    principals: CacheStats
+    issued: int
+    rejected: int
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _get_principal(user_type: str, user_id: int) -> Optional[Principal]:
+    entity_type = USER_TYPES[user_type]
+    columns = [
+        entity_type.id,
+        entity_type.username,
+        entity_type.first_name,
+        entity_type.college_id,
+        entity_type.department_id,
+    ]
+    if entity_type is Student:
+        columns.append(Student.batch_id)
+    else:
+        columns.append(Faculty.is_admin)
+    with Session(db_engine.engine) as session:
+        row = session.exec(select(*columns).where(entity_type.id == user_id)).first()
+    if row is None:
+        return None
+    return Principal(user_type=user_type, **row._asdict())
+
+
+def user_type_of(user: User) -> str:
+    return "faculty" if isinstance(user, Faculty) else "student"
+
+
+class TokenService:
+    def __init__(self, configs: AuthConfigs):
+        self.configs = configs
+        secret_key = configs.secret_key or get_launcher_secret_key()
+        if not secret_key:
+            logger.warning("auth_configs.secret_key is not set, using a random key")
+            secret_key = secrets.token_hex(32)
+        self._hmac = hmac.new(
+            secret_key.encode(), digestmod=JWT_HASHES[configs.algorithm]
+        )
+        self._header = _b64encode(
+            orjson.dumps({"alg": configs.algorithm, "typ": "JWT"})
+        )
+        self.expires_in = configs.access_token_expire_minutes * 60
+        # Only used from the event loop, like the other TTLCaches
+        self.token_cache: TTLCache[Principal] = TTLCache(
+            max_size=configs.token_cache_max_entries,
+            default_ttl=configs.token_cache_ttl,
+        )
+        self.principal_cache: TTLCache[Principal] = TTLCache(
+            max_size=configs.principal_cache_max_entries,
+            default_ttl=configs.principal_cache_ttl,
+        )
+        self.issued = 0
+        self.rejected = 0
+
+    def _sign(self, signing_input: bytes) -> bytes:
+        mac = self._hmac.copy()
+        mac.update(signing_input)
+        return _b64encode(mac.digest())
+
+    def create_access_token(self, user: User) -> Token:
+        assert user.id is not None
+        now = int(time.time())
+        payload = {
+            "sub": user.username,
+            "typ": user_type_of(user),
+            "uid": user.id,
+            "iat": now,
+            "exp": now + self.expires_in,
+        }
+        signing_input = self._header + b"." + _b64encode(orjson.dumps(payload))
+        access_token = signing_input + b"." + self._sign(signing_input)
+        self.issued += 1
+        return Token(
+            access_token=access_token.decode(),
+            token_type="bearer",
+            expires_in=self.expires_in,
+        )
+
+    # Returns the claims, or None when the token is not one of ours or expired
+    def decode(self, token: str) -> Optional[dict]:
+        try:
+            signing_input, signature = token.encode().rsplit(b".", 1)
+            header, payload = signing_input.split(b".")
+        except ValueError:
+            return None
+        # Only our own header is accepted, which also rules out alg=none
+        if header != self._header:
+            return None
+        if not hmac.compare_digest(self._sign(signing_input), signature):
+            return None
+        try:
+            claims = orjson.loads(_b64decode(payload))
+        except (ValueError, orjson.JSONDecodeError):
+            return None
+        if not isinstance(claims, dict) or claims.get("typ") not in USER_TYPES:
+            return None
+        if not isinstance(claims.get("uid"), int):
+            return None
+        if not isinstance(claims.get("exp"), int) or claims["exp"] <= time.time():
+            return None
+        return claims
+
+    async def get_principal(self, token: str) -> Optional[Principal]:
+        principal = self.token_cache.get(token)
+        if principal is not None:
+            return principal
+        claims = self.decode(token)
+        if claims is None:
+            self.rejected += 1
+            return None
+        key = (claims["typ"], claims["uid"])
+        principal = self.principal_cache.get(key)
+        if principal is None:
+            principal = await run_in_threadpool(_get_principal, *key)
+            if principal is None:
+                self.rejected += 1
+                return None
+            self.principal_cache.set(key, principal)
+        ttl = min(self.configs.token_cache_ttl, claims["exp"] - time.time())
+        self.token_cache.set(token, principal, ttl=ttl)
+        return principal
+
+    def get_stats(self) -> TokenStats:
+        return TokenStats(
+            tokens=self.token_cache.get_stats(),
+            principals=self.principal_cache.get_stats(),
+            issued=self.issued,
+            rejected=self.rejected,
+        )
+
+
+token_service: Optional[TokenService] = None
+
+
+def start_token_service(configs: AuthConfigs) -> TokenService:
+    global token_service
+    token_service = TokenService(configs)
+    return token_service
+
+
+def get_token_service() -> TokenService:
+    if token_service is None:
+        raise RuntimeError("Token service is not started")
+    return token_service
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> Principal:
+    principal = await get_token_service().get_principal(token)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
+
+
+async def get_current_admin(
+    current_user: Annotated[Principal, Depends(get_current_user)],
+) -> Principal:
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admins can do this",
+        )
+    return current_user
 
 
 ################TODO
 # 1. Add response_model to everything?
 ################TODO
-
-
-# def authenticate_user(fake_db, username: str, password: str):
-#     user = get_user(fake_db, username)
-#     if not user:
-#         return False
-#     if not verify_password(password, user.hashed_password):
-#         return False
-#     return user
-
-
-# async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-#     credentials_exception = HTTPException(
-#         status_code=status.HTTP_401_UNAUTHORIZED,
-#         detail="Could not validate credentials",
-#         headers={"WWW-Authenticate": "Bearer"},
-#     )
-#     try:
-#         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-#         username: str = payload.get("sub")
-#         if username is None:
-#             raise credentials_exception
-#         token_data = TokenData(username=username)
-#     except jwt.ExpiredSignatureError as exc:
-#         print("in ExpiredSignatureError")
-#         raise HTTPException(
-#             status_code=status.HTTP_401_UNAUTHORIZED, detail="token has expired"
-#         ) from exc
-#     except JWTError as exc:
-#         print("JWTError exception", exc)
-#         raise credentials_exception from exc
-#     user = get_user(fake_users_db, username=token_data.username)
-#     if user is None:
-#         print("No user found exception")
-#         raise credentials_exception
-#     return user
-
-
-# # @app.post("/token")
-# async def login_for_access_token(
-#     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-# ) -> Token:
-#     credentials_exception = HTTPException(
-#         status_code=status.HTTP_401_UNAUTHORIZED,
-#         detail="Incorrect username or password",
-#         headers={"WWW-Authenticate": "Bearer"},
-#     )
-#     try:
-#         print("at the start", form_data)
-#         user = authenticate_user(fake_users_db, form_data.username, form_data.password)
-#         if not user:
-#             raise credentials_exception
-#         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-#         access_token = create_access_token(
-#             data={"sub": user.username}, expires_delta=access_token_expires
-#         )
-#         return Token(access_token=access_token, token_type="bearer")
-#     except Exception as exc:
-#         print("Got exception ", exc)
-#         raise credentials_exception
-
-
-# async def read_users_me(
-#     current_user: Annotated[User, Depends(get_current_user)],
-# ):
-#     return current_user
-
-
-# async def read_own_items(
-#     current_user: Annotated[User, Depends(get_current_user)],
-# ):
-#     return [{"item_id": "Foo", "owner": current_user.username}]
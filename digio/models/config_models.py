@@ -1,25 +1,417 @@
 # GiG
 
+import os
 from pathlib import Path
-from pydantic import BaseModel, ConfigDict
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 from digio.utils import utils
 
+# The web server is started by uvicorn, which imports the app by itself,
+# so the config file is located through an env variable instead of an argument
+CONFIG_PATH_ENV_VAR = "DIGIO_CONFIG_PATH"
+DEFAULT_CONFIG_PATH = Path("implementation/demo/configs.toml")
+# Set by the launcher for its workers, so that limits meant for the whole
+# server can be shared out between them
+SERVER_WORKERS_ENV_VAR = "DIGIO_SERVER_WORKERS"
+# Set by the launcher once it has created the schema, so that its workers
+# do not create it again. Any other start creates it
+SCHEMA_CREATED_ENV_VAR = "DIGIO_SCHEMA_CREATED"
+# Set by the launcher when auth_configs.secret_key is not, so that its
+# workers sign tokens with the same random key and accept each other's
+SECRET_KEY_ENV_VAR = "DIGIO_SECRET_KEY"
+
+
+# Async drivers used in place of the sync ones when async_mode is on
+ASYNC_DB_PREFIXES = {
+    "sqlite:///": "sqlite+aiosqlite:///",
+}
+
+
+class SQLitePragmaConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # WAL lets readers carry on while a writer commits, and NORMAL only
+    # syncs at checkpoints, which is still safe against corruption in WAL
+    journal_mode: str = "WAL"
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    # In bytes
+    mmap_size: int = 256 * 1024 * 1024
+    # Negative values are in KiB, positive values in pages
+    cache_size: int = -64 * 1024
+    temp_store: Literal["DEFAULT", "FILE", "MEMORY"] = "MEMORY"
+    # How long a writer waits for the lock before "database is locked", in ms
+    busy_timeout: int = 5000
+    foreign_keys: bool = True
+
 
 class DatabaseConfigs(BaseModel):
     model_config = ConfigDict(extra="forbid")
     db_file_path: Path
     db_prefix: str
+    # Also create an async engine for get_async_db_session
+    async_mode: bool = False
+    # Logs every statement, only meant for debugging
+    echo: bool = False
+    # Keep latency histograms per statement, see /ops/slow_queries/
+    track_query_stats: bool = True
+    # Statements slower than this are logged, in milliseconds
+    slow_query_threshold_ms: float = 100.0
+    # Time statements by operation and sessions for /metrics
+    track_metrics: bool = True
+    # Set on every new SQLite connection, ignored for other databases
+    sqlite_pragmas: SQLitePragmaConfigs = SQLitePragmaConfigs()
+    # "auto" uses a static pool (one shared connection) for an in-memory
+    # database, which would otherwise be a new empty database per
+    # connection, and a queue pool for a database file
+    pool_class: Literal["auto", "queue", "static", "null"] = "auto"
+    # Only used by the queue pool
+    pool_size: int = 5
+    max_overflow: int = 10
+
+    @model_validator(mode="after")
+    def check_async_mode(self) -> "DatabaseConfigs":
+        if not self.async_mode:
+            return self
+        if self.db_prefix not in ASYNC_DB_PREFIXES:
+            raise ValueError(
+                f"async_mode is not supported for {self.db_prefix}, expected one of {', '.join(ASYNC_DB_PREFIXES)}"
+            )
+        # The async engine would open a database of its own,
+        # which would not have the schema or the data of the sync one
+        if self.is_in_memory():
+            raise ValueError("async_mode cannot be used with an in-memory database")
+        return self
+
+    def is_in_memory(self) -> bool:
+        return str(self.db_file_path) == ":memory:"
+
+    def get_db_path(self) -> str:
+        if self.is_in_memory():
+            return ":memory:"
+        return str(self.db_file_path.absolute())
 
     def get_db_url(self) -> str:
-        return f"{self.db_prefix}{self.db_file_path.absolute()}"
+        return f"{self.db_prefix}{self.get_db_path()}"
+
+    def get_async_db_url(self) -> str:
+        return f"{ASYNC_DB_PREFIXES[self.db_prefix]}{self.get_db_path()}"
+
+    def get_pool_class(self) -> str:
+        if self.pool_class == "auto":
+            return "static" if self.is_in_memory() else "queue"
+        return self.pool_class
+
+
+class DigioClientConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    base_url: str = "https://api.digio.in"
+    # Digio uses basic auth with the client id and secret
+    client_id: Optional[str] = None
+    client_secret: Optional[str] = None
+    http2: bool = True
+    # All timeouts are in seconds
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    write_timeout: float = 30.0
+    pool_timeout: float = 5.0
+    # Limits are per host, and we only talk to one host
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60.0
+
+
+class UpstreamLimitConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # Sustained rate and how many calls can go out at once after a quiet spell
+    per_second: float = Field(default=10.0, gt=0)
+    burst: int = Field(default=10, ge=1)
+    # Calls per UTC day, not limited when unset
+    per_day: Optional[int] = None
+
+
+class UpstreamGovernorConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    default_limits: UpstreamLimitConfigs = UpstreamLimitConfigs()
+    # Keyed by endpoint: create_kyc_request, fetch_id_data, analyze_idcard
+    limits_by_endpoint: Dict[str, UpstreamLimitConfigs] = {}
+    # How long a call may wait for its turn before it is refused with a 429,
+    # in seconds. Batch items wait longer and always go after interactive calls
+    interactive_deadline: float = 5.0
+    batch_deadline: float = 120.0
+    # How often the daily counts are written to the DB, in seconds
+    quota_flush_interval: float = 5.0
+
+    def get_limits(self, endpoint: str) -> UpstreamLimitConfigs:
+        return self.limits_by_endpoint.get(endpoint, self.default_limits)
+
+
+class UpstreamResilienceConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    # Only idempotent calls are retried, ie. fetch_id_data with a
+    # unique_request_id. Delays are in seconds, doubling up to the max
+    # with full jitter
+    max_retries: int = 2
+    retry_base_delay: float = 0.1
+    retry_max_delay: float = 2.0
+    # Send a second copy of an idempotent call that has not answered
+    # within the hedge_quantile of the endpoint's recent latencies
+    hedging: bool = False
+    hedge_quantile: float = Field(default=0.95, gt=0, lt=1)
+    hedge_min_delay: float = 0.05
+    hedge_min_samples: int = 20
+    latency_window: int = 200
+    # After this many failures in a row an endpoint is not called for
+    # open_duration seconds, then a single trial call decides whether
+    # it is back
+    failure_threshold: int = 5
+    open_duration: float = 30.0
+
+
+class FakeDigioConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # Serve the Digio client from the fake Digio app inside the worker
+    # instead of calling base_url, for load tests without the vendor
+    in_process: bool = False
+    # Where python -m digio.web_services.fake_digio listens
+    host: str = "127.0.0.1"
+    port: int = 9000
+    # Latency of every response in milliseconds. fixed is always latency_ms,
+    # uniform is latency_ms +/- latency_spread * latency_ms and lognormal
+    # has a median of latency_ms and a sigma of latency_spread
+    latency_distribution: Literal["fixed", "uniform", "lognormal"] = "lognormal"
+    latency_ms: float = 80.0
+    latency_spread: float = 0.5
+    # Keyed by endpoint: create_kyc_request, fetch_id_data, analyze_idcard
+    latency_ms_by_endpoint: Dict[str, float] = {}
+    # Fraction of calls answered with a 500
+    error_rate: float = Field(default=0.0, ge=0, le=1)
+    # Calls beyond this rate are answered with a 429, not limited when unset
+    rate_limit_per_second: Optional[float] = None
+    # Every throttle_burst_interval seconds, every call is answered with a
+    # 429 for throttle_burst_duration seconds. Off when the interval is 0
+    throttle_burst_interval: float = 0.0
+    throttle_burst_duration: float = 1.0
+    # Added to every response as padding, to try out larger payloads
+    extra_payload_bytes: int = 0
+    # Makes the latencies and errors the same on every run
+    seed: Optional[int] = None
+
+
+class IDCardCacheConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    # Size of the in-process LRU, the DB table is only bounded by the TTLs
+    max_memory_entries: int = 10_000
+    # All TTLs are in seconds
+    default_ttl: int = 24 * 60 * 60
+    # Keyed by IDCardType, eg. {"PAN" = 604800, "VEHICLE_RC" = 3600}
+    ttl_by_type: Dict[str, int] = {}
+    # Expired results are kept this much longer and only served
+    # when Digio is down for the ID card type
+    serve_stale_for: int = 7 * 24 * 60 * 60
+
+    def get_ttl(self, id_type: str) -> int:
+        return self.ttl_by_type.get(id_type, self.default_ttl)
+
+
+class IdempotencyConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    max_memory_entries: int = 10_000
+    # How long a response is replayed for a repeated request, in seconds
+    ttl: int = 24 * 60 * 60
+    # How often expired responses are deleted from the DB, in seconds
+    compaction_interval: int = 60 * 60
+
+
+class IDCardBatchConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    max_items: int = 1000
+    # How many items of one batch are sent to Digio at the same time
+    max_concurrency: int = 16
+
+
+class IDCardAnalysisConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # Uploads larger than this are spooled to a temp file on disk
+    spool_memory_limit: int = 64 * 1024
+
+
+class BulkImportConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # Rows written per statement and commit
+    chunk_size: int = 500
+    max_rows: int = 50_000
+
+
+class CompressionConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    # In order of preference when the client accepts more than one equally,
+    # zstd and br are skipped if zstandard/brotli are not installed
+    algorithms: List[str] = ["zstd", "br", "gzip"]
+    gzip_level: int = 6
+    brotli_level: int = 4
+    zstd_level: int = 3
+    # Smaller bodies are sent as is, streamed bodies are always compressed
+    minimum_size: int = 1000
+    # Content types starting with any of these are already compressed
+    excluded_content_types: List[str] = [
+        "image/",
+        "video/",
+        "audio/",
+        "application/pdf",
+        "application/zip",
+        "application/gzip",
+        "application/octet-stream",
+    ]
+    # Compressed copies of recently sent bodies, so a body that is sent
+    # again (cache hits, replays) is not compressed again
+    cache_max_entries: int = 256
+    cache_max_body_size: int = 256 * 1024
+    cache_ttl: int = 10 * 60
+
+
+class MetricsConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # Request, upstream and cache metrics at /metrics, see also
+    # track_metrics in the DatabaseConfigs for the DB timers
+    enabled: bool = True
+    # Histogram bucket bounds, in seconds
+    http_buckets: List[float] = [
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    ]
+    upstream_buckets: List[float] = [
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+    ]
+
+
+class PasswordHasherConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # bcrypt cost, each step doubles the time of a hash. Existing hashes
+    # with a different cost are rehashed on the next successful login
+    bcrypt_rounds: int = Field(default=12, ge=4, le=31)
+    # Processes keep the hashing off the event loop and the GIL,
+    # threads are enough for tests
+    executor: Literal["process", "thread"] = "process"
+    # spawn is safe to use from a process that already runs threads
+    start_method: Literal["spawn", "forkserver", "fork"] = "spawn"
+    # Defaults to the number of CPUs shared out between the server's workers
+    max_workers: Optional[int] = None
+    # Hashes waiting for a free worker beyond this are refused with a 503,
+    # so a burst of logins cannot queue up without bound
+    max_queue_depth: int = 64
+
+
+class AuthConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    # To get one run: openssl rand -hex 32
+    # Without it a random key is used, shared by the workers of one
+    # launch, so tokens stop working on a restart
+    secret_key: Optional[str] = None
+    algorithm: Literal["HS256", "HS384", "HS512"] = "HS256"
+    access_token_expire_minutes: int = 30
+    # Tokens that were verified recently are not verified again,
+    # entries never outlive the token's exp
+    token_cache_max_entries: int = 10_000
+    token_cache_ttl: int = 5 * 60
+    # Users looked up for a token are reused for this long, in seconds
+    principal_cache_max_entries: int = 10_000
+    principal_cache_ttl: int = 60
+
+
+class ServerConfigs(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    host: str = "127.0.0.1"
+    port: int = 8000
+    # Worker processes, defaults to the number of CPUs
+    workers: Optional[int] = Field(default=None, ge=1)
+    # auto picks uvloop and httptools when they are installed
+    loop: Literal["auto", "uvloop", "asyncio"] = "auto"
+    http: Literal["auto", "httptools", "h11"] = "auto"
+    # Connections the OS queues up before the workers accept them
+    backlog: int = 2048
+    # Seconds an idle connection is kept open for the next request
+    timeout_keep_alive: int = 5
+    # Seconds the workers get on SIGTERM to finish the requests in flight
+    timeout_graceful_shutdown: int = 30
+    # Requests over this many in flight per worker get a 503, not limited when unset
+    limit_concurrency: Optional[int] = None
+    log_level: Literal["critical", "error", "warning", "info", "debug", "trace"] = (
+        "info"
+    )
+    # A line per request costs more than the request itself for the fast endpoints
+    access_log: bool = False
+    # Trust X-Forwarded-For and X-Forwarded-Proto from these addresses
+    forwarded_allow_ips: Optional[str] = None
+    # Served as /openapi.json instead of building it in every worker, written by
+    # python -m digio.utils.startup_profile --write-openapi
+    openapi_file: Optional[Path] = None
+
+    def get_workers(self) -> int:
+        return self.workers or os.cpu_count() or 1
+
+
+def get_server_workers() -> int:
+    return int(os.environ.get(SERVER_WORKERS_ENV_VAR, 1))
+
+
+def is_schema_created() -> bool:
+    return os.environ.get(SCHEMA_CREATED_ENV_VAR) == "1"
+
+
+def get_launcher_secret_key() -> Optional[str]:
+    return os.environ.get(SECRET_KEY_ENV_VAR) or None
 
 
 class GlobalConfigs(BaseModel):
     model_config = ConfigDict(extra="forbid")
     db_configs: DatabaseConfigs
+    # Files written by the service (eg. images from ID card analysis) go here
+    data_dir: Path = Path("implementation/demo/data")
+    digio_configs: DigioClientConfigs = DigioClientConfigs()
+    fake_digio_configs: FakeDigioConfigs = FakeDigioConfigs()
+    upstream_governor_configs: UpstreamGovernorConfigs = UpstreamGovernorConfigs()
+    upstream_resilience_configs: UpstreamResilienceConfigs = UpstreamResilienceConfigs()
+    idcard_cache_configs: IDCardCacheConfigs = IDCardCacheConfigs()
+    idempotency_configs: IdempotencyConfigs = IdempotencyConfigs()
+    idcard_batch_configs: IDCardBatchConfigs = IDCardBatchConfigs()
+    idcard_analysis_configs: IDCardAnalysisConfigs = IDCardAnalysisConfigs()
+    compression_configs: CompressionConfigs = CompressionConfigs()
+    bulk_import_configs: BulkImportConfigs = BulkImportConfigs()
+    metrics_configs: MetricsConfigs = MetricsConfigs()
+    password_hasher_configs: PasswordHasherConfigs = PasswordHasherConfigs()
+    auth_configs: AuthConfigs = AuthConfigs()
+    server_configs: ServerConfigs = ServerConfigs()
 
     @staticmethod
     def load_from_path(file_path: Path) -> "GlobalConfigs":
         data = utils.load_toml(file_path)
         configs = GlobalConfigs.model_validate(data)
         return configs
+
+    @staticmethod
+    def load_default() -> "GlobalConfigs":
+        file_path = Path(os.environ.get(CONFIG_PATH_ENV_VAR, DEFAULT_CONFIG_PATH))
+        return GlobalConfigs.load_from_path(file_path)
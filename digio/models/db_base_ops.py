@@ -1,11 +1,24 @@
 # GiG
-from typing import Type, TypeVar
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Type, TypeVar
 
 from fastapi import HTTPException, status
+from loguru import logger
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import delete, func, insert, select
 from sqlmodel import Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 SQLModelType = TypeVar("SQLModelType", bound=SQLModel)
 
+# Rows written per statement and commit by the bulk helpers
+DEFAULT_CHUNK_SIZE = 500
+# Never returned by list_entities, even when asked for
+HIDDEN_COLUMNS = frozenset(["hashed_pwd"])
+# How long a total count is reused before it is counted again, in seconds
+COUNT_ESTIMATE_TTL = 60
+
 
 def create_entity(session: Session, entity: SQLModelType) -> SQLModelType:
     try:
@@ -58,7 +71,7 @@ def update_entity(
         session.commit()
         session.refresh(db_item)
     except Exception as e:
-        print(f"Got exception {e}")
+        logger.warning(f"Got exception {e}")
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Error when processing {type(entity).__tablename__} with ID {entity_id}: {e}",
@@ -81,8 +94,455 @@ def delete_entity(
         session.commit()
         return {"ok": True}
     except Exception as e:
-        print(f"Got exception {e}")
+        logger.warning(f"Got exception {e}")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Error when processing {entity_type.__tablename__} with ID {entity_id}: {e}",
+        ) from e
+
+
+# Async versions of the helpers above, for handlers that use
+# get_async_db_session instead of get_db_session
+
+
+async def create_entity_async(
+    session: AsyncSession, entity: SQLModelType
+) -> SQLModelType:
+    try:
+        db_item = type(entity).model_validate(entity)
+        session.add(db_item)
+        await session.commit()
+        await session.refresh(db_item)
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Error when processing {entity.__tablename__} {e}",
+        ) from e
+    return db_item
+
+
+async def get_entity_async(
+    session: AsyncSession, entity_id: int, entity_type: Type[SQLModelType]
+) -> SQLModelType:
+    db_item = await session.get(entity_type, entity_id)
+    if db_item is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cannot find {entity_type.__tablename__} with ID {entity_id}",
+        )
+    return db_item
+
+
+async def update_entity_async(
+    session: AsyncSession,
+    entity_id: int,
+    entity: SQLModelType,
+) -> SQLModelType:
+    db_item = await session.get(type(entity), entity_id)
+    if db_item is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Item type {type(entity).__tablename__} with ID {entity_id} not found",
+        )
+
+    try:
+        entity_data = entity.model_dump(exclude_unset=True)
+        db_item.sqlmodel_update(entity_data)
+        _ = type(entity).model_validate(db_item)
+
+        session.add(db_item)
+        await session.commit()
+        await session.refresh(db_item)
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Error when processing {type(entity).__tablename__} with ID {entity_id}: {e}",
+        ) from e
+    return db_item
+
+
+async def delete_entity_async(
+    session: AsyncSession, entity_id: int, entity_type: Type[SQLModelType]
+) -> dict:
+    db_item = await session.get(entity_type, entity_id)
+    if not db_item:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Entity {entity_type.__tablename__} with ID {entity_id} not found",
+        )
+
+    try:
+        await session.delete(db_item)
+        await session.commit()
+        return {"ok": True}
+    except Exception as e:
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Error when processing {entity_type.__tablename__} with ID {entity_id}: {e}",
         ) from e
+
+
+# Bulk helpers: rows are validated up front, written a chunk at a time with
+# one statement and one commit per chunk, and a row that fails is reported
+# by its position in the input instead of failing the whole batch.
+# When a chunk fails in the database (eg. a foreign key), it is retried
+# row by row in savepoints to find the rows at fault.
+
+
+class BulkRowError(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkResult(BaseModel):
+    succeeded: int = 0
+    # IDs of the rows created, updated or deleted, in input order
+    ids: List[int] = []
+    errors: List[BulkRowError] = []
+
+
+def _chunks(items: list, chunk_size: int):
+    for start in range(0, len(items), chunk_size):
+        yield items[start : start + chunk_size]
+
+
+def _validate_rows(
+    entity_type: Type[SQLModelType], rows: Sequence[Any], result: BulkResult
+) -> List[tuple[int, SQLModelType]]:
+    valid_rows = []
+    for index, row in enumerate(rows):
+        try:
+            valid_rows.append((index, entity_type.model_validate(row)))
+        except ValidationError as e:
+            result.errors.append(BulkRowError(index=index, detail=str(e)))
+    return valid_rows
+
+
+def _insert_values(entity: SQLModel) -> Dict[str, Any]:
+    values = entity.model_dump()
+    # Let the database assign the primary key
+    if values.get("id") is None:
+        values.pop("id", None)
+    return values
+
+
+def _insert_chunk(
+    session: Session,
+    entity_type: Type[SQLModelType],
+    chunk: List[tuple[int, SQLModelType]],
+) -> List[int]:
+    ids_by_index = {}
+    # executemany needs the same columns on every row, so rows that come
+    # with their own id are inserted separately from those that do not
+    for with_id in (False, True):
+        group = [
+            (index, entity)
+            for index, entity in chunk
+            if (entity.id is not None) == with_id  # type: ignore
+        ]
+        if not group:
+            continue
+        statement = insert(entity_type).returning(
+            entity_type.id,  # type: ignore
+            sort_by_parameter_order=True,
+        )
+        inserted_ids = session.scalars(
+            statement, [_insert_values(entity) for _, entity in group]
+        ).all()
+        for (index, _), entity_id in zip(group, inserted_ids):
+            ids_by_index[index] = entity_id
+    return [ids_by_index[index] for index, _ in chunk]
+
+
+def bulk_create_entities(
+    session: Session,
+    entity_type: Type[SQLModelType],
+    rows: Sequence[Any],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> BulkResult:
+    result = BulkResult()
+    valid_rows = _validate_rows(entity_type, rows, result)
+    for chunk in _chunks(valid_rows, chunk_size):
+        try:
+            result.ids.extend(_insert_chunk(session, entity_type, chunk))
+            session.commit()
+            result.succeeded += len(chunk)
+            continue
+        except Exception:
+            session.rollback()
+
+        for index, entity in chunk:
+            try:
+                with session.begin_nested():
+                    result.ids.extend(
+                        _insert_chunk(session, entity_type, [(index, entity)])
+                    )
+                result.succeeded += 1
+            except Exception as e:
+                result.errors.append(
+                    BulkRowError(
+                        index=index,
+                        detail=f"Error when processing {entity_type.__tablename__} {e}",
+                    )
+                )
+        session.commit()
+    result.errors.sort(key=lambda error: error.index)
+    return result
+
+
+def bulk_update_entities(
+    session: Session,
+    entity_type: Type[SQLModelType],
+    rows: Sequence[Dict[str, Any]],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> BulkResult:
+    # Every row must have the id of the entity to update, the other
+    # fields in it are set the same way as update_entity does
+    result = BulkResult()
+    indexed_rows = []
+    for index, row in enumerate(rows):
+        if row.get("id") is None:
+            result.errors.append(BulkRowError(index=index, detail="id is required"))
+        else:
+            indexed_rows.append((index, row))
+
+    for chunk in _chunks(indexed_rows, chunk_size):
+        # One SELECT for the chunk, the UPDATEs of rows that change
+        # the same columns are then sent together on commit
+        chunk_ids = [row["id"] for _, row in chunk]
+        db_items = {
+            db_item.id: db_item  # type: ignore
+            for db_item in session.scalars(
+                select(entity_type).where(entity_type.id.in_(chunk_ids))  # type: ignore
+            )
+        }
+        updated = []
+        for index, row in chunk:
+            db_item = db_items.get(row["id"])
+            if db_item is None:
+                result.errors.append(
+                    BulkRowError(
+                        index=index,
+                        detail=f"Item type {entity_type.__tablename__} with ID {row['id']} not found",
+                    )
+                )
+                continue
+            try:
+                db_item.sqlmodel_update(row)
+                # Do not try to use the output of model_validate
+                # as it will cause SQLModel errors when inserting
+                _ = entity_type.model_validate(db_item)
+                updated.append((index, db_item))
+            except ValidationError as e:
+                session.expire(db_item)
+                result.errors.append(BulkRowError(index=index, detail=str(e)))
+
+        try:
+            session.commit()
+            result.ids.extend(db_item.id for _, db_item in updated)
+            result.succeeded += len(updated)
+            continue
+        except Exception:
+            session.rollback()
+
+        updated_indexes = {index for index, _ in updated}
+        for index, row in chunk:
+            if index not in updated_indexes:
+                continue
+            try:
+                with session.begin_nested():
+                    db_item = session.get(entity_type, row["id"])
+                    db_item.sqlmodel_update(row)  # type: ignore
+                    _ = entity_type.model_validate(db_item)
+                result.ids.append(row["id"])
+                result.succeeded += 1
+            except Exception as e:
+                result.errors.append(
+                    BulkRowError(
+                        index=index,
+                        detail=f"Error when processing {entity_type.__tablename__} with ID {row['id']}: {e}",
+                    )
+                )
+        session.commit()
+    result.errors.sort(key=lambda error: error.index)
+    return result
+
+
+def bulk_delete_entities(
+    session: Session,
+    entity_type: Type[SQLModelType],
+    entity_ids: Sequence[int],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> BulkResult:
+    result = BulkResult()
+    indexed_ids = list(enumerate(entity_ids))
+    for chunk in _chunks(indexed_ids, chunk_size):
+        chunk_ids = [entity_id for _, entity_id in chunk]
+        deleted_ids = set()
+        try:
+            deleted_ids = set(
+                session.scalars(
+                    delete(entity_type)
+                    .where(entity_type.id.in_(chunk_ids))  # type: ignore
+                    .returning(entity_type.id)  # type: ignore
+                )
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            for index, entity_id in chunk:
+                try:
+                    with session.begin_nested():
+                        deleted_ids.update(
+                            session.scalars(
+                                delete(entity_type)
+                                .where(entity_type.id == entity_id)  # type: ignore
+                                .returning(entity_type.id)  # type: ignore
+                            )
+                        )
+                except Exception as e:
+                    result.errors.append(
+                        BulkRowError(
+                            index=index,
+                            detail=f"Error when processing {entity_type.__tablename__} with ID {entity_id}: {e}",
+                        )
+                    )
+            session.commit()
+
+        failed = {error.index for error in result.errors}
+        for index, entity_id in chunk:
+            if entity_id in deleted_ids:
+                result.ids.append(entity_id)
+                result.succeeded += 1
+            elif index not in failed:
+                result.errors.append(
+                    BulkRowError(
+                        index=index,
+                        detail=f"Entity {entity_type.__tablename__} with ID {entity_id} not found",
+                    )
+                )
+    result.errors.sort(key=lambda error: error.index)
+    return result
+
+
+# Listing: keyset pagination on the primary key, so that every page is an
+# index range scan no matter how deep it is, unlike OFFSET which reads and
+# throws away all the rows before the page
+
+
+class Page(BaseModel):
+    items: List[Dict[str, Any]]
+    # Pass as after to get the next page, None on the last page
+    next_cursor: Optional[int] = None
+    # Counted at most once every COUNT_ESTIMATE_TTL seconds per filter
+    total_estimate: int
+
+
+class CountEstimates:
+    # Counting all the matching rows is a scan, so the count for a
+    # table and filter is kept for a while and shared by every page
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # list_entities runs in the threadpool
+        self._lock = threading.Lock()
+        self._counts: Dict[tuple, tuple[float, int]] = {}
+
+    def get(self, key: tuple) -> Optional[int]:
+        with self._lock:
+            entry = self._counts.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: tuple, count: int):
+        with self._lock:
+            if len(self._counts) >= self.max_entries:
+                self._counts.clear()
+            self._counts[key] = (time.monotonic() + self.ttl, count)
+
+
+count_estimates = CountEstimates(COUNT_ESTIMATE_TTL)
+
+
+def _get_column(entity_type: Type[SQLModel], column_name: str):
+    column = entity_type.__table__.columns.get(column_name)  # type: ignore
+    if column is None or column_name in HIDDEN_COLUMNS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{entity_type.__tablename__} has no column {column_name}",
+        )
+    return column
+
+
+def _coerce_filter_value(column, value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+        if python_type is bool:
+            return value.lower() in ("1", "true", "yes")
+        return python_type(value)
+    except (NotImplementedError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid value {value} for {column.name}",
+        ) from e
+
+
+def build_list_statements(
+    entity_type: Type[SQLModel],
+    filters: Optional[Dict[str, Any]] = None,
+    after: Optional[int] = None,
+    limit: int = 100,
+    columns: Optional[List[str]] = None,
+):
+    # Returns the statements for a page and for the total count
+    table = entity_type.__table__  # type: ignore
+    if columns:
+        selected = [table.c.id] + [
+            _get_column(entity_type, name) for name in columns if name != "id"
+        ]
+    else:
+        selected = [column for column in table.c if column.name not in HIDDEN_COLUMNS]
+
+    conditions = []
+    for name, value in (filters or {}).items():
+        column = _get_column(entity_type, name)
+        conditions.append(column == _coerce_filter_value(column, value))
+
+    statement = select(*selected).where(*conditions)
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+    # One extra row tells if there is a next page
+    statement = statement.order_by(table.c.id).limit(limit + 1)
+    count_statement = select(func.count()).select_from(table).where(*conditions)
+    return statement, count_statement
+
+
+def list_entities(
+    session: Session,
+    entity_type: Type[SQLModelType],
+    filters: Optional[Dict[str, Any]] = None,
+    after: Optional[int] = None,
+    limit: int = 100,
+    columns: Optional[List[str]] = None,
+) -> Page:
+    statement, count_statement = build_list_statements(
+        entity_type, filters, after, limit, columns
+    )
+    rows = [dict(row) for row in session.execute(statement).mappings()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    count_key = (entity_type.__tablename__, tuple(sorted((filters or {}).items())))
+    total_estimate = count_estimates.get(count_key)
+    if total_estimate is None:
+        total_estimate = session.execute(count_statement).scalar_one()
+        count_estimates.set(count_key, total_estimate)
+    return Page(items=rows, next_cursor=next_cursor, total_estimate=total_estimate)
@@ -1,51 +1,247 @@
 # GiG
 
-from sqlite3 import Connection as SQLite3Connection
+import time
+from typing import Any, Dict, Optional
 
+from loguru import logger
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool, StaticPool
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # DO NOT REMOVE THIS LINE
 # This will import all the db_schemas and "register" them
 # so that we can call create_all if necessary
 # Due to this, I am disabling the pylint and ruff checks
 # pylint: disable=unused-import
+from digio.models import db_schemas  # noqa: F401
 from digio.models.config_models import DatabaseConfigs
+from digio.models.query_stats import QueryStats, start_query_stats
+from digio.utils.metrics import registry
 
 engine = None
+# Only created when async_mode is on in the DatabaseConfigs
+async_engine: Optional[AsyncEngine] = None
 
 
-# By default, SQLite3 database does not check for foreign key violations
-# See Sec2 of https://www.sqlite.org/foreignkeys.html
-# this is especially the case for in-memory database that we use for testing
-# so you can insert a child tuple even if the corresponding entry
-# in parent does not exist.
-# we prevent this using this hack
-@event.listens_for(Engine, "connect")
-def _set_sqlite_pragma(dbapi_connection, connection_record):
-    if isinstance(dbapi_connection, SQLite3Connection):
+# Exported at /metrics when track_metrics is on in the DatabaseConfigs
+DB_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+DB_OPERATIONS = ["select", "insert", "update", "delete", "other"]
+db_query_seconds = registry.histogram(
+    "digio_db_query_duration_seconds",
+    "Time to run a SQL statement",
+    ["operation"],
+    DB_BUCKETS,
+)
+db_query_seconds.prepare([[operation] for operation in DB_OPERATIONS])
+db_session_seconds = registry.histogram(
+    "digio_db_session_duration_seconds",
+    "Time a request held a DB session",
+    buckets=DB_BUCKETS,
+)
+db_session_seconds.prepare([[]])
+track_metrics = False
+
+SYNCHRONOUS_VALUES = {"OFF": 0, "NORMAL": 1, "FULL": 2, "EXTRA": 3}
+TEMP_STORE_VALUES = {"DEFAULT": 0, "FILE": 1, "MEMORY": 2}
+
+
+# The PRAGMAs in the order they are set, with the values that
+# reading them back should give
+def get_sqlite_pragmas(db_configs: DatabaseConfigs) -> Dict[str, Any]:
+    pragma_configs = db_configs.sqlite_pragmas
+    # Set first so that switching the journal mode also waits for locks
+    pragmas: Dict[str, Any] = {"busy_timeout": pragma_configs.busy_timeout}
+    if not db_configs.is_in_memory():
+        # An in-memory database always uses the memory journal and no mmap
+        pragmas["journal_mode"] = pragma_configs.journal_mode.lower()
+        pragmas["mmap_size"] = pragma_configs.mmap_size
+    pragmas["synchronous"] = SYNCHRONOUS_VALUES[pragma_configs.synchronous]
+    pragmas["cache_size"] = pragma_configs.cache_size
+    pragmas["temp_store"] = TEMP_STORE_VALUES[pragma_configs.temp_store]
+    # By default, SQLite3 database does not check for foreign key violations
+    # See Sec2 of https://www.sqlite.org/foreignkeys.html
+    # this is especially the case for in-memory database that we use for testing
+    # so you can insert a child tuple even if the corresponding entry
+    # in parent does not exist.
+    pragmas["foreign_keys"] = int(pragma_configs.foreign_keys)
+    return pragmas
+
+
+# Registered on our own engines only, as a listener on the Engine class
+# would also run for every other engine created in the process
+def _create_sqlite_pragma_listener(db_configs: DatabaseConfigs):
+    pragmas = get_sqlite_pragmas(db_configs)
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Works for sqlite3 and for the aiosqlite adapter of the async engine
         cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON;")
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value};")
         cursor.close()
 
+    return set_sqlite_pragmas
+
+
+def verify_sqlite_pragmas(sqlite_engine: Engine, db_configs: DatabaseConfigs) -> dict:
+    expected = get_sqlite_pragmas(db_configs)
+    actual = {}
+    with sqlite_engine.connect() as connection:
+        for name in expected:
+            actual[name] = connection.exec_driver_sql(f"PRAGMA {name};").scalar()
+    for name, value in expected.items():
+        if str(actual[name]).lower() != str(value).lower():
+            logger.warning(f"SQLite PRAGMA {name} is {actual[name]} instead of {value}")
+    logger.info(f"SQLite PRAGMAs: {actual}")
+    return actual
+
+
+def _get_pool_args(db_configs: DatabaseConfigs, is_async: bool) -> dict:
+    pool_class = db_configs.get_pool_class()
+    if pool_class == "static":
+        return {"poolclass": StaticPool}
+    if pool_class == "null":
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": AsyncAdaptedQueuePool if is_async else QueuePool,
+        "pool_size": db_configs.pool_size,
+        "max_overflow": db_configs.max_overflow,
+    }
+
 
 def get_db_session():
-    with Session(engine) as session:
-        yield session
+    start_time = time.perf_counter()
+    try:
+        with Session(engine) as session:
+            yield session
+    finally:
+        if track_metrics:
+            db_session_seconds.labels().observe(time.perf_counter() - start_time)
+
+
+async def get_async_db_session():
+    start_time = time.perf_counter()
+    try:
+        # Objects stay loaded after a commit, as lazy loading them
+        # again would need IO outside of an await
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+    finally:
+        if track_metrics:
+            db_session_seconds.labels().observe(time.perf_counter() - start_time)
+
+
+def get_operation(statement: str) -> str:
+    operation = statement.lstrip()[:6].lower()
+    return operation if operation in DB_OPERATIONS else "other"
 
 
-def initialize_dbs(db_configs: DatabaseConfigs):
+# A single listener pair times every statement and feeds both the query
+# stats and the /metrics histogram, so that a statement is only timed once
+def instrument_engine(
+    sync_engine: Engine, query_stats: Optional[QueryStats], track_metrics: bool
+):
+    if query_stats is None and not track_metrics:
+        return
+    children = {
+        operation: db_query_seconds.labels(operation) for operation in DB_OPERATIONS
+    }
+
+    # The start times are kept on the connection as a stack, as the
+    # same connection may run a statement while another is being timed
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(
+        connection, cursor, statement, parameters, context, executemany
+    ):
+        connection.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(
+        connection, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - connection.info["query_start_times"].pop()
+        if query_stats is not None:
+            query_stats.record(statement, elapsed * 1000)
+        if track_metrics:
+            children[get_operation(statement)].observe(elapsed)
+
+    # A failed statement never reaches after_cursor_execute
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_times"):
+            connection.info["query_start_times"].pop()
+
+
+# With several workers the launcher creates the schema once before starting
+# them, and each worker only creates its engines, as create_all racing
+# in every worker can fail on a table another worker has just created
+def initialize_dbs(db_configs: DatabaseConfigs, create_schema: bool = True):
+    query_stats = start_query_stats(db_configs)
     engine = create_db_engine(db_configs)
     assert engine is not None
-    SQLModel.metadata.create_all(engine)
+    if create_schema:
+        SQLModel.metadata.create_all(engine)
+        ensure_indexes(engine)
+    if engine.dialect.name == "sqlite":
+        verify_sqlite_pragmas(engine, db_configs)
+    if db_configs.async_mode:
+        create_async_db_engine(db_configs)
+    global track_metrics
+    track_metrics = db_configs.track_metrics
+    instrument_engine(engine, query_stats, track_metrics)
+    if async_engine is not None:
+        instrument_engine(async_engine.sync_engine, query_stats, track_metrics)
     return engine
 
 
+# create_all only creates the indexes of tables it creates, so
+# indexes added to existing tables are created here
+def ensure_indexes(sync_engine: Engine):
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_engine, checkfirst=True)
+
+
 def create_db_engine(db_configs: DatabaseConfigs):
     global engine
-    connect_args = {"check_same_thread": False}
+    connect_args = {}
+    if db_configs.db_prefix.startswith("sqlite"):
+        connect_args["check_same_thread"] = False
     engine = create_engine(
-        db_configs.get_db_url(), echo=True, connect_args=connect_args
+        db_configs.get_db_url(),
+        echo=db_configs.echo,
+        connect_args=connect_args,
+        **_get_pool_args(db_configs, is_async=False),
     )
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _create_sqlite_pragma_listener(db_configs))
     return engine
+
+
+def create_async_db_engine(db_configs: DatabaseConfigs) -> AsyncEngine:
+    global async_engine
+    async_engine = create_async_engine(
+        db_configs.get_async_db_url(),
+        echo=db_configs.echo,
+        **_get_pool_args(db_configs, is_async=True),
+    )
+    if async_engine.dialect.name == "sqlite":
+        event.listen(
+            async_engine.sync_engine,
+            "connect",
+            _create_sqlite_pragma_listener(db_configs),
+        )
+    return async_engine
+
+
+def dispose_db_engine():
+    if engine is not None:
+        engine.dispose()
+
+
+async def dispose_async_db_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
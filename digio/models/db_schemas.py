@@ -1,8 +1,14 @@
 # GiG
 
+from datetime import datetime
 from typing import Optional
 
-from sqlmodel import Field, SQLModel, UniqueConstraint
+from sqlmodel import Field, Index, SQLModel, UniqueConstraint
+
+# Every foreign key column is indexed, by index=True or by leading a
+# composite index or unique constraint, as with foreign_keys=ON deleting
+# a parent looks up its children by that column.
+# python -m digio.utils.index_advisor checks the queries we run for scans.
 
 
 class College(SQLModel, table=True):
@@ -17,16 +23,20 @@ class Department(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     short_name: str
-    college_id: int = Field(foreign_key="colleges.id")
+    college_id: int = Field(foreign_key="colleges.id", index=True)
 
 
 class Batch(SQLModel, table=True):
     __tablename__: str = "batches"  #  type: ignore
+    # Batches are listed by college or by college and department
+    __table_args__ = (
+        Index("ix_batches_college_id_department_id", "college_id", "department_id"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     short_name: str
     college_id: int = Field(foreign_key="colleges.id")
-    department_id: int = Field(foreign_key="departments.id")
+    department_id: int = Field(foreign_key="departments.id", index=True)
 
 
 class Course(SQLModel, table=True):
@@ -41,6 +51,9 @@ class Course(SQLModel, table=True):
 
 class Faculty(SQLModel, table=True):
     __tablename__: str = "faculties"  #  type: ignore
+    __table_args__ = (
+        Index("ix_faculties_college_id_department_id", "college_id", "department_id"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(unique=True, index=True)
@@ -53,12 +66,22 @@ class Faculty(SQLModel, table=True):
     # Probably space efficient to use CHAR but its okay
     gender: Optional[str] = Field(default="M")
     college_id: int = Field(foreign_key="colleges.id")
-    department_id: int = Field(foreign_key="departments.id")
+    department_id: int = Field(foreign_key="departments.id", index=True)
     is_admin: bool = Field(default=False)
 
 
 class Student(SQLModel, table=True):
     __tablename__: str = "students"  #  type: ignore
+    # Students are listed by college, department and batch, or by batch alone
+    __table_args__ = (
+        Index(
+            "ix_students_college_id_department_id_batch_id",
+            "college_id",
+            "department_id",
+            "batch_id",
+        ),
+        Index("ix_students_batch_id", "batch_id"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(unique=True, index=True)
@@ -75,7 +98,7 @@ class Student(SQLModel, table=True):
     # but storing it here so that we can do processing easily
     # with some minor space wastage
     college_id: int = Field(foreign_key="colleges.id")
-    department_id: int = Field(foreign_key="departments.id")
+    department_id: int = Field(foreign_key="departments.id", index=True)
     batch_id: int = Field(foreign_key="batches.id")
 
 
@@ -86,5 +109,52 @@ class BatchCourseAssignments(SQLModel, table=True):
     __table_args__ = (UniqueConstraint("batch_id", "course_id", name="uq_batch_id_course_id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     batch_id: int = Field(foreign_key="batches.id")
-    course_id: int = Field(foreign_key="courses.id")
-    faculty_id: int = Field(foreign_key="faculties.id")
+    course_id: int = Field(foreign_key="courses.id", index=True)
+    faculty_id: int = Field(foreign_key="faculties.id", index=True)
+
+
+class VerifiedIDCardResult(SQLModel, table=True):
+    __tablename__: str = "verified_id_card_results"  #  type: ignore
+    # sha256 over the ID card type and the fields sent to Digio
+    # so that the raw ID numbers are not used as keys
+    cache_key: str = Field(primary_key=True)
+    id_type: str
+    response_json: str
+    verified_at: datetime
+    expires_at: datetime = Field(index=True)
+
+
+class IdempotencyRecord(SQLModel, table=True):
+    __tablename__: str = "idempotency_records"  #  type: ignore
+    # <scope>:<key sent by the client>
+    idempotency_key: str = Field(primary_key=True)
+    scope: str
+    # sha256 of the request, to catch a key being reused for another request
+    request_hash: str
+    response_json: str
+    created_at: datetime
+    expires_at: datetime = Field(index=True)
+
+
+class UpstreamQuotaUsage(SQLModel, table=True):
+    __tablename__: str = "upstream_quota_usage"  #  type: ignore
+    # Calls made to a Digio endpoint on a UTC day, summed over all workers
+    endpoint: str = Field(primary_key=True)
+    day: str = Field(primary_key=True)
+    used: int = Field(default=0)
+
+
+class IDCardAnalysis(SQLModel, table=True):
+    __tablename__: str = "idcard_analyses"  #  type: ignore
+    id: Optional[int] = Field(default=None, primary_key=True)
+    id_type: Optional[str]
+    id_no: Optional[str]
+    name: Optional[str]
+    dob: Optional[str]
+    analysed_at: datetime
+    # The images live in the blob store, rows only carry their sha256 digests
+    # so that reading a row does not pay for the images
+    front_bytes_digest: Optional[str]
+    aligned_front_image_digest: Optional[str]
+    encoded_image_digest: Optional[str]
+    encoded_signature_digest: Optional[str]
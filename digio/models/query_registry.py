@@ -0,0 +1,87 @@
+# GiG
+# The shapes of the queries the app runs, so that their plans can be
+# checked with python -m digio.utils.index_advisor.
+# Add the query here when adding a new way of reading a table.
+
+from typing import Dict
+
+from sqlalchemy import delete, select
+from sqlalchemy.sql import Executable
+from sqlmodel import SQLModel
+
+from digio.models import db_schemas
+from digio.models.db_base_ops import build_list_statements
+from digio.utils.utils import utc_now
+
+# Filters the list routers are expected to be called with
+LIST_FILTERS = {
+    db_schemas.College: [{}],
+    db_schemas.Department: [{}, {"college_id": 1}],
+    db_schemas.Batch: [
+        {},
+        {"college_id": 1},
+        {"college_id": 1, "department_id": 1},
+        {"department_id": 1},
+    ],
+    db_schemas.Course: [{}],
+    db_schemas.Faculty: [
+        {},
+        {"college_id": 1},
+        {"college_id": 1, "department_id": 1},
+        {"department_id": 1},
+    ],
+    db_schemas.Student: [
+        {},
+        {"college_id": 1},
+        {"college_id": 1, "department_id": 1},
+        {"college_id": 1, "department_id": 1, "batch_id": 1},
+        {"department_id": 1},
+        {"batch_id": 1},
+    ],
+    db_schemas.BatchCourseAssignments: [
+        {},
+        {"batch_id": 1},
+        {"course_id": 1},
+        {"faculty_id": 1},
+    ],
+}
+
+
+def get_registered_queries() -> Dict[str, Executable]:
+    queries: Dict[str, Executable] = {}
+
+    for entity_type, filter_sets in LIST_FILTERS.items():
+        name = entity_type.__tablename__
+        for filters in filter_sets:
+            statement, count_statement = build_list_statements(
+                entity_type, filters, after=0
+            )
+            filter_names = ",".join(filters) or "all"
+            queries[f"list {name} by {filter_names}"] = statement
+            # Counting everything is a scan however it is indexed,
+            # which is why the counts are cached
+            if filters:
+                queries[f"count {name} by {filter_names}"] = count_statement
+
+    for entity_type in (db_schemas.Faculty, db_schemas.Student):
+        queries[f"login {entity_type.__tablename__}"] = select(entity_type).where(
+            entity_type.username == "username"
+        )
+
+    now = utc_now()
+    queries["purge verified_id_card_results"] = delete(
+        db_schemas.VerifiedIDCardResult
+    ).where(db_schemas.VerifiedIDCardResult.expires_at <= now)  # type: ignore
+    queries["compact idempotency_records"] = delete(db_schemas.IdempotencyRecord).where(
+        db_schemas.IdempotencyRecord.expires_at <= now  # type: ignore
+    )
+
+    # With foreign_keys=ON, deleting or updating a parent row makes
+    # SQLite look up the child rows by the foreign key column
+    for table in SQLModel.metadata.sorted_tables:
+        for foreign_key in table.foreign_keys:
+            column = foreign_key.parent
+            queries[f"foreign key {table.name}.{column.name}"] = select(
+                table.c.id
+            ).where(column == 1)
+    return queries
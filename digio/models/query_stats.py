@@ -0,0 +1,118 @@
+# GiG
+# Timings of every SQL statement run through our engines, which are timed by
+# the listeners of db_engine. Statements are grouped after replacing their
+# literals and parameter lists, each group keeps a latency histogram, and
+# only statements slower than the threshold are logged.
+
+import re
+import threading
+from typing import Dict, List, Literal, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+from digio.models.config_models import DatabaseConfigs
+
+# Upper bounds of the histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf")]
+# Statements beyond this many distinct ones are counted together
+MAX_STATEMENTS = 1000
+OTHER_STATEMENTS = "<other>"
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_LIST = re.compile(r"(VALUES\s*\(\?\))(?:\s*,\s*\(\?\))+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _PARAMETER_LIST.sub("(?)", statement)
+    statement = _VALUES_LIST.sub(r"\1", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class _StatementTimings:
+    __slots__ = ("count", "total_ms", "max_ms", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram: Dict[str, int] = {}
+
+
+class StatementSummary(BaseModel):
+    statement: str
+    count: int
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    histogram: Dict[str, int]
+
+
+class QueryStats:
+    def __init__(self, slow_query_threshold_ms: float):
+        self.slow_query_threshold_ms = slow_query_threshold_ms
+        # Statements are run from the threadpool as well as the event loop
+        self._lock = threading.Lock()
+        self._statements: Dict[str, _StatementTimings] = {}
+        self.slow_queries = 0
+
+    def record(self, statement: str, elapsed_ms: float):
+        normalized = normalize_statement(statement)
+        bucket = next(str(bound) for bound in LATENCY_BUCKETS_MS if elapsed_ms <= bound)
+        is_slow = elapsed_ms >= self.slow_query_threshold_ms
+        with self._lock:
+            timings = self._statements.get(normalized)
+            if timings is None:
+                if len(self._statements) >= MAX_STATEMENTS:
+                    normalized = OTHER_STATEMENTS
+                timings = self._statements.setdefault(normalized, _StatementTimings())
+            timings.count += 1
+            timings.total_ms += elapsed_ms
+            timings.max_ms = max(timings.max_ms, elapsed_ms)
+            timings.histogram[bucket] = timings.histogram.get(bucket, 0) + 1
+            if is_slow:
+                self.slow_queries += 1
+        if is_slow:
+            logger.warning(f"Slow query took {elapsed_ms:.1f}ms: {normalized}")
+
+    def get_top(
+        self, limit: int, order_by: Literal["total", "mean", "max"] = "total"
+    ) -> List[StatementSummary]:
+        with self._lock:
+            summaries = [
+                StatementSummary(
+                    statement=statement,
+                    count=timings.count,
+                    total_ms=round(timings.total_ms, 3),
+                    mean_ms=round(timings.total_ms / timings.count, 3),
+                    max_ms=round(timings.max_ms, 3),
+                    histogram=dict(timings.histogram),
+                )
+                for statement, timings in self._statements.items()
+            ]
+        summaries.sort(key=lambda summary: getattr(summary, f"{order_by}_ms"))
+        return summaries[::-1][:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self.slow_queries = 0
+
+
+query_stats: Optional[QueryStats] = None
+
+
+def start_query_stats(db_configs: DatabaseConfigs) -> Optional[QueryStats]:
+    global query_stats
+    query_stats = None
+    if db_configs.track_query_stats:
+        query_stats = QueryStats(db_configs.slow_query_threshold_ms)
+    return query_stats
+
+
+def get_query_stats() -> Optional[QueryStats]:
+    return query_stats
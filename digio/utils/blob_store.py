@@ -0,0 +1,97 @@
+# GiG
+
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_valid_digest(digest: str) -> bool:
+    return _DIGEST_PATTERN.match(digest) is not None
+
+
+class BlobWriter:
+    # Writes to a temp file while hashing, the blob only becomes visible
+    # under its digest once it is committed. If a blob with the same
+    # content already exists, the new copy is dropped.
+
+    def __init__(self, blob_store: "BlobStore"):
+        self.blob_store = blob_store
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        fd, temp_path = tempfile.mkstemp(dir=blob_store.temp_dir)
+        self.temp_path = Path(temp_path)
+        self.file_obj = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes):
+        self.hasher.update(data)
+        self.file_obj.write(data)
+        self.size += len(data)
+
+    def commit(self) -> str:
+        self.file_obj.close()
+        digest = self.hasher.hexdigest()
+        blob_path = self.blob_store.path_for(digest)
+        if blob_path.exists():
+            self.temp_path.unlink()
+            self.blob_store.deduplicated += 1
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self.temp_path, blob_path)
+            self.blob_store.written += 1
+        return digest
+
+    def abort(self):
+        self.file_obj.close()
+        self.temp_path.unlink(missing_ok=True)
+
+
+class BlobStore:
+    # Content addressed store, every blob is saved under the sha256 of its
+    # bytes and sharded as <root>/ab/cd/abcd... to keep directories small
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.temp_dir = root / "tmp"
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.written = 0
+        self.deduplicated = 0
+
+    def path_for(self, digest: str) -> Path:
+        if not is_valid_digest(digest):
+            raise ValueError(f"Invalid blob digest {digest}")
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.path_for(digest).exists()
+
+    def open_writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def put_bytes(self, data: bytes) -> str:
+        writer = self.open_writer()
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+
+blob_store: Optional[BlobStore] = None
+
+
+def start_blob_store(root: Path) -> BlobStore:
+    global blob_store
+    blob_store = BlobStore(root)
+    return blob_store
+
+
+def get_blob_store() -> BlobStore:
+    if blob_store is None:
+        raise RuntimeError("Blob store has not been started")
+    return blob_store
@@ -0,0 +1,93 @@
+# Runs EXPLAIN QUERY PLAN for every query in query_registry against a copy
+# of the database and reports the ones that scan a whole table.
+# Exits with 1 when any query scans, so it can run as a check in CI.
+#
+# python -m digio.utils.index_advisor [--db implementation/demo/digio.sqlite]
+
+import argparse
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Executable
+from sqlmodel import SQLModel
+
+from digio.models.config_models import GlobalConfigs
+from digio.models.db_engine import ensure_indexes
+from digio.models.query_registry import get_registered_queries
+
+
+def explain(engine: Engine, statement: Executable) -> List[str]:
+    compiled = statement.compile(dialect=engine.dialect)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup or [])
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {compiled}", parameters
+        ).all()
+    # Each row is (id, parent, notused, detail)
+    return [row[3] for row in rows]
+
+
+def is_scan(detail: str) -> bool:
+    return detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT")
+
+
+# Sorting the matches is not a scan but still reads every matching row
+def is_sort(detail: str) -> bool:
+    return detail.startswith("USE TEMP B-TREE")
+
+
+def check_queries(engine: Engine) -> Dict[str, List[str]]:
+    SQLModel.metadata.create_all(engine)
+    ensure_indexes(engine)
+    return {
+        name: explain(engine, statement)
+        for name, statement in get_registered_queries().items()
+    }
+
+
+def check_db_file(db_path: Path) -> Dict[str, List[str]]:
+    # The schema and indexes are brought up to date on a copy,
+    # so the database itself is never changed
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_copy = Path(temp_dir) / "index_advisor.sqlite"
+        if db_path.exists():
+            shutil.copy(db_path, db_copy)
+        engine = create_engine(f"sqlite:///{db_copy}")
+        plans = check_queries(engine)
+        engine.dispose()
+    return plans
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Report the registered queries that scan a whole table"
+    )
+    parser.add_argument(
+        "--db", type=Path, help="SQLite file, from the configs by default"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Print every plan")
+    args = parser.parse_args()
+    db_path = args.db or GlobalConfigs.load_default().db_configs.db_file_path
+
+    plans = check_db_file(db_path)
+    scanning = 0
+    for name, details in plans.items():
+        scans = [detail for detail in details if is_scan(detail)]
+        if scans:
+            scanning += 1
+            print(f"SCAN  {name}: {'; '.join(scans)}")
+        elif any(is_sort(detail) for detail in details):
+            print(f"SORT  {name}: {'; '.join(details)}")
+        elif args.verbose:
+            print(f"ok    {name}: {'; '.join(details)}")
+    print(f"{len(plans)} queries checked, {scanning} scan a whole table")
+    return 1 if scanning else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
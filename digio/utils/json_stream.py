@@ -0,0 +1,315 @@
+# GiG
+# Incremental JSON parsing, for upstream responses that carry large
+# base64 images which should go to disk without being held in memory.
+# Any malformed input raises JSONStreamError.
+
+import base64
+import binascii
+import codecs
+import json
+import re
+from typing import Any, BinaryIO, Callable, Optional, Protocol
+
+# Characters that end a run of plain characters inside a JSON string
+_STRING_SPECIAL = re.compile(r'["\\]')
+_LITERAL_END = re.compile(r"[\s,\]\}]")
+_WHITESPACE = " \t\r\n"
+_SIMPLE_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class StringSink(Protocol):
+    def write(self, text: str): ...
+
+    def finish(self) -> Any: ...
+
+
+class Base64FileSink:
+    # Decodes a base64 string as it arrives and writes the bytes to a file,
+    # so that the encoded string is never held in memory as a whole
+    def __init__(self, file_obj: BinaryIO, on_finish: Callable[[int], Any]):
+        self.file_obj = file_obj
+        self.on_finish = on_finish
+        self.size = 0
+        self._pending = ""
+        # Padding ends the data, nothing may follow it
+        self._padded = False
+
+    def write(self, text: str):
+        if "\n" in text or "\r" in text:
+            # Line breaks of MIME style base64
+            text = text.replace("\n", "").replace("\r", "")
+        text = self._pending + text
+        usable = len(text) - len(text) % 4
+        self._pending = text[usable:]
+        if not usable:
+            return
+        encoded = text[:usable]
+        # b64decode would take padding in the middle or more than two "="
+        if self._padded or "=" in encoded[:-2]:
+            raise JSONStreamError("Base64 string has data after the padding")
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except binascii.Error as e:
+            raise JSONStreamError(f"Invalid base64 string: {e}") from e
+        self._padded = encoded[-1] == "="
+        self.file_obj.write(data)
+        self.size += len(data)
+
+    def finish(self) -> Any:
+        if self._pending:
+            raise JSONStreamError("Base64 string has trailing characters")
+        return self.on_finish(self.size)
+
+
+def _parse_hex(digits: str) -> int:
+    # int() would also take signs, underscores and spaces
+    if len(digits) != 4 or not all(char in "0123456789abcdefABCDEF" for char in digits):
+        raise JSONStreamError(f"Invalid unicode escape \\u{digits}")
+    return int(digits, 16)
+
+
+class _Container:
+    def __init__(self, value: Any):
+        self.value = value
+        self.key: Optional[str] = None
+        # "key" -> waiting for a key, "colon", "value", "comma"
+        self.expect = "value" if isinstance(value, list) else "key"
+        self.empty = True
+
+
+class StreamingJSONParser:
+    # Incremental JSON parser that can be fed one chunk at a time.
+    # String values of the keys in sink_keys (at any depth) are passed
+    # to the sink returned by sink_factory as they are parsed, and
+    # whatever the sink returns on finish takes the place of the string.
+
+    def __init__(
+        self,
+        sink_keys: frozenset[str] = frozenset(),
+        sink_factory: Optional[Callable[[str], StringSink]] = None,
+    ):
+        self.sink_keys = sink_keys
+        self.sink_factory = sink_factory
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._stack: list[_Container] = []
+        self._result: Any = None
+        self._done = False
+        # Text that could not be processed yet as it needs more data
+        self._tail = ""
+        self._in_string = False
+        self._string_parts: list[str] = []
+        self._string_is_key = False
+        self._sink: Optional[StringSink] = None
+        self._literal: Optional[str] = None
+
+    def feed(self, data: bytes):
+        text = self._tail + self._decoder.decode(data)
+        self._tail = ""
+        self._process(text)
+
+    def close(self) -> Any:
+        text = self._tail + self._decoder.decode(b"", final=True)
+        self._tail = ""
+        self._process(text)
+        if self._literal is not None:
+            self._add_value(self._parse_literal(self._literal))
+            self._literal = None
+        if not self._done or self._in_string or self._tail:
+            raise JSONStreamError("Incomplete JSON document")
+        return self._result
+
+    def _process(self, text: str):
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if self._in_string:
+                pos = self._process_string(text, pos)
+                if pos < 0:
+                    return
+                continue
+
+            if self._literal is not None:
+                match = _LITERAL_END.search(text, pos)
+                if match is None:
+                    self._literal += text[pos:]
+                    return
+                self._literal += text[pos : match.start()]
+                self._add_value(self._parse_literal(self._literal))
+                self._literal = None
+                pos = match.start()
+                continue
+
+            char = text[pos]
+            pos += 1
+            if char in _WHITESPACE:
+                continue
+            if self._done:
+                raise JSONStreamError("Extra data after the JSON document")
+
+            container = self._stack[-1] if self._stack else None
+            expect = container.expect if container else "value"
+            if char == "}" and expect in ("key", "comma") and container:
+                if isinstance(container.value, dict) and (
+                    expect == "comma" or container.empty
+                ):
+                    self._close_container()
+                    continue
+                raise JSONStreamError("Unexpected '}'")
+            if char == "]" and expect in ("value", "comma") and container:
+                if isinstance(container.value, list) and (
+                    expect == "comma" or container.empty
+                ):
+                    self._close_container()
+                    continue
+                raise JSONStreamError("Unexpected ']'")
+            if expect == "comma":
+                if char != ",":
+                    raise JSONStreamError(f"Expected ',' but got {char!r}")
+                container.expect = (  # type: ignore
+                    "key" if isinstance(container.value, dict) else "value"
+                )
+                continue
+            if expect == "colon":
+                if char != ":":
+                    raise JSONStreamError(f"Expected ':' but got {char!r}")
+                container.expect = "value"  # type: ignore
+                continue
+            if expect == "key":
+                if char != '"':
+                    raise JSONStreamError(f"Expected a key but got {char!r}")
+                self._start_string(is_key=True)
+                continue
+
+            # expect == "value"
+            if char == "{":
+                self._stack.append(_Container({}))
+            elif char == "[":
+                self._stack.append(_Container([]))
+            elif char == '"':
+                self._start_string(is_key=False)
+            else:
+                self._literal = char
+
+    def _start_string(self, is_key: bool):
+        self._in_string = True
+        self._string_is_key = is_key
+        self._string_parts = []
+        self._sink = None
+        container = self._stack[-1] if self._stack else None
+        if (
+            not is_key
+            and self.sink_factory is not None
+            and container is not None
+            and container.key in self.sink_keys
+        ):
+            self._sink = self.sink_factory(container.key)  # type: ignore
+
+    def _write_string(self, text: str):
+        if not text:
+            return
+        if self._sink is not None:
+            self._sink.write(text)
+        else:
+            self._string_parts.append(text)
+
+    # Returns the position after the processed text or -1 if
+    # the rest of the text has to wait for the next chunk
+    def _process_string(self, text: str, pos: int) -> int:
+        while True:
+            match = _STRING_SPECIAL.search(text, pos)
+            if match is None:
+                self._write_string(text[pos:])
+                return len(text)
+            self._write_string(text[pos : match.start()])
+            pos = match.start()
+            if text[pos] == '"':
+                self._end_string()
+                return pos + 1
+
+            # Backslash escapes, which may be split across chunks
+            if pos + 1 >= len(text):
+                self._tail = text[pos:]
+                return -1
+            escape = text[pos + 1]
+            if escape in _SIMPLE_ESCAPES:
+                self._write_string(_SIMPLE_ESCAPES[escape])
+                pos += 2
+            elif escape == "u":
+                if pos + 6 > len(text):
+                    self._tail = text[pos:]
+                    return -1
+                code_point = _parse_hex(text[pos + 2 : pos + 6])
+                # Surrogate pairs come as two escapes, a high surrogate
+                # without a low one is kept as it is, as json.loads does
+                if 0xD800 <= code_point < 0xDC00:
+                    following = text[pos + 6 : pos + 8]
+                    # Wait for what may still turn out to be a low surrogate
+                    if following == "\\u":
+                        wait = pos + 12 > len(text)
+                    else:
+                        wait = "\\u".startswith(following)
+                    if wait:
+                        self._tail = text[pos:]
+                        return -1
+                    if following == "\\u":
+                        low = _parse_hex(text[pos + 8 : pos + 12])
+                        if 0xDC00 <= low < 0xE000:
+                            code_point = (
+                                0x10000 + ((code_point - 0xD800) << 10) + (low - 0xDC00)
+                            )
+                            pos += 6
+                self._write_string(chr(code_point))
+                pos += 6
+            else:
+                raise JSONStreamError(f"Invalid escape {escape!r}")
+
+    def _end_string(self):
+        self._in_string = False
+        if self._sink is not None:
+            value = self._sink.finish()
+            self._sink = None
+        else:
+            value = "".join(self._string_parts)
+            self._string_parts = []
+        if self._string_is_key:
+            container = self._stack[-1]
+            container.key = value
+            container.expect = "colon"
+        else:
+            self._add_value(value)
+
+    def _parse_literal(self, literal: str) -> Any:
+        try:
+            return json.loads(literal)
+        except ValueError as e:
+            raise JSONStreamError(f"Invalid literal {literal!r}") from e
+
+    def _add_value(self, value: Any):
+        if not self._stack:
+            self._result = value
+            self._done = True
+            return
+        container = self._stack[-1]
+        if isinstance(container.value, dict):
+            container.value[container.key] = value
+        else:
+            container.value.append(value)
+        container.empty = False
+        container.expect = "comma"
+
+    def _close_container(self):
+        container = self._stack.pop()
+        self._add_value(container.value)
@@ -0,0 +1,226 @@
+# GiG
+# Counters, gauges and histograms, rendered in the Prometheus text format.
+# A metric keeps a child per set of label values. Children are created once,
+# up front with prepare() for the label values known at startup, and are then
+# looked up by tuple, so that recording a value is a dict lookup and an add
+# under an uncontended lock. The lock is needed as the DB timers record from
+# the threadpool while the HTTP metrics record from the event loop.
+
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Generic, List, Sequence, Tuple, TypeVar
+
+ChildType = TypeVar("ChildType")
+MetricType = TypeVar("MetricType", bound="Metric")
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    # For totals that are counted elsewhere (eg. cache stats), copied at scrape time
+    def set_total(self, value: float):
+        self.value = value
+
+
+class GaugeChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        # Counts per bucket, the last one for values above every bound.
+        # They are only made cumulative when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Metric(Generic[ChildType]):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], ChildType] = {}
+        self._lock = threading.Lock()
+
+    def _create_child(self) -> ChildType:
+        raise NotImplementedError
+
+    def labels(self, *label_values: str) -> ChildType:
+        child = self._children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(
+                    f"{self.name} has labels {self.label_names}, got {label_values}"
+                )
+            with self._lock:
+                child = self._children.setdefault(label_values, self._create_child())
+        return child
+
+    def prepare(self, label_value_sets: Sequence[Sequence[str]]):
+        for label_values in label_value_sets:
+            self.labels(*label_values)
+
+    def _format_labels(self, label_values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [
+            f'{name}="{escape_label_value(value)}"'
+            for name, value in zip(self.label_names, label_values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _render_samples(self, lines: List[str]):
+        for label_values, child in list(self._children.items()):
+            lines.append(
+                f"{self.name}{self._format_labels(label_values)} {format_value(child.value)}"  # type: ignore
+            )
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        self._render_samples(lines)
+
+
+class Counter(Metric[CounterChild]):
+    kind = "counter"
+
+    def _create_child(self) -> CounterChild:
+        return CounterChild()
+
+
+class Gauge(Metric[GaugeChild]):
+    kind = "gauge"
+
+    def _create_child(self) -> GaugeChild:
+        return GaugeChild()
+
+
+class Histogram(Metric[HistogramChild]):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.bounds = sorted(bound for bound in buckets if bound != math.inf)
+
+    def _create_child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def _render_samples(self, lines: List[str]):
+        for label_values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.bounds + [math.inf], counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{self._format_labels(label_values, le)} {cumulative}"
+                )
+            labels = self._format_labels(label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        # Run before rendering, to copy values that are kept elsewhere
+        self._collectors: Dict[str, Callable[[], None]] = {}
+
+    # A metric registered again under the same name replaces the earlier one
+    def register(self, metric: MetricType) -> MetricType:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    # Like metrics, a collector added again under the same name replaces the earlier one
+    def add_collector(self, name: str, collector: Callable[[], None]):
+        self._collectors[name] = collector
+
+    def render(self) -> str:
+        for collector in list(self._collectors.values()):
+            collector()
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            metric.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+registry = MetricsRegistry()
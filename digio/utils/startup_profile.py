@@ -0,0 +1,116 @@
+# Reports what importing the web server costs, from python -X importtime in
+# a fresh interpreter, as that is what every new worker pays before it can
+# take traffic. Exits with 1 when the import takes longer than the budget or
+# pulls in a module that is meant to be imported on first use, so it can
+# run as a check in CI.
+#
+# python -m digio.utils.startup_profile [--budget-ms 1500] [--top 25]
+# python -m digio.utils.startup_profile --write-openapi implementation/demo/openapi.json
+
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+import orjson
+
+APP_MODULE = "digio.web_services.web_server"
+DEFAULT_BUDGET_MS = 1500
+
+# Imported when they are first needed, passlib in the password hasher's
+# workers and the rest by the tools and tests that use them
+LAZY_MODULES = ["passlib", "uvicorn", "digio.web_services.fake_digio"]
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def profile_imports(module: str) -> List[ImportTime]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append(ImportTime(name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def get_package_times(times: List[ImportTime]) -> Dict[str, int]:
+    packages: Dict[str, int] = {}
+    for import_time in times:
+        package = import_time.module.split(".")[0]
+        packages[package] = packages.get(package, 0) + import_time.self_us
+    return dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+
+
+def write_openapi(openapi_path: Path) -> float:
+    from digio.web_services.web_server import app
+
+    start_time = time.perf_counter()
+    schema = app.openapi()
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    openapi_path.write_bytes(orjson.dumps(schema, option=orjson.OPT_INDENT_2))
+    return elapsed_ms
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Profile the web server's imports")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=25, help="Modules to list")
+    parser.add_argument(
+        "--write-openapi", type=Path, help="Write the OpenAPI schema to this file"
+    )
+    args = parser.parse_args()
+
+    if args.write_openapi:
+        elapsed_ms = write_openapi(args.write_openapi)
+        print(
+            f"Built the OpenAPI schema in {elapsed_ms:.0f}ms, wrote {args.write_openapi}"
+        )
+        return 0
+
+    times = profile_imports(APP_MODULE)
+    total_ms = next(t.cumulative_us for t in times if t.module == APP_MODULE) / 1000
+
+    print(f"{'self ms':>9} {'total ms':>9}  module")
+    slowest = sorted(times, key=lambda t: t.cumulative_us, reverse=True)
+    for import_time in slowest[: args.top]:
+        print(
+            f"{import_time.self_us / 1000:9.1f} {import_time.cumulative_us / 1000:9.1f}"
+            f"  {import_time.module}"
+        )
+    print(f"\n{'self ms':>9}  package")
+    for package, self_us in list(get_package_times(times).items())[: args.top]:
+        print(f"{self_us / 1000:9.1f}  {package}")
+
+    failed = False
+    imported = {t.module for t in times}
+    for module in LAZY_MODULES:
+        if module in imported:
+            failed = True
+            print(
+                f"{module} is imported by {APP_MODULE}, it should be imported on first use"
+            )
+    print(
+        f"\nImporting {APP_MODULE} took {total_ms:.0f}ms, the budget is {args.budget_ms:.0f}ms"
+    )
+    if total_ms > args.budget_ms:
+        failed = True
+        print("Over budget")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
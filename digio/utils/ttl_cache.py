@@ -0,0 +1,89 @@
+# GiG
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, Optional, TypeVar
+
+from pydantic import BaseModel
+
+ValueType = TypeVar("ValueType")
+
+
+class CacheStats(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+
+class TTLCache(Generic[ValueType]):
+    # In-process LRU cache where every entry also has an expiry time.
+    # Entries are evicted in LRU order once max_size is reached and
+    # expired entries are dropped lazily when they are looked up.
+    # It is not thread safe and is meant to be used from the event loop.
+
+    def __init__(
+        self,
+        max_size: int,
+        default_ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.clock = clock
+        # key -> (expires_at, value)
+        self._entries: OrderedDict[Hashable, tuple[float, ValueType]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[ValueType]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: ValueType, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.default_ttl
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[key] = (self.clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[ValueType]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> CacheStats:
+        return CacheStats(
+            size=len(self._entries),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
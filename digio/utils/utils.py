@@ -1,3 +1,4 @@
+from datetime import datetime, timezone
 from pathlib import Path
 
 import tomllib
@@ -8,3 +9,14 @@ def load_toml(file_name: Path) -> dict:
     with open(file_name, "rb") as file_obj:
         data = tomllib.load(file_obj)
     return data
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# SQLite does not store the timezone, everything we write is in UTC
+def as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
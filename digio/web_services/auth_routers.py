@@ -0,0 +1,39 @@
+# GiG
+# Login for faculties and students. The token from /token is sent back as
+# "Authorization: Bearer <token>" and routes get the user with
+# Depends(get_current_user), eg.
+# curl -X POST http://localhost:8000/token -d 'username=u&password=p&user_type=faculty'
+
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, Form, HTTPException, status
+from fastapi.security import OAuth2PasswordRequestForm
+
+from digio.models import auth_models
+from digio.models.auth_models import Principal, Token, get_current_user
+
+router = APIRouter()
+
+
+@router.post("/token")
+async def login_for_access_token(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    user_type: Annotated[Literal["faculty", "student"], Form()] = "student",
+) -> Token:
+    user = await auth_models.authenticate_user(
+        auth_models.USER_TYPES[user_type], form_data.username, form_data.password
+    )
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return auth_models.get_token_service().create_access_token(user)
+
+
+@router.get("/users/me")
+async def read_users_me(
+    current_user: Annotated[Principal, Depends(get_current_user)],
+) -> Principal:
+    return current_user
@@ -0,0 +1,169 @@
+# GiG
+# Serves the blobs (KYC images) saved in the content addressed blob store.
+# Blobs never change once written, so they are served with their digest
+# as the ETag and support byte ranges for partial downloads.
+# They are identity documents, so only logged-in users can fetch them and
+# shared caches (proxies, CDNs) must not keep them. Browsers may, but
+# revalidate every use, which the ETag answers with a 304 and no body.
+
+import mmap
+from pathlib import Path
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from digio.models.auth_models import get_current_user
+from digio.utils import blob_store
+from digio.utils.blob_store import is_valid_digest
+
+router = APIRouter()
+
+BLOB_CACHE_CONTROL = "private, no-cache"
+
+_MAGIC_MEDIA_TYPES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"%PDF", "application/pdf"),
+]
+
+
+def guess_media_type(head: bytes) -> str:
+    for magic, media_type in _MAGIC_MEDIA_TYPES:
+        if head.startswith(magic):
+            return media_type
+    return "application/octet-stream"
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    # Returns the inclusive (start, end) of a single byte range, None to send
+    # the whole file, and raises ValueError for a range that cannot be served.
+    # Multiple ranges are answered with the whole file, which the RFC allows
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    ranges = range_header[len("bytes=") :].strip()
+    if "," in ranges:
+        return None
+    start_text, _, end_text = ranges.partition("-")
+    if not start_text:
+        suffix_length = int(end_text)
+        if suffix_length <= 0:
+            raise ValueError(range_header)
+        return max(size - suffix_length, 0), size - 1
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if start >= size or end < start:
+        raise ValueError(range_header)
+    return start, min(end, size - 1)
+
+
+class MmapFileResponse(Response):
+    # The file is memory mapped and sent in slices, so the bytes come
+    # straight from the page cache without read() calls into a buffer
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        path: Path,
+        etag: str,
+        range_header: Optional[str] = None,
+        background: Optional[BackgroundTask] = None,
+    ):
+        super().__init__(background=background)
+        self.path = path
+        self.etag = etag
+        self.range_header = range_header
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        file_obj = await run_in_threadpool(open, self.path, "rb")
+        with file_obj:
+            size = file_obj.seek(0, 2)
+            if size == 0:
+                await self._send_empty(send)
+                return
+            with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                await self._send_mapped(mapped, size, send)
+        if self.background is not None:
+            await self.background()
+
+    def _headers(self, media_type: str, length: int) -> list[tuple[bytes, bytes]]:
+        return [
+            (b"content-type", media_type.encode()),
+            (b"content-length", str(length).encode()),
+            (b"accept-ranges", b"bytes"),
+            (b"etag", f'"{self.etag}"'.encode()),
+            (b"cache-control", BLOB_CACHE_CONTROL.encode()),
+        ]
+
+    async def _send_empty(self, send: Send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status.HTTP_200_OK,
+                "headers": self._headers("application/octet-stream", 0),
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _send_mapped(self, mapped: mmap.mmap, size: int, send: Send):
+        media_type = guess_media_type(mapped[:16])
+        try:
+            byte_range = parse_range(self.range_header, size)
+        except ValueError:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    "headers": [(b"content-range", f"bytes */{size}".encode())],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        status_code = status.HTTP_200_OK
+        start, end = 0, size - 1
+        headers = self._headers(media_type, size)
+        if byte_range is not None:
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            start, end = byte_range
+            headers = self._headers(media_type, end - start + 1)
+            headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+
+        await send(
+            {"type": "http.response.start", "status": status_code, "headers": headers}
+        )
+        offset = start
+        while offset <= end:
+            chunk_end = min(offset + self.chunk_size, end + 1)
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": mapped[offset:chunk_end],
+                    "more_body": chunk_end <= end,
+                }
+            )
+            offset = chunk_end
+
+
+@router.get("/blobs/{digest}", dependencies=[Depends(get_current_user)])
+async def get_blob(digest: str, request: Request) -> Response:
+    if not is_valid_digest(digest):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Cannot find blob {digest}"
+        )
+    blob_path = blob_store.get_blob_store().path_for(digest)
+    if not await run_in_threadpool(blob_path.exists):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Cannot find blob {digest}"
+        )
+    if request.headers.get("if-none-match", "").strip('"') == digest:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"etag": f'"{digest}"', "cache-control": BLOB_CACHE_CONTROL},
+        )
+    return MmapFileResponse(
+        blob_path, etag=digest, range_header=request.headers.get("range")
+    )
@@ -0,0 +1,291 @@
+# GiG
+# Response compression, replacing starlette's GZipMiddleware.
+# The encoding is negotiated from Accept-Encoding (zstd, br, gzip), already
+# compressed content (images, PDFs, responses with a Content-Encoding) is
+# passed through, streamed responses are flushed chunk by chunk so that
+# NDJSON results still reach the client as they are produced, and the
+# compressed copies of recent bodies are kept so that a body that is sent
+# again is not compressed again.
+
+import gzip
+import hashlib
+import zlib
+from typing import List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from digio.models.config_models import CompressionConfigs
+from digio.utils.ttl_cache import CacheStats, TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressionStats(BaseModel):
+    cache: CacheStats
+    compressed: int
+    streamed: int
+    skipped: int
+    bytes_in: int
+    bytes_out: int
+
+
+class _GzipEncoder:
+    def __init__(self, level: int):
+        # wbits 31 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)  # type: ignore
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdEncoder:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()  # type: ignore
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK  # type: ignore
+        )
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+class Compression:
+    def __init__(self, configs: CompressionConfigs):
+        self.configs = configs
+        self.algorithms: List[str] = []
+        for algorithm in configs.algorithms:
+            if algorithm == "br" and brotli is None:
+                logger.warning("brotli is not installed, br compression is disabled")
+            elif algorithm == "zstd" and zstandard is None:
+                logger.warning(
+                    "zstandard is not installed, zstd compression is disabled"
+                )
+            elif algorithm not in ("gzip", "br", "zstd"):
+                raise ValueError(f"Unknown compression algorithm {algorithm}")
+            else:
+                self.algorithms.append(algorithm)
+        self.excluded_content_types = tuple(configs.excluded_content_types)
+        # (encoding, digest of the body) -> compressed body
+        self.compressed_bodies: TTLCache[bytes] = TTLCache(
+            max_size=configs.cache_max_entries, default_ttl=configs.cache_ttl
+        )
+        self.compressed = 0
+        self.streamed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def select_encoding(self, accept_encoding: str) -> Optional[str]:
+        accepted = parse_accept_encoding(accept_encoding)
+        default_quality = accepted.get("*", 0.0)
+        best, best_quality = None, 0.0
+        for algorithm in self.algorithms:
+            quality = accepted.get(algorithm, default_quality)
+            if quality > best_quality:
+                best, best_quality = algorithm, quality
+        return best
+
+    def is_compressible(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "").lower()
+        return not content_type.startswith(self.excluded_content_types)
+
+    def create_encoder(self, encoding: str):
+        if encoding == "zstd":
+            return _ZstdEncoder(self.configs.zstd_level)
+        if encoding == "br":
+            return _BrotliEncoder(self.configs.brotli_level)
+        return _GzipEncoder(self.configs.gzip_level)
+
+    def compress_body(self, encoding: str, body: bytes) -> bytes:
+        cacheable = len(body) <= self.configs.cache_max_body_size
+        if cacheable:
+            cache_key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+            compressed_body = self.compressed_bodies.get(cache_key)
+            if compressed_body is not None:
+                return compressed_body
+        if encoding == "zstd":
+            compressed_body = zstandard.ZstdCompressor(  # type: ignore
+                level=self.configs.zstd_level
+            ).compress(body)
+        elif encoding == "br":
+            compressed_body = brotli.compress(body, quality=self.configs.brotli_level)  # type: ignore
+        else:
+            compressed_body = gzip.compress(
+                body, compresslevel=self.configs.gzip_level, mtime=0
+            )
+        if cacheable:
+            self.compressed_bodies.set(cache_key, compressed_body)
+        return compressed_body
+
+    def get_stats(self) -> CompressionStats:
+        return CompressionStats(
+            cache=self.compressed_bodies.get_stats(),
+            compressed=self.compressed,
+            streamed=self.streamed,
+            skipped=self.skipped,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+        )
+
+
+class _CompressionResponder:
+    def __init__(self, compression: Compression, encoding: str, send: Send):
+        self.compression = compression
+        self.encoding = encoding
+        self.send = send
+        self.start_message: Optional[Message] = None
+        # None until the first body message decides what to do
+        self.compressing: Optional[bool] = None
+        self.encoder = None
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+        if self.compressing is None:
+            await self._start(message)
+        elif self.compressing:
+            await self._send_chunk(message)
+        else:
+            await self.send(message)
+
+    async def _start(self, message: Message):
+        compression = self.compression
+        start_message = self.start_message
+        headers = MutableHeaders(raw=start_message["headers"])  # type: ignore
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        self.compressing = (
+            start_message["status"] == 200  # type: ignore
+            and compression.is_compressible(headers)
+            and (more_body or len(body) >= compression.configs.minimum_size)
+        )
+        if not self.compressing:
+            compression.skipped += 1
+            await self.send(start_message)  # type: ignore
+            await self.send(message)
+            return
+
+        headers["content-encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if more_body:
+            # The size is not known up front, the body goes out chunked
+            compression.streamed += 1
+            del headers["content-length"]
+            self.encoder = compression.create_encoder(self.encoding)
+            await self.send(start_message)  # type: ignore
+            await self._send_chunk(message)
+            return
+
+        compression.compressed += 1
+        compressed_body = compression.compress_body(self.encoding, body)
+        compression.bytes_in += len(body)
+        compression.bytes_out += len(compressed_body)
+        headers["content-length"] = str(len(compressed_body))
+        await self.send(start_message)  # type: ignore
+        await self.send({"type": "http.response.body", "body": compressed_body})
+
+    async def _send_chunk(self, message: Message):
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        compressed_body = self.encoder.compress(body) if body else b""  # type: ignore
+        if not more_body:
+            compressed_body += self.encoder.finish()  # type: ignore
+        self.compression.bytes_in += len(body)
+        self.compression.bytes_out += len(compressed_body)
+        await self.send(
+            {
+                "type": "http.response.body",
+                "body": compressed_body,
+                "more_body": more_body,
+            }
+        )
+
+
+class CompressionMiddleware:
+    # Compression is set up in the lifespan from the configs,
+    # until then (and when it is disabled) responses pass through
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        compression = get_compression()
+        if scope["type"] != "http" or compression is None:
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = compression.select_encoding(
+            request_headers.get("accept-encoding", "")
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(compression, encoding, send)
+        await self.app(scope, receive, responder)
+
+
+compression: Optional[Compression] = None
+
+
+def start_compression(configs: CompressionConfigs) -> Optional[Compression]:
+    global compression
+    compression = None
+    if configs.enabled:
+        compression = Compression(configs)
+    return compression
+
+
+def get_compression() -> Optional[Compression]:
+    return compression
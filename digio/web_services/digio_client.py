@@ -0,0 +1,213 @@
+# GiG
+# Shared client for every call we make to the Digio APIs.
+# One httpx.AsyncClient is kept open for the lifetime of the app so that
+# the TCP+TLS connections to Digio are pooled and reused across requests
+# instead of paying for a new handshake on every call.
+
+from contextlib import contextmanager
+from typing import Any, Awaitable, BinaryIO, Callable, Optional
+
+import httpx
+from fastapi import HTTPException, status
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from digio.models.config_models import DigioClientConfigs
+from digio.utils.json_stream import JSONStreamError, StreamingJSONParser
+from digio.web_services.metrics import UpstreamTimer, get_metrics
+from digio.web_services.upstream_governor import get_upstream_governor
+from digio.web_services.upstream_resilience import get_resilience_policy
+
+CREATE_KYC_REQUEST_PATH = "/client/kyc/v2/request/with_template"
+FETCH_ID_DATA_PATH = "/v3/client/kyc/fetch_id_data/{id_type}"
+ANALYZE_IDCARD_PATH = "/v3/client/kyc/analyze/file/idcard_cord"
+
+
+# Waits for the endpoint's turn within the vendor's limits
+async def acquire_upstream(endpoint: str):
+    governor = get_upstream_governor()
+    if governor is not None:
+        await governor.acquire(endpoint)
+
+
+# Each attempt, including retries and hedges, waits for its own turn.
+# Only the call itself is timed, not the wait
+async def call_upstream(
+    endpoint: str,
+    attempt: Callable[[], Awaitable[Any]],
+    idempotent: bool,
+    id_type: str = "",
+) -> Any:
+    async def governed_attempt() -> Any:
+        await acquire_upstream(endpoint)
+        metrics = get_metrics()
+        if metrics is None:
+            return await attempt()
+        with UpstreamTimer(metrics, endpoint, id_type):
+            return await attempt()
+
+    policy = get_resilience_policy()
+    if policy is None:
+        return await governed_attempt()
+    return await policy.call(endpoint, governed_attempt, idempotent)
+
+
+class DigioClient:
+    def __init__(
+        self,
+        configs: DigioClientConfigs,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.configs = configs
+        auth = None
+        if configs.client_id and configs.client_secret:
+            auth = httpx.BasicAuth(configs.client_id, configs.client_secret)
+        self.client = httpx.AsyncClient(
+            base_url=configs.base_url,
+            auth=auth,
+            http2=configs.http2,
+            timeout=httpx.Timeout(
+                connect=configs.connect_timeout,
+                read=configs.read_timeout,
+                write=configs.write_timeout,
+                pool=configs.pool_timeout,
+            ),
+            limits=httpx.Limits(
+                max_connections=configs.max_connections,
+                max_keepalive_connections=configs.max_keepalive_connections,
+                keepalive_expiry=configs.keepalive_expiry,
+            ),
+            headers={"accept": "application/json"},
+            transport=transport,
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def post_json(
+        self,
+        endpoint: str,
+        path: str,
+        payload: dict,
+        idempotent: bool = False,
+        id_type: str = "",
+    ) -> Any:
+        async def attempt() -> Any:
+            with translate_transport_errors(path):
+                response = await self.client.post(path, json=payload)
+            return parse_digio_response(path, response)
+
+        return await call_upstream(endpoint, attempt, idempotent, id_type)
+
+    async def create_kyc_request(self, payload: dict) -> Any:
+        # Not retried, a second attempt could create a second KYC request
+        return await self.post_json(
+            "create_kyc_request", CREATE_KYC_REQUEST_PATH, payload
+        )
+
+    async def fetch_id_data(self, id_type: str, payload: dict) -> Any:
+        # Digio dedupes on unique_request_id, so only then is it safe to resend
+        return await self.post_json(
+            "fetch_id_data",
+            FETCH_ID_DATA_PATH.format(id_type=id_type),
+            payload,
+            idempotent=bool(payload.get("unique_request_id")),
+            id_type=id_type,
+        )
+
+    # The image is streamed from the file object and the response is fed to
+    # the parser as it arrives, so neither is held in memory as a whole.
+    # The parser runs in the threadpool as it writes the images to disk
+    async def analyze_idcard(
+        self,
+        file_name: str,
+        file_obj: BinaryIO,
+        content_type: str,
+        should_verify: bool,
+        parser: StreamingJSONParser,
+    ) -> Any:
+        path = ANALYZE_IDCARD_PATH
+        files = {"front_part": (file_name, file_obj, content_type)}
+        data = {"should_verify": "true" if should_verify else "false"}
+
+        # Never retried, the file object has been read by the first attempt
+        async def attempt() -> Any:
+            try:
+                with translate_transport_errors(path):
+                    async with self.client.stream(
+                        "POST", path, files=files, data=data
+                    ) as response:
+                        if response.is_error:
+                            await response.aread()
+                            parse_digio_response(path, response)
+                        async for chunk in response.aiter_bytes():
+                            await run_in_threadpool(parser.feed, chunk)
+                return await run_in_threadpool(parser.close)
+            except JSONStreamError as e:
+                raise HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail=f"Digio returned invalid JSON for {path}: {e}",
+                ) from e
+
+        return await call_upstream("analyze_idcard", attempt, idempotent=False)
+
+
+@contextmanager
+def translate_transport_errors(path: str):
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Digio timed out when processing {path}",
+        ) from e
+    except httpx.TransportError as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Cannot reach Digio when processing {path}: {e}",
+        ) from e
+
+
+def parse_digio_response(path: str, response: httpx.Response) -> Any:
+    if not response.is_error:
+        return response.json()
+
+    logger.warning(f"Digio returned {response.status_code} for {path}")
+    # Client errors are about the data that was sent, so pass them on as is.
+    # Auth errors are about our credentials and not the caller's problem
+    status_code = response.status_code
+    if status_code >= 500 or status_code in (401, 403):
+        status_code = status.HTTP_502_BAD_GATEWAY
+    raise HTTPException(
+        status_code=status_code,
+        detail=f"Digio returned {response.status_code} for {path}: {response.text}",
+    )
+
+
+digio_client: Optional[DigioClient] = None
+
+
+def start_digio_client(
+    configs: DigioClientConfigs,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> DigioClient:
+    global digio_client
+    digio_client = DigioClient(configs, transport=transport)
+    return digio_client
+
+
+async def stop_digio_client():
+    global digio_client
+    if digio_client is not None:
+        await digio_client.close()
+        digio_client = None
+
+
+async def get_digio_client() -> DigioClient:
+    # async so that FastAPI does not hop to the threadpool to resolve it
+    if digio_client is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Digio client has not been started",
+        )
+    return digio_client
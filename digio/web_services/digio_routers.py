@@ -3,16 +3,21 @@
 
 
 from fastapi import APIRouter, Depends
-from sqlmodel import Session
 
-from digio.models.db_engine import get_db_session
-from pydantic import BaseModel, EmailStr, Field, constr, conint
+from digio.web_services.digio_client import DigioClient, get_digio_client
+from digio.web_services.idempotency import get_idempotency_store, get_request_hash
+from digio.web_services.responses import FastJSONResponse
+from digio.web_services.single_flight import SingleFlight
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, constr, conint
 from typing import Optional, List, Dict, Any
 from enum import Enum
 from datetime import datetime
 
 router = APIRouter()
 
+CREATE_KYC_REQUEST_SCOPE = "create_kyc_request"
+kyc_requests = SingleFlight()
+
 
 class NotificationMode(str, Enum):
     SMS = "SMS"
@@ -267,58 +272,44 @@ class KYCResponse(BaseModel):
     additional_plugin_invocations: Optional[Dict[str, List[Dict[str, Any]]]] = None
 
 
-# # Create a request object
-# request_data = CreateKYCRequest(
-#     customer_identifier="customer@example.com",
-#     notify_customer=True,
-#     customer_name="John Doe",
-#     template_name="StandardKYC",
-#     reference_id="REF123456",
-#     transaction_id="TXN123456",
-#     preset_values={"key1": "value1"},
-#     expire_in_days=10,
-#     message="Please complete your KYC",
-#     other_signers=[
-#         CreateKYCRequest.Signer(
-#             identifier="signer@example.com", reason="To sign the document"
-#         )  # type: ignore
-#     ],
-#     signing_addons=[
-#         CreateKYCRequest.SignAddon(
-#             type=SignAddonType.geo_location, performEnrichment=True
-#         )  # type: ignore
-#     ],
-#     estamp_request=CreateKYCRequest.EStampRequest(tags={"Tag1": 1}),  # type: ignore
-#     generate_access_token=True,
-# )  # type: ignore
-
-# # Convert the request object to a dictionary
-# request_payload = request_data.dict()
-
-# # Make the API call
-# response = httpx.post(
-#     url="http://localhost:8080/client/kyc/v2/request/with_template",
-#     json=request_payload,
-#     auth=("username", "password"),  # Replace with your authentication method
-# )
-
-# # Check the response
-# if response.status_code == 200:
-#     print("Request successful!")
-#     response_data = response.json()
-#     print(response.json())
-#     validated_response = KYCResponse(**response_data)
-# else:
-#     print(f"Request failed with status code: {response.status_code}")
-#     print(response.text)
+kyc_response_adapter: TypeAdapter[KYCResponse] = TypeAdapter(KYCResponse)
 
 
 @router.post("/integration/create_request/", response_model=KYCResponse)
-def create_request(
-    *, session: Session = Depends(get_db_session), item: CreateKYCRequest
-) -> KYCResponse:  # type: ignore
-    pass
-    # return create_entity(session, item)
+async def create_request(
+    *,
+    client: DigioClient = Depends(get_digio_client),
+    item: CreateKYCRequest,
+) -> FastJSONResponse:
+    # reference_id and transaction_id are unique per request, so a resent
+    # request is answered from the store instead of creating another KYC request
+    idempotency_store = get_idempotency_store()
+    idempotency_key = f"{item.reference_id}:{item.transaction_id}"
+    request_hash = get_request_hash(item)
+    if idempotency_store is not None:
+        response = await idempotency_store.get(
+            CREATE_KYC_REQUEST_SCOPE,
+            idempotency_key,
+            request_hash,
+            kyc_response_adapter,
+        )
+        if response is not None:
+            return FastJSONResponse(response)
+
+    async def create_in_digio() -> KYCResponse:
+        payload = item.model_dump(mode="json", exclude_none=True)
+        response_data = await client.create_kyc_request(payload)
+        response = KYCResponse.model_validate(response_data)
+        if idempotency_store is not None:
+            await idempotency_store.save(
+                CREATE_KYC_REQUEST_SCOPE, idempotency_key, request_hash, response
+            )
+        return response
+
+    # A double submit that arrives before the first one is stored
+    # must still create only one KYC request
+    response = await kyc_requests.do((idempotency_key, request_hash), create_in_digio)
+    return FastJSONResponse(response)
 
 
 """
@@ -0,0 +1,286 @@
+# GiG
+# A stand-in for the Digio APIs we call, for load tests that cannot go to
+# the vendor. Responses are built from the captured payloads (idcard_cord.json
+# and the curl samples in digio_routers), with latencies, 500s and 429s
+# injected as set in fake_digio_configs.
+#
+# As a separate server, with digio_configs.base_url = "http://127.0.0.1:9000":
+#   python -m digio.web_services.fake_digio [--port 9000]
+# In-process, with fake_digio_configs.in_process = true, or in a script:
+#   start_digio_client(configs, transport=httpx.ASGITransport(app=create_fake_digio_app(fake_configs)))
+
+import argparse
+import asyncio
+import math
+import random
+import secrets
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+import orjson
+from fastapi import FastAPI, File, Form, Request, Response, UploadFile, status
+from pydantic import BaseModel
+
+from digio.models.config_models import FakeDigioConfigs, GlobalConfigs
+from digio.utils.utils import utc_now
+from digio.web_services.digio_client import (
+    ANALYZE_IDCARD_PATH,
+    CREATE_KYC_REQUEST_PATH,
+    FETCH_ID_DATA_PATH,
+)
+from digio.web_services.upstream_governor import TokenBucket
+
+IDCARD_CORD_FIXTURE = Path(__file__).parent / "idcard_cord.json"
+
+
+class FakeEndpointStats(BaseModel):
+    calls: int = 0
+    ok: int = 0
+    errors: int = 0
+    throttled: int = 0
+    total_latency_ms: float = 0.0
+
+
+# The fields of each ID card response, the ones taken from the request are filled in later
+FETCH_ID_DATA_FIXTURES: Dict[str, Dict[str, Any]] = {
+    "PAN": {
+        "status": "VALID",
+        "category": "Individual",
+        "remarks": "",
+        "name_as_per_pan_match": "Y",
+        "date_of_birth_match": "Y",
+        "aadhaar_seeding_status": "Y",
+    },
+    "VOTER_ID": {
+        "status": "ACTIVE",
+        "pc_name": "Chennai South",
+        "st_code": "S22",
+        "gender": "M",
+        "rln_name_v1": "UDAYAKUMAR",
+        "ac_name": "Mylapore",
+    },
+    "DRIVING_LICENSE": {
+        "status": "ACTIVE",
+        "date_of_issue": "12-08-2016",
+        "hazardous_valid_till": "NA",
+        "non_transport": "12-08-2016 to 19-07-2037",
+        "transport": "NA",
+        "current_status": "ACTIVE",
+    },
+    "VEHICLE_RC": {
+        "status": "ACTIVE",
+        "fuel_norms": "BHARAT STAGE VI",
+        "maker_model": "HONDA ACTIVA 6G",
+        "chassis_no": "ME4JF91XXXX123456",
+        "fitness_upto": "15-03-2036",
+        "owner_name": "EZHILARASAN U",
+        "vehicle_class": "M-Cycle/Scooter(2WN)",
+    },
+    "PASSPORT": {
+        "status": "VALID",
+        "given_name": "EZHILARASAN",
+        "surname": "U",
+        "type_of_application": "Normal",
+        "application_received_on_date": "01/06/2019",
+        "date_of_birth_match": "Y",
+    },
+}
+
+# Request field -> response field, per ID card type
+FETCH_ID_DATA_ECHOED_FIELDS: Dict[str, Dict[str, str]] = {
+    "PAN": {"id_no": "pan"},
+    "VOTER_ID": {"id_no": "epic_no", "name": "name_v1"},
+    "DRIVING_LICENSE": {"id_no": "old_new_dl_no", "name": "holders_name"},
+    "VEHICLE_RC": {"id_no": "registration_no"},
+    "PASSPORT": {"id_no": "passport_number", "file_no": "file_number"},
+}
+
+
+# The captured response as a whole, sent as is unless it is padded
+@lru_cache(maxsize=1)
+def load_idcard_cord_response() -> bytes:
+    return IDCARD_CORD_FIXTURE.read_bytes()
+
+
+class FakeDigio:
+    def __init__(self, configs: FakeDigioConfigs):
+        self.configure(configs)
+        self.stats: Dict[str, FakeEndpointStats] = {}
+
+    def configure(self, configs: FakeDigioConfigs):
+        self.configs = configs
+        self.rng = random.Random(configs.seed)
+        self.bucket = None
+        if configs.rate_limit_per_second:
+            self.bucket = TokenBucket(
+                configs.rate_limit_per_second, math.ceil(configs.rate_limit_per_second)
+            )
+        self.started_at = time.monotonic()
+
+    def sample_latency(self, endpoint: str) -> float:
+        latency_ms = self.configs.latency_ms_by_endpoint.get(
+            endpoint, self.configs.latency_ms
+        )
+        if latency_ms <= 0:
+            return 0.0
+        spread = self.configs.latency_spread
+        if self.configs.latency_distribution == "uniform":
+            latency_ms = self.rng.uniform(
+                latency_ms * (1 - spread), latency_ms * (1 + spread)
+            )
+        elif self.configs.latency_distribution == "lognormal":
+            latency_ms = self.rng.lognormvariate(math.log(latency_ms), spread)
+        return max(0.0, latency_ms / 1000)
+
+    def is_throttled(self) -> bool:
+        interval = self.configs.throttle_burst_interval
+        if interval > 0:
+            elapsed = (time.monotonic() - self.started_at) % interval
+            if elapsed >= interval - self.configs.throttle_burst_duration:
+                return True
+        return self.bucket is not None and not self.bucket.try_take()
+
+    def with_padding(self, content: Dict[str, Any]) -> Dict[str, Any]:
+        if self.configs.extra_payload_bytes > 0:
+            content = {**content, "padding": "x" * self.configs.extra_payload_bytes}
+        return content
+
+    async def respond(
+        self, endpoint: str, build_content: Callable[[], Any]
+    ) -> Response:
+        stats = self.stats.setdefault(endpoint, FakeEndpointStats())
+        stats.calls += 1
+        # Throttled calls are turned away before any work, like a gateway would
+        if self.is_throttled():
+            stats.throttled += 1
+            return Response(
+                content=b'{"code":"TOO_MANY_REQUESTS","message":"Rate limit exceeded"}',
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                media_type="application/json",
+                headers={"Retry-After": "1"},
+            )
+        latency = self.sample_latency(endpoint)
+        await asyncio.sleep(latency)
+        stats.total_latency_ms += latency * 1000
+        if self.configs.error_rate and self.rng.random() < self.configs.error_rate:
+            stats.errors += 1
+            return Response(
+                content=b'{"code":"INTERNAL_ERROR","message":"Injected error"}',
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                media_type="application/json",
+            )
+        content = build_content()
+        stats.ok += 1
+        if isinstance(content, Response):
+            return content
+        if isinstance(content, bytes):
+            if not self.configs.extra_payload_bytes:
+                return Response(content=content, media_type="application/json")
+            content = orjson.loads(content)
+        return Response(
+            content=orjson.dumps(self.with_padding(content)),
+            media_type="application/json",
+        )
+
+
+def build_fetch_id_data_response(id_type: str, payload: Dict[str, Any]):
+    fixture = FETCH_ID_DATA_FIXTURES.get(id_type)
+    if fixture is None:
+        return Response(
+            content=orjson.dumps(
+                {"code": "INVALID_ID_TYPE", "message": f"Unknown id type {id_type}"}
+            ),
+            status_code=status.HTTP_400_BAD_REQUEST,
+            media_type="application/json",
+        )
+    content = dict(fixture)
+    for request_field, response_field in FETCH_ID_DATA_ECHOED_FIELDS[id_type].items():
+        if payload.get(request_field):
+            content[response_field] = payload[request_field]
+    return content
+
+
+def build_kyc_response(payload: Dict[str, Any]) -> Dict[str, Any]:
+    now = utc_now()
+    return {
+        "id": f"KID{secrets.token_hex(8).upper()}",
+        "created_at": now.isoformat(),
+        "status": "requested",
+        "customer_identifier": payload.get("customer_identifier", ""),
+        "reference_id": payload.get("reference_id"),
+        "transaction_id": payload.get("transaction_id"),
+        "customer_name": payload.get("customer_name"),
+        "expire_in_days": payload.get("expire_in_days", 10),
+        "reminder_registered": False,
+        "access_token": {
+            "created_at": now.isoformat(),
+            "entity_id": f"KID{secrets.token_hex(8).upper()}",
+            "id": f"GWT{secrets.token_hex(8).upper()}",
+            "valid_till": now.replace(year=now.year + 1).isoformat(),
+            "workflow_name": payload.get("template_name"),
+        },
+        "auto_approved": False,
+    }
+
+
+def create_fake_digio_app(configs: FakeDigioConfigs) -> FastAPI:
+    fake_digio = FakeDigio(configs)
+    app = FastAPI(title="fake digio")
+    app.state.fake_digio = fake_digio
+
+    @app.post(FETCH_ID_DATA_PATH)
+    async def fetch_id_data(id_type: str, request: Request) -> Response:
+        payload = orjson.loads(await request.body() or b"{}")
+        return await fake_digio.respond(
+            "fetch_id_data", lambda: build_fetch_id_data_response(id_type, payload)
+        )
+
+    @app.post(CREATE_KYC_REQUEST_PATH)
+    async def create_kyc_request(request: Request) -> Response:
+        payload = orjson.loads(await request.body() or b"{}")
+        return await fake_digio.respond(
+            "create_kyc_request", lambda: build_kyc_response(payload)
+        )
+
+    @app.post(ANALYZE_IDCARD_PATH)
+    async def analyze_idcard(
+        front_part: UploadFile = File(...),
+        should_verify: Optional[str] = Form(None),
+    ) -> Response:
+        await front_part.read()
+        return await fake_digio.respond("analyze_idcard", load_idcard_cord_response)
+
+    @app.get("/fake/stats")
+    async def get_stats() -> Dict[str, FakeEndpointStats]:
+        return fake_digio.stats
+
+    # Lets a load test change the behaviour between runs without a restart
+    @app.put("/fake/configs")
+    async def put_configs(new_configs: FakeDigioConfigs) -> FakeDigioConfigs:
+        fake_digio.configure(new_configs)
+        fake_digio.stats = {}
+        return new_configs
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    configs = GlobalConfigs.load_default().fake_digio_configs
+    parser = argparse.ArgumentParser(description="Serve the Digio APIs from fixtures")
+    parser.add_argument("--host", default=configs.host)
+    parser.add_argument("--port", type=int, default=configs.port)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_fake_digio_app(configs),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# https://documentation.digio.in/digikyc/id_proof/api_integration/
+# Analyze ID Card image
+# The upload is spooled to disk as it arrives and streamed on to Digio,
+# and the base64 images in Digio's response (see idcard_cord.json) are
+# decoded straight into the blob store instead of becoming large Python strings.
+
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from pydantic import BaseModel, ConfigDict
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+from digio.models import db_engine
+from digio.models.db_schemas import IDCardAnalysis
+from digio.utils import blob_store
+from digio.utils.blob_store import BlobStore, BlobWriter
+from digio.utils.json_stream import Base64FileSink, StreamingJSONParser
+from digio.utils.utils import utc_now
+from digio.web_services.digio_client import DigioClient, get_digio_client
+from digio.web_services.responses import FastJSONResponse
+
+router = APIRouter()
+
+IMAGE_FIELDS = frozenset(
+    ["encoded_signature", "encoded_image", "aligned_front_image", "front_bytes"]
+)
+
+
+class SpoolingMultiPartParser(MultiPartParser):
+    # Starlette keeps up to 1MB of every uploaded file in memory,
+    # this rolls the upload over to a temp file much earlier
+    max_file_size = 64 * 1024
+
+
+class StoredImage(BaseModel):
+    digest: str
+    size: int
+    url: str
+
+
+class IDCardAnalysisDetails(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    id_type: Optional[str] = None
+    part: Optional[str] = None
+    name: Optional[str] = None
+    fathers_name: Optional[str] = None
+    id_no: Optional[str] = None
+    dob: Optional[str] = None
+    front_image_properties: Optional[Dict[str, float]] = None
+    front_part_security_features: Optional[List[str]] = None
+    coordinates: Optional[Dict[str, List[float]]] = None
+
+
+class IDCardAnalysisResponse(BaseModel):
+    analysis_id: Optional[int] = None
+    response: IDCardAnalysisDetails
+    # Keyed by the field in which Digio sent the image
+    images: Dict[str, StoredImage]
+
+
+class ImageBlobSinks:
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.pending_writers: List[BlobWriter] = []
+
+    def create_sink(self, field_name: str) -> Base64FileSink:
+        writer = self.store.open_writer()
+        self.pending_writers.append(writer)
+
+        def on_finish(size: int) -> StoredImage:
+            self.pending_writers.remove(writer)
+            digest = writer.commit()
+            return StoredImage(digest=digest, size=size, url=f"/blobs/{digest}")
+
+        return Base64FileSink(writer, on_finish)  # type: ignore
+
+    # Drops the half written blobs when the response could not be parsed
+    def abort(self):
+        for writer in self.pending_writers:
+            writer.abort()
+        self.pending_writers = []
+
+
+def pop_images(data: dict, images: Dict[str, StoredImage]):
+    for field_name in IMAGE_FIELDS:
+        if isinstance(data.get(field_name), StoredImage):
+            images[field_name] = data.pop(field_name)
+
+
+# The form is parsed by hand instead of declaring an UploadFile parameter
+# so that the upload does not go through FastAPI's in-memory spooling
+@router.post(
+    "/analyze/idcard_cord/",
+    response_model=IDCardAnalysisResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["front_part"],
+                        "properties": {
+                            "front_part": {"type": "string", "format": "binary"},
+                            "should_verify": {"type": "boolean", "default": True},
+                        },
+                    }
+                }
+            },
+        }
+    },
+)
+async def analyze_idcard(
+    *,
+    request: Request,
+    client: DigioClient = Depends(get_digio_client),
+) -> FastJSONResponse:
+    global_configs = request.app.state.global_configs
+    analysis_configs = global_configs.idcard_analysis_configs
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Expected a multipart/form-data upload",
+        )
+
+    form_parser = SpoolingMultiPartParser(request.headers, request.stream())
+    form_parser.max_file_size = analysis_configs.spool_memory_limit
+    try:
+        form = await form_parser.parse()
+    except MultiPartException as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=e.message
+        ) from e
+
+    image_sinks = ImageBlobSinks(blob_store.get_blob_store())
+    try:
+        front_part = form.get("front_part")
+        if not isinstance(front_part, UploadFile):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="front_part must be an uploaded file",
+            )
+        should_verify = str(form.get("should_verify", "true")).lower() == "true"
+        response_parser = StreamingJSONParser(IMAGE_FIELDS, image_sinks.create_sink)
+        data = await client.analyze_idcard(
+            front_part.filename or "front_part.jpg",
+            front_part.file,
+            front_part.content_type or "application/octet-stream",
+            should_verify,
+            response_parser,
+        )
+    finally:
+        await run_in_threadpool(image_sinks.abort)
+        await form.close()
+
+    images: Dict[str, StoredImage] = {}
+    pop_images(data, images)
+    details_data = data.get("response") or {}
+    pop_images(details_data, images)
+    details = IDCardAnalysisDetails.model_validate(details_data)
+    analysis_id = await run_in_threadpool(save_analysis, details, images)
+    return FastJSONResponse(
+        IDCardAnalysisResponse(analysis_id=analysis_id, response=details, images=images)
+    )
+
+
+def save_analysis(
+    details: IDCardAnalysisDetails, images: Dict[str, StoredImage]
+) -> Optional[int]:
+    if db_engine.engine is None:
+        return None
+
+    def get_digest(field_name: str) -> Optional[str]:
+        image = images.get(field_name)
+        return image.digest if image else None
+
+    analysis = IDCardAnalysis(
+        id_type=details.id_type,
+        id_no=details.id_no,
+        name=details.name,
+        dob=details.dob,
+        analysed_at=utc_now(),
+        front_bytes_digest=get_digest("front_bytes"),
+        aligned_front_image_digest=get_digest("aligned_front_image"),
+        encoded_image_digest=get_digest("encoded_image"),
+        encoded_signature_digest=get_digest("encoded_signature"),
+    )
+    with Session(db_engine.engine) as session:
+        session.add(analysis)
+        session.commit()
+        session.refresh(analysis)
+    return analysis.id
@@ -0,0 +1,184 @@
+# GiG
+# Cache of verified ID card results so that repeat verifications of the same
+# customer are answered locally instead of making another paid Digio call.
+# The first tier is an in-process LRU, the second tier is a SQLite table
+# so that the results survive restarts and are shared across workers.
+
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+import orjson
+from loguru import logger
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import delete
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+from digio.models import db_engine
+from digio.models.config_models import IDCardCacheConfigs
+from digio.models.db_schemas import VerifiedIDCardResult
+from digio.utils.ttl_cache import CacheStats, TTLCache
+from digio.utils.utils import as_utc, utc_now
+
+
+class IDCardCacheStats(BaseModel):
+    memory: CacheStats
+    db_hits: int
+    db_misses: int
+    db_expirations: int
+    db_errors: int
+    stale_served: int
+
+
+# Keyed on every field sent to Digio, as the answer depends on all of them
+# (eg. name_as_per_pan_match on the name). unique_request_id only traces
+# the request and is left out
+def get_cache_key(id_type: str, payload: Dict[str, Any]) -> str:
+    normalized = {
+        field: value.strip() if isinstance(value, str) else value
+        for field, value in payload.items()
+        if field != "unique_request_id" and value is not None
+    }
+    if isinstance(normalized.get("id_no"), str):
+        normalized["id_no"] = normalized["id_no"].upper()
+    key_data = orjson.dumps([id_type, normalized], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(key_data).hexdigest()
+
+
+class IDCardResultCache:
+    def __init__(self, configs: IDCardCacheConfigs, response_adapter: TypeAdapter):
+        self.configs = configs
+        # The responses are a union of models, one per ID card type
+        self.response_adapter = response_adapter
+        self.memory_cache: TTLCache[BaseModel] = TTLCache(
+            max_size=configs.max_memory_entries, default_ttl=configs.default_ttl
+        )
+        self.db_hits = 0
+        self.db_misses = 0
+        self.db_expirations = 0
+        self.db_errors = 0
+        self.stale_served = 0
+
+    async def get(self, cache_key: str) -> Optional[Any]:
+        response = self.memory_cache.get(cache_key)
+        if response is not None:
+            return response
+
+        db_entry = await run_in_threadpool(self._get_from_db, cache_key)
+        if db_entry is None:
+            self.db_misses += 1
+            return None
+        self.db_hits += 1
+        response_json, expires_at = db_entry
+        response = self.response_adapter.validate_json(response_json)
+        # Only keep it in memory for as long as the DB row is valid
+        remaining = (expires_at - utc_now()).total_seconds()
+        self.memory_cache.set(cache_key, response, ttl=remaining)
+        return response
+
+    # Only for when Digio cannot be reached, the result may have expired
+    async def get_stale(self, cache_key: str) -> Optional[Any]:
+        db_entry = await run_in_threadpool(self._get_from_db, cache_key, True)
+        if db_entry is None:
+            return None
+        self.stale_served += 1
+        return self.response_adapter.validate_json(db_entry[0])
+
+    async def set(self, cache_key: str, id_type: str, response: BaseModel):
+        ttl = self.configs.get_ttl(id_type)
+        if ttl <= 0:
+            return
+        self.memory_cache.set(cache_key, response, ttl=ttl)
+        now = utc_now()
+        row = VerifiedIDCardResult(
+            cache_key=cache_key,
+            id_type=id_type,
+            response_json=response.model_dump_json(exclude_none=True),
+            verified_at=now,
+            expires_at=now + timedelta(seconds=ttl),
+        )
+        await run_in_threadpool(self._save_to_db, row)
+
+    def get_stats(self) -> IDCardCacheStats:
+        return IDCardCacheStats(
+            memory=self.memory_cache.get_stats(),
+            db_hits=self.db_hits,
+            db_misses=self.db_misses,
+            db_expirations=self.db_expirations,
+            db_errors=self.db_errors,
+            stale_served=self.stale_served,
+        )
+
+    # The DB tier is best effort, a broken cache should
+    # never fail a verification that Digio can answer
+    def _get_from_db(
+        self, cache_key: str, allow_stale: bool = False
+    ) -> Optional[tuple[str, datetime]]:
+        if db_engine.engine is None:
+            return None
+        try:
+            with Session(db_engine.engine) as session:
+                row = session.get(VerifiedIDCardResult, cache_key)
+                if row is None:
+                    return None
+                expires_at = as_utc(row.expires_at)
+                now = utc_now()
+                if expires_at + self.get_stale_window() <= now:
+                    session.delete(row)
+                    session.commit()
+                    self.db_expirations += 1
+                    return None
+                if expires_at <= now and not allow_stale:
+                    self.db_expirations += 1
+                    return None
+                return row.response_json, expires_at
+        except Exception as e:
+            self.db_errors += 1
+            logger.warning(f"Cannot read ID card cache: {e}")
+            return None
+
+    def _save_to_db(self, row: VerifiedIDCardResult):
+        if db_engine.engine is None:
+            return
+        try:
+            with Session(db_engine.engine) as session:
+                session.merge(row)
+                session.commit()
+        except Exception as e:
+            self.db_errors += 1
+            logger.warning(f"Cannot write ID card cache: {e}")
+
+    # Expired rows are kept this long for get_stale
+    def get_stale_window(self) -> timedelta:
+        return timedelta(seconds=self.configs.serve_stale_for)
+
+    def purge_expired(self) -> int:
+        if db_engine.engine is None:
+            return 0
+        with Session(db_engine.engine) as session:
+            result = session.execute(
+                delete(VerifiedIDCardResult).where(
+                    VerifiedIDCardResult.expires_at  # type: ignore
+                    <= utc_now() - self.get_stale_window()
+                )
+            )
+            session.commit()
+            return result.rowcount
+
+
+idcard_cache: Optional[IDCardResultCache] = None
+
+
+def start_idcard_cache(
+    configs: IDCardCacheConfigs, response_adapter: TypeAdapter
+) -> Optional[IDCardResultCache]:
+    global idcard_cache
+    idcard_cache = None
+    if configs.enabled:
+        idcard_cache = IDCardResultCache(configs, response_adapter)
+    return idcard_cache
+
+
+def get_idcard_cache() -> Optional[IDCardResultCache]:
+    return idcard_cache
@@ -1,17 +1,31 @@
 # https://documentation.digio.in/digikyc/id_proof/api_integration/
 # Fetch ID Card
 
-from pydantic import BaseModel, Field
-from typing import Optional
+import asyncio
+from pydantic import BaseModel, Field, TypeAdapter
+from typing import Annotated, Dict, List, Literal, NamedTuple, Optional, Type, Union
 from enum import Enum
 
-from fastapi import APIRouter, Depends
-from sqlmodel import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from loguru import logger
 
-from digio.models.db_engine import get_db_session
+from digio.web_services.digio_client import DigioClient, get_digio_client
+from digio.web_services.idcard_cache import get_cache_key, get_idcard_cache
+from digio.web_services.idempotency import get_idempotency_store, get_request_hash
+from digio.web_services.responses import FastJSONResponse, dump_json
+from digio.web_services.single_flight import SingleFlight
+from digio.web_services.upstream_governor import Priority, request_priority
+from digio.web_services.upstream_resilience import UPSTREAM_FAILURE_STATUSES
 
 router = APIRouter()
 
+# Identical lookups that arrive together (double submits, retry storms)
+# share one call to Digio instead of making one each
+idcard_lookups = SingleFlight()
+
+FETCH_ID_DATA_SCOPE = "fetch_id_data"
+
 
 class FetchIDCardRequest(BaseModel):
     id_no: str = Field(..., description="Identifier of the ID Card")
@@ -32,22 +46,31 @@ class IDCardType(str, Enum):
     DRIVING_LICENSE = "DRIVING_LICENSE"
 
 
-class FetchIDCardResponse(BaseModel):
+# Digio sends a different set of fields for every IDCardType, so each type
+# has its own compact model and id_type tells them apart. This keeps
+# validation and serialization to the fields a type can actually have.
+class IDCardResponseBase(BaseModel):
+    status: Optional[str] = Field(None, description="Describes the status of ID Card")
+    date_of_birth_match: Optional[str] = Field(
+        None, description="Date of birth as per ID Card details"
+    )
+
+
+class PANResponse(IDCardResponseBase):
+    id_type: Literal[IDCardType.PAN] = IDCardType.PAN
     pan: Optional[str] = Field(None, description="Applicable in case of PAN")
     category: Optional[str] = Field(None, description="Applicable in case of PAN")
-    status: Optional[str] = Field(None, description="Describes the status of ID Card")
     remarks: Optional[str] = Field(None, description="Applicable in case of PAN")
     name_as_per_pan_match: Optional[str] = Field(
         None, description="Applicable in case of PAN"
     )
-    date_of_birth_match: Optional[str] = Field(
-        None, description="Date of birth as per ID Card details"
-    )
     aadhaar_seeding_status: Optional[str] = Field(
         None, description="Applicable in case PAN"
     )
 
-    # Voter ID fields
+
+class VoterIDResponse(IDCardResponseBase):
+    id_type: Literal[IDCardType.VOTER_ID] = IDCardType.VOTER_ID
     pc_name: Optional[str] = Field(
         None, description="Polling center name, Applicable in case VOTER_ID"
     )
@@ -147,7 +170,9 @@ class FetchIDCardResponse(BaseModel):
         description="Contains all other irrelevant details, Applicable in case VOTER_ID",
     )
 
-    # Driving License fields
+
+class DrivingLicenseResponse(IDCardResponseBase):
+    id_type: Literal[IDCardType.DRIVING_LICENSE] = IDCardType.DRIVING_LICENSE
     date_of_issue: Optional[str] = Field(
         None, description="Applicable in case DRIVING_LICENSE"
     )
@@ -173,7 +198,9 @@ class FetchIDCardResponse(BaseModel):
         None, description="Last Transaction At, Applicable in case DRIVING_LICENSE"
     )
 
-    # Vehicle RC fields
+
+class VehicleRCResponse(IDCardResponseBase):
+    id_type: Literal[IDCardType.VEHICLE_RC] = IDCardType.VEHICLE_RC
     fuel_norms: Optional[str] = Field(
         None, description="Fuel Norms, Applicable in case VEHICLE_RC"
     )
@@ -196,7 +223,9 @@ class FetchIDCardResponse(BaseModel):
         None, description="Vehicle Class, Applicable in case VEHICLE_RC"
     )
 
-    # Passport fields
+
+class PassportResponse(IDCardResponseBase):
+    id_type: Literal[IDCardType.PASSPORT] = IDCardType.PASSPORT
     file_number: Optional[str] = Field(
         None, description="File Number, Applicable in case PASSPORT"
     )
@@ -218,14 +247,188 @@ class FetchIDCardResponse(BaseModel):
     nt: Optional[str] = Field(None, description="Applicable in case PASSPORT")
 
 
-@router.post("/fetch_id_data/", response_model=FetchIDCardResponse)
-def create_request(
+FetchIDCardResponse = Annotated[
+    Union[
+        PANResponse,
+        VoterIDResponse,
+        DrivingLicenseResponse,
+        VehicleRCResponse,
+        PassportResponse,
+    ],
+    Field(discriminator="id_type"),
+]
+fetch_id_card_response_adapter: TypeAdapter[FetchIDCardResponse] = TypeAdapter(
+    FetchIDCardResponse
+)
+
+ID_CARD_RESPONSE_TYPES: Dict[IDCardType, Type[IDCardResponseBase]] = {
+    IDCardType.PAN: PANResponse,
+    IDCardType.VOTER_ID: VoterIDResponse,
+    IDCardType.DRIVING_LICENSE: DrivingLicenseResponse,
+    IDCardType.VEHICLE_RC: VehicleRCResponse,
+    IDCardType.PASSPORT: PassportResponse,
+}
+
+
+class IDCardLookup(NamedTuple):
+    response: FetchIDCardResponse
+    # An expired result served while Digio is down
+    is_stale: bool = False
+
+
+async def lookup_id_card(
+    client: DigioClient, types: IDCardType, item: FetchIDCardRequest
+) -> IDCardLookup:
+    idcard_cache = get_idcard_cache()
+    payload = item.model_dump(exclude_none=True)
+    cache_key = get_cache_key(types.value, payload)
+    if idcard_cache is not None:
+        cached_response = await idcard_cache.get(cache_key)
+        if cached_response is not None:
+            return IDCardLookup(cached_response)
+
+    async def fetch_from_digio() -> IDCardLookup:
+        try:
+            response_data = await client.fetch_id_data(types.value, payload)
+        except HTTPException as e:
+            # An earlier result, even an expired one, beats no answer
+            # while Digio is down
+            if e.status_code not in UPSTREAM_FAILURE_STATUSES or idcard_cache is None:
+                raise
+            stale_response = await idcard_cache.get_stale(cache_key)
+            if stale_response is None:
+                raise
+            logger.warning(f"Serving a stale {types.value} result, Digio is down")
+            return IDCardLookup(stale_response, is_stale=True)
+        # Digio does not send the type back, it is known from the request
+        response = ID_CARD_RESPONSE_TYPES[types].model_validate(response_data)
+        if idcard_cache is not None:
+            await idcard_cache.set(cache_key, types.value, response)
+        return IDCardLookup(response)
+
+    # Only lookups that would send Digio the same fields share a call,
+    # the same PAN with another name is a lookup of its own
+    return await idcard_lookups.do(cache_key, fetch_from_digio)
+
+
+async def fetch_id_card(
+    client: DigioClient, types: IDCardType, item: FetchIDCardRequest
+) -> FetchIDCardResponse:
+    # A resent request is answered with exactly what was sent the first time
+    idempotency_store = get_idempotency_store()
+    if idempotency_store is None or not item.unique_request_id:
+        return (await lookup_id_card(client, types, item)).response
+
+    request_hash = get_request_hash(item, types.value)
+    response = await idempotency_store.get(
+        FETCH_ID_DATA_SCOPE,
+        item.unique_request_id,
+        request_hash,
+        fetch_id_card_response_adapter,
+    )
+    if response is not None:
+        return response
+    lookup = await lookup_id_card(client, types, item)
+    # A stale result is not kept, so that resending the request once
+    # Digio is back gets a fresh answer instead of the stale one again
+    if not lookup.is_stale:
+        await idempotency_store.save(
+            FETCH_ID_DATA_SCOPE, item.unique_request_id, request_hash, lookup.response
+        )
+    return lookup.response
+
+
+@router.post(
+    "/fetch_id_data/",
+    response_model=FetchIDCardResponse,
+    response_model_exclude_none=True,
+)
+async def create_request(
     *,
-    session: Session = Depends(get_db_session),
+    client: DigioClient = Depends(get_digio_client),
     types: IDCardType,
     item: FetchIDCardRequest,
-) -> FetchIDCardResponse:  # type: ignore
-    print(types)
-    print(item)
-    pass
-    # return create_entity(session, item)
+) -> FastJSONResponse:
+    response = await fetch_id_card(client, types, item)
+    return FastJSONResponse(response, exclude_none=True)
+
+
+class BatchFetchIDCardItem(FetchIDCardRequest):
+    id_type: IDCardType = Field(..., description="Type of the ID Card")
+
+
+class BatchFetchIDCardRequest(BaseModel):
+    items: List[BatchFetchIDCardItem] = Field(..., min_length=1)
+
+
+class BatchFetchIDCardResult(BaseModel):
+    index: int = Field(..., description="Position of the item in the request")
+    id_type: IDCardType
+    unique_request_id: Optional[str] = None
+    status_code: int
+    response: Optional[FetchIDCardResponse] = None
+    error: Optional[str] = None
+
+
+async def fetch_batch_item(
+    client: DigioClient,
+    semaphore: asyncio.Semaphore,
+    index: int,
+    batch_item: BatchFetchIDCardItem,
+) -> BatchFetchIDCardResult:
+    result = BatchFetchIDCardResult(
+        index=index,
+        id_type=batch_item.id_type,
+        unique_request_id=batch_item.unique_request_id,
+        status_code=status.HTTP_200_OK,
+    )
+    item = FetchIDCardRequest.model_validate(batch_item.model_dump(exclude={"id_type"}))
+    # Each item runs in its own task, so this only applies to the item
+    request_priority.set(Priority.BATCH)
+    async with semaphore:
+        try:
+            result.response = await fetch_id_card(client, batch_item.id_type, item)
+        except HTTPException as e:
+            result.status_code = e.status_code
+            result.error = str(e.detail)
+        except Exception as e:
+            logger.exception(f"Batch item {index} failed")
+            result.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            result.error = str(e)
+    return result
+
+
+# Results are streamed as NDJSON in the order they complete,
+# the index in each result ties it back to the request
+@router.post("/fetch_id_data/batch", response_class=StreamingResponse)
+async def create_batch_request(
+    *,
+    request: Request,
+    client: DigioClient = Depends(get_digio_client),
+    batch: BatchFetchIDCardRequest,
+) -> StreamingResponse:
+    batch_configs = request.app.state.global_configs.idcard_batch_configs
+    if len(batch.items) > batch_configs.max_items:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A batch can have at most {batch_configs.max_items} items",
+        )
+
+    async def stream_results():
+        # The tasks are only started once the response is being sent, so that
+        # a response that never starts does not leave them calling Digio
+        semaphore = asyncio.Semaphore(batch_configs.max_concurrency)
+        tasks = [
+            asyncio.create_task(fetch_batch_item(client, semaphore, index, batch_item))
+            for index, batch_item in enumerate(batch.items)
+        ]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                yield dump_json(result, exclude_none=True) + b"\n"
+        finally:
+            # The client went away, do not keep calling Digio for it
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
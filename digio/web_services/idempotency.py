@@ -0,0 +1,164 @@
+# GiG
+# Replays the stored response when a client resends a request with the same
+# unique_request_id (fetch ID data) or reference_id/transaction_id (KYC).
+# Responses are kept in an in-process LRU in front of the idempotency_records
+# table, expired rows are compacted away periodically.
+
+import asyncio
+import hashlib
+from datetime import timedelta
+from typing import Any, Optional
+
+from fastapi import HTTPException, status
+from loguru import logger
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import delete
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+from digio.models import db_engine
+from digio.models.config_models import IdempotencyConfigs
+from digio.models.db_schemas import IdempotencyRecord
+from digio.utils.ttl_cache import CacheStats, TTLCache
+from digio.utils.utils import as_utc, utc_now
+
+
+class IdempotencyStats(BaseModel):
+    memory: CacheStats
+    replays: int
+    db_errors: int
+    compacted: int
+
+
+def get_request_hash(request: BaseModel, *extra: str) -> str:
+    hasher = hashlib.sha256(request.model_dump_json().encode())
+    for value in extra:
+        hasher.update(value.encode())
+    return hasher.hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, configs: IdempotencyConfigs):
+        self.configs = configs
+        # idempotency key -> (request hash, response)
+        self.memory_cache: TTLCache[tuple[str, BaseModel]] = TTLCache(
+            max_size=configs.max_memory_entries, default_ttl=configs.ttl
+        )
+        self.replays = 0
+        self.db_errors = 0
+        self.compacted = 0
+
+    async def get(
+        self,
+        scope: str,
+        key: str,
+        request_hash: str,
+        response_adapter: TypeAdapter,
+    ) -> Optional[Any]:
+        idempotency_key = f"{scope}:{key}"
+        entry = self.memory_cache.get(idempotency_key)
+        if entry is None:
+            db_entry = await run_in_threadpool(self._get_from_db, idempotency_key)
+            if db_entry is None:
+                return None
+            stored_hash, response_json, expires_at = db_entry
+            entry = (stored_hash, response_adapter.validate_json(response_json))
+            remaining = (expires_at - utc_now()).total_seconds()
+            self.memory_cache.set(idempotency_key, entry, ttl=remaining)
+
+        stored_hash, response = entry
+        if stored_hash != request_hash:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"{key} was already used for a different {scope} request",
+            )
+        self.replays += 1
+        return response
+
+    async def save(self, scope: str, key: str, request_hash: str, response: BaseModel):
+        idempotency_key = f"{scope}:{key}"
+        self.memory_cache.set(idempotency_key, (request_hash, response))
+        now = utc_now()
+        record = IdempotencyRecord(
+            idempotency_key=idempotency_key,
+            scope=scope,
+            request_hash=request_hash,
+            response_json=response.model_dump_json(),
+            created_at=now,
+            expires_at=now + timedelta(seconds=self.configs.ttl),
+        )
+        await run_in_threadpool(self._save_to_db, record)
+
+    def get_stats(self) -> IdempotencyStats:
+        return IdempotencyStats(
+            memory=self.memory_cache.get_stats(),
+            replays=self.replays,
+            db_errors=self.db_errors,
+            compacted=self.compacted,
+        )
+
+    def _get_from_db(self, idempotency_key: str):
+        if db_engine.engine is None:
+            return None
+        try:
+            with Session(db_engine.engine) as session:
+                record = session.get(IdempotencyRecord, idempotency_key)
+                if record is None:
+                    return None
+                expires_at = as_utc(record.expires_at)
+                if expires_at <= utc_now():
+                    # Left for compaction to delete
+                    return None
+                return record.request_hash, record.response_json, expires_at
+        except Exception as e:
+            self.db_errors += 1
+            logger.warning(f"Cannot read idempotency record: {e}")
+            return None
+
+    def _save_to_db(self, record: IdempotencyRecord):
+        if db_engine.engine is None:
+            return
+        try:
+            with Session(db_engine.engine) as session:
+                session.merge(record)
+                session.commit()
+        except Exception as e:
+            self.db_errors += 1
+            logger.warning(f"Cannot write idempotency record: {e}")
+
+    def compact(self) -> int:
+        if db_engine.engine is None:
+            return 0
+        with Session(db_engine.engine) as session:
+            result = session.execute(
+                delete(IdempotencyRecord).where(
+                    IdempotencyRecord.expires_at <= utc_now()  # type: ignore
+                )
+            )
+            session.commit()
+        self.compacted += result.rowcount
+        return result.rowcount
+
+    async def compact_periodically(self):
+        while True:
+            try:
+                deleted = await run_in_threadpool(self.compact)
+                logger.info(f"Compacted {deleted} expired idempotency records")
+            except Exception as e:
+                logger.warning(f"Cannot compact idempotency records: {e}")
+            await asyncio.sleep(self.configs.compaction_interval)
+
+
+idempotency_store: Optional[IdempotencyStore] = None
+
+
+def start_idempotency_store(configs: IdempotencyConfigs) -> Optional[IdempotencyStore]:
+    global idempotency_store
+    idempotency_store = None
+    if configs.enabled:
+        idempotency_store = IdempotencyStore(configs)
+    return idempotency_store
+
+
+def get_idempotency_store() -> Optional[IdempotencyStore]:
+    return idempotency_store
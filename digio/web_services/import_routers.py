@@ -0,0 +1,136 @@
+# GiG
+# Bulk import of rosters (colleges, departments, batches, courses,
+# faculties, students) from CSV or NDJSON, one row per entity.
+# The rows are written with the bulk helpers in db_base_ops, so a bad row
+# is reported by its line instead of failing the whole import.
+# Only admins can import, and passwords and admin rights cannot be set
+# this way, see PROTECTED_COLUMNS.
+#
+# curl -X POST 'http://localhost:8000/import/students' -H 'authorization: Bearer <token>' \
+#   -H 'content-type: text/csv' --data-binary @students.csv
+
+import csv
+import io
+from typing import Any, Dict, List, Type
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlmodel import Session, SQLModel
+from starlette.concurrency import run_in_threadpool
+
+from digio.models import db_base_ops
+from digio.models.auth_models import get_current_admin
+from digio.models.db_base_ops import BulkResult
+from digio.models.db_engine import get_db_session
+from digio.models.db_schemas import Batch, College, Course, Department, Faculty, Student
+
+router = APIRouter()
+
+IMPORTABLE_ENTITIES: Dict[str, Type[SQLModel]] = {
+    "colleges": College,
+    "departments": Department,
+    "batches": Batch,
+    "courses": Course,
+    "faculties": Faculty,
+    "students": Student,
+}
+# An import that could set these could make up an admin
+# with a password of its choosing
+PROTECTED_COLUMNS = {"hashed_pwd", "is_admin"}
+
+
+def parse_csv_rows(body: bytes, entity_type: Type[SQLModel]) -> List[Dict[str, Any]]:
+    reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+    # CSV has no null, so an empty cell is None for a field without a
+    # default (eg. last_name) and is left out so that the default applies otherwise
+    fields = entity_type.model_fields
+    nullable_columns = {name for name, field in fields.items() if field.is_required()}
+    rows = []
+    for row in reader:
+        parsed_row: Dict[str, Any] = {}
+        for key, value in row.items():
+            if value != "":
+                parsed_row[key] = value
+            elif key in nullable_columns:
+                parsed_row[key] = None
+        rows.append(parsed_row)
+    return rows
+
+
+def parse_ndjson_rows(body: bytes) -> List[Dict[str, Any]]:
+    rows = []
+    for line_no, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(orjson.loads(line))
+        except orjson.JSONDecodeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid JSON on line {line_no}: {e}",
+            ) from e
+    return rows
+
+
+@router.post(
+    "/import/{entity_name}",
+    response_model=BulkResult,
+    dependencies=[Depends(get_current_admin)],
+)
+async def import_entities(
+    *,
+    request: Request,
+    entity_name: str,
+    session: Session = Depends(get_db_session),
+) -> BulkResult:
+    entity_type = IMPORTABLE_ENTITIES.get(entity_name)
+    if entity_type is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cannot import {entity_name}, expected one of {', '.join(IMPORTABLE_ENTITIES)}",
+        )
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body = await request.body()
+    if content_type == "text/csv":
+        rows = parse_csv_rows(body, entity_type)
+    elif content_type in ("application/x-ndjson", "application/jsonl"):
+        rows = parse_ndjson_rows(body)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Expected text/csv or application/x-ndjson",
+        )
+
+    protected_columns = {
+        column
+        for row in rows
+        if isinstance(row, dict)
+        for column in row
+        if column in PROTECTED_COLUMNS
+    }
+    if protected_columns:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{', '.join(sorted(protected_columns))} cannot be imported",
+        )
+
+    import_configs = request.app.state.global_configs.bulk_import_configs
+    if len(rows) > import_configs.max_rows:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"An import can have at most {import_configs.max_rows} rows",
+        )
+    result = await run_in_threadpool(
+        db_base_ops.bulk_create_entities,
+        session,
+        entity_type,
+        rows,
+        import_configs.chunk_size,
+    )
+    if result.errors and not result.succeeded:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=[error.model_dump() for error in result.errors],
+        )
+    return result
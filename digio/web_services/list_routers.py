@@ -0,0 +1,69 @@
+# GiG
+# Paginated listing of the roster tables.
+# Every query parameter other than after, limit and fields filters on the
+# column of that name, eg.
+# curl -H 'authorization: Bearer <token>' \
+#   'http://localhost:8000/list/students?batch_id=3&fields=username,first_name&limit=50'
+# and the next page is fetched with after=<next_cursor>.
+
+from typing import Dict, Optional, Type
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlmodel import Session, SQLModel
+from starlette.concurrency import run_in_threadpool
+
+from digio.models import db_base_ops
+from digio.models.auth_models import get_current_user
+from digio.models.db_base_ops import Page
+from digio.models.db_engine import get_db_session
+from digio.models.db_schemas import BatchCourseAssignments
+from digio.web_services.import_routers import IMPORTABLE_ENTITIES
+from digio.web_services.responses import FastJSONResponse
+
+router = APIRouter()
+
+LISTABLE_ENTITIES: Dict[str, Type[SQLModel]] = {
+    **IMPORTABLE_ENTITIES,
+    "course_batch_assignments": BatchCourseAssignments,
+}
+PAGINATION_PARAMS = frozenset(["after", "limit", "fields"])
+
+
+# The roster has the students' and faculties' contact details,
+# so it is only listed to users who are logged in
+@router.get(
+    "/list/{entity_name}",
+    response_model=Page,
+    dependencies=[Depends(get_current_user)],
+)
+async def list_entities(
+    *,
+    request: Request,
+    entity_name: str,
+    after: Optional[int] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    fields: Optional[str] = Query(None, description="Comma separated columns"),
+    session: Session = Depends(get_db_session),
+) -> FastJSONResponse:
+    entity_type = LISTABLE_ENTITIES.get(entity_name)
+    if entity_type is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cannot list {entity_name}, expected one of {', '.join(LISTABLE_ENTITIES)}",
+        )
+    filters = {
+        name: value
+        for name, value in request.query_params.items()
+        if name not in PAGINATION_PARAMS
+    }
+    columns = [name.strip() for name in fields.split(",")] if fields else None
+    page = await run_in_threadpool(
+        db_base_ops.list_entities,
+        session,
+        entity_type,
+        filters,
+        after,
+        limit,
+        columns,
+    )
+    return FastJSONResponse(page)
@@ -0,0 +1,234 @@
+# GiG
+# Request, upstream and cache metrics, served at /metrics by ops_routers in
+# the Prometheus text format along with the DB timers of db_engine.
+# Requests are labelled with the route's path template, not the path, so
+# that IDs in paths do not each make a new series. The label sets of every
+# route and of every upstream endpoint and ID card type are created at
+# startup, so recording a request does not allocate.
+
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.routing import BaseRoute, Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from digio.models import auth_models
+from digio.models.config_models import MetricsConfigs
+from digio.utils.metrics import CounterChild, HistogramChild, registry
+from digio.web_services.compression import get_compression
+from digio.web_services.idcard_cache import get_idcard_cache
+from digio.web_services.idempotency import get_idempotency_store
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Requests that no route matched, eg. 404s and 405s
+UNMATCHED_ROUTE = "<unmatched>"
+UPSTREAM_ENDPOINTS = ["create_kyc_request", "fetch_id_data", "analyze_idcard"]
+
+
+class _RouteMetrics:
+    __slots__ = ("metrics", "method", "route", "duration", "statuses")
+
+    def __init__(self, metrics: "Metrics", method: str, route: str):
+        self.metrics = metrics
+        self.method = method
+        self.route = route
+        self.duration: HistogramChild = metrics.http_duration.labels(method, route)
+        self.statuses: Dict[int, CounterChild] = {}
+
+    def get_status_counter(self, status_code: int) -> CounterChild:
+        counter = self.statuses.get(status_code)
+        if counter is None:
+            counter = self.metrics.http_requests.labels(
+                self.method, self.route, str(status_code)
+            )
+            self.statuses[status_code] = counter
+        return counter
+
+    def record(self, status_code: int, elapsed: float):
+        self.duration.observe(elapsed)
+        self.get_status_counter(status_code).inc()
+
+
+class Metrics:
+    def __init__(self, configs: MetricsConfigs):
+        self.configs = configs
+        self.http_requests = registry.counter(
+            "digio_http_requests_total",
+            "Requests handled, by route and status",
+            ["method", "route", "status"],
+        )
+        self.http_duration = registry.histogram(
+            "digio_http_request_duration_seconds",
+            "Time to handle a request, until the last byte of the response is sent",
+            ["method", "route"],
+            configs.http_buckets,
+        )
+        # By method only, as the route is not known until the request is routed
+        self.http_in_flight = registry.gauge(
+            "digio_http_requests_in_flight",
+            "Requests being handled",
+            ["method"],
+        )
+        self.upstream_duration = registry.histogram(
+            "digio_upstream_request_duration_seconds",
+            "Time of a call to Digio, every retry and hedge is a call of its own",
+            ["endpoint", "id_type", "outcome"],
+            configs.upstream_buckets,
+        )
+        self.cache_hits = registry.counter(
+            "digio_cache_hits_total", "Lookups served from the cache", ["cache"]
+        )
+        self.cache_misses = registry.counter(
+            "digio_cache_misses_total", "Lookups not found in the cache", ["cache"]
+        )
+        self.cache_hit_ratio = registry.gauge(
+            "digio_cache_hit_ratio", "Hits over lookups since the start", ["cache"]
+        )
+        registry.add_collector("caches", self.collect_cache_metrics)
+        self._routes: Dict[Tuple[str, str], _RouteMetrics] = {}
+
+    def get_route(self, method: str, route: str) -> _RouteMetrics:
+        route_metrics = self._routes.get((method, route))
+        if route_metrics is None:
+            route_metrics = _RouteMetrics(self, method, route)
+            self._routes[(method, route)] = route_metrics
+        return route_metrics
+
+    def prepare_routes(self, routes: Iterable[BaseRoute]):
+        methods = set()
+        for route in routes:
+            if not isinstance(route, Route) or not route.methods:
+                continue
+            # The route's own status, the others are created when first seen
+            status_code = getattr(route, "status_code", None) or 200
+            for method in route.methods:
+                methods.add(method)
+                self.get_route(method, route.path).get_status_counter(status_code)
+        self.http_in_flight.prepare([[method] for method in sorted(methods)])
+
+    def prepare_upstream(self, id_types: List[str]):
+        label_sets = [["fetch_id_data", id_type, "ok"] for id_type in id_types] + [
+            [endpoint, "", "ok"]
+            for endpoint in UPSTREAM_ENDPOINTS
+            if endpoint != "fetch_id_data"
+        ]
+        self.upstream_duration.prepare(label_sets)
+
+    def observe_upstream(
+        self, endpoint: str, id_type: str, outcome: str, elapsed: float
+    ):
+        self.upstream_duration.labels(endpoint, id_type, outcome).observe(elapsed)
+
+    def collect_cache_metrics(self):
+        caches: Dict[str, Tuple[int, int]] = {}
+        idcard_cache = get_idcard_cache()
+        if idcard_cache is not None:
+            stats = idcard_cache.get_stats()
+            caches["idcard_results_memory"] = (stats.memory.hits, stats.memory.misses)
+            caches["idcard_results_db"] = (stats.db_hits, stats.db_misses)
+        idempotency_store = get_idempotency_store()
+        if idempotency_store is not None:
+            memory = idempotency_store.get_stats().memory
+            caches["idempotency_memory"] = (memory.hits, memory.misses)
+        if auth_models.token_service is not None:
+            token_stats = auth_models.token_service.get_stats()
+            caches["auth_tokens"] = (token_stats.tokens.hits, token_stats.tokens.misses)
+            caches["auth_principals"] = (
+                token_stats.principals.hits,
+                token_stats.principals.misses,
+            )
+        compression = get_compression()
+        if compression is not None:
+            cache = compression.get_stats().cache
+            caches["compressed_bodies"] = (cache.hits, cache.misses)
+        for cache_name, (hits, misses) in caches.items():
+            self.cache_hits.labels(cache_name).set_total(hits)
+            self.cache_misses.labels(cache_name).set_total(misses)
+            lookups = hits + misses
+            self.cache_hit_ratio.labels(cache_name).set(
+                hits / lookups if lookups else 0.0
+            )
+
+
+class MetricsMiddleware:
+    # Added last so that it is the outermost middleware and its
+    # timings include the other middlewares, compression in particular
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        metrics = get_metrics()
+        if scope["type"] != "http" or metrics is None:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        in_flight = metrics.http_in_flight.labels(method)
+        in_flight.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            in_flight.dec()
+            # Set on the scope by the router once it has matched a route
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or UNMATCHED_ROUTE
+            metrics.get_route(method, route_path).record(status_code, elapsed)
+
+
+# Times one call to Digio, labelled with how it ended
+class UpstreamTimer:
+    __slots__ = ("metrics", "endpoint", "id_type", "start_time")
+
+    def __init__(self, metrics: Metrics, endpoint: str, id_type: str):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.id_type = id_type
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is None:
+            outcome = "ok"
+        elif isinstance(exc, HTTPException):
+            outcome = str(exc.status_code)
+        elif isinstance(exc, asyncio.CancelledError):
+            # eg. the slower copy of a hedged call
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+        self.metrics.observe_upstream(
+            self.endpoint,
+            self.id_type,
+            outcome,
+            time.perf_counter() - self.start_time,
+        )
+        return False
+
+
+metrics: Optional[Metrics] = None
+
+
+def start_metrics(configs: MetricsConfigs) -> Optional[Metrics]:
+    global metrics
+    metrics = None
+    if configs.enabled:
+        metrics = Metrics(configs)
+    return metrics
+
+
+def get_metrics() -> Optional[Metrics]:
+    return metrics
@@ -0,0 +1,107 @@
+# GiG
+# Operational endpoints that report the state of the service
+
+from typing import Dict, List, Literal
+
+from fastapi import APIRouter, HTTPException, Response, status
+
+from digio.models import auth_models
+from digio.models.auth_models import PasswordHasherStats
+from digio.models.query_stats import StatementSummary, get_query_stats
+from digio.utils import blob_store
+from digio.utils.metrics import registry
+from digio.web_services import digio_routers, idcard_routers
+from digio.web_services.compression import get_compression
+from digio.web_services.idcard_cache import get_idcard_cache
+from digio.web_services.idempotency import get_idempotency_store
+from digio.web_services.metrics import PROMETHEUS_CONTENT_TYPE, get_metrics
+from digio.web_services.upstream_governor import (
+    EndpointGovernorStats,
+    get_upstream_governor,
+)
+from digio.web_services.upstream_resilience import (
+    EndpointResilienceStats,
+    get_resilience_policy,
+)
+
+router = APIRouter()
+
+
+@router.get("/ops/cache_stats/")
+async def get_cache_stats() -> dict:
+    stats = {}
+    idcard_cache = get_idcard_cache()
+    if idcard_cache is not None:
+        stats["idcard_results"] = idcard_cache.get_stats().model_dump()
+    idempotency_store = get_idempotency_store()
+    if idempotency_store is not None:
+        stats["idempotency"] = idempotency_store.get_stats().model_dump()
+    if blob_store.blob_store is not None:
+        stats["blobs"] = {
+            "written": blob_store.blob_store.written,
+            "deduplicated": blob_store.blob_store.deduplicated,
+        }
+    if auth_models.token_service is not None:
+        stats["auth_tokens"] = auth_models.token_service.get_stats().model_dump()
+    compression = get_compression()
+    if compression is not None:
+        stats["compression"] = compression.get_stats().model_dump()
+    return stats
+
+
+@router.get("/ops/in_flight/")
+async def get_in_flight_stats() -> dict:
+    return {
+        "idcard_lookups": idcard_routers.idcard_lookups.get_stats().model_dump(),
+        "kyc_requests": digio_routers.kyc_requests.get_stats().model_dump(),
+    }
+
+
+@router.get("/ops/slow_queries/")
+async def get_slow_queries(
+    limit: int = 20, order_by: Literal["total", "mean", "max"] = "total"
+) -> List[StatementSummary]:
+    query_stats = get_query_stats()
+    if query_stats is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Query stats are not tracked, see track_query_stats",
+        )
+    return query_stats.get_top(limit, order_by)
+
+
+@router.get("/ops/password_hasher/")
+async def get_password_hasher_stats() -> PasswordHasherStats:
+    return auth_models.get_password_hasher().get_stats()
+
+
+@router.get("/ops/upstream_governor/")
+async def get_upstream_governor_stats() -> Dict[str, EndpointGovernorStats]:
+    upstream_governor = get_upstream_governor()
+    if upstream_governor is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upstream calls are not governed, see upstream_governor_configs",
+        )
+    return upstream_governor.get_stats()
+
+
+@router.get("/ops/upstream_resilience/")
+async def get_upstream_resilience_stats() -> Dict[str, EndpointResilienceStats]:
+    resilience_policy = get_resilience_policy()
+    if resilience_policy is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upstream calls have no resilience policy, see upstream_resilience_configs",
+        )
+    return resilience_policy.get_stats()
+
+
+@router.get("/metrics", response_class=Response)
+async def get_metrics_text() -> Response:
+    if get_metrics() is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Metrics are not tracked, see metrics_configs",
+        )
+    return Response(content=registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,48 @@
+# GiG
+# JSON responses that are encoded straight to bytes. FastAPI's default path
+# turns a returned model into a dict with jsonable_encoder and then runs
+# json.dumps over it, here models are serialized by pydantic-core and
+# everything else by orjson, both of which handle datetimes and enums natively.
+
+from typing import Any, Mapping, Optional
+
+import orjson
+import pydantic_core
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse
+
+# UTC datetimes end with Z, the same as pydantic writes them
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return orjson.Fragment(pydantic_core.to_json(value))
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dump_json(content: Any, exclude_none: bool = False) -> bytes:
+    if isinstance(content, BaseModel):
+        return pydantic_core.to_json(content, exclude_none=exclude_none)
+    return orjson.dumps(content, default=_encode_default, option=_ORJSON_OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    # Handlers can return this with the model itself, which skips FastAPI's
+    # response_model round trip. Keep response_model on the route for the docs.
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        media_type: Optional[str] = None,
+        background: Optional[BackgroundTask] = None,
+        exclude_none: bool = False,
+    ):
+        self.exclude_none = exclude_none
+        super().__init__(content, status_code, headers, media_type, background)
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content, exclude_none=self.exclude_none)
@@ -0,0 +1,66 @@
+# GiG
+# Coalesces concurrent identical calls so that only one of them does the work.
+# The first caller for a key starts the call, every caller that arrives for the
+# same key while it is in flight waits for that call and gets the same result
+# or the same exception.
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from pydantic import BaseModel
+
+ResultType = TypeVar("ResultType")
+
+
+class SingleFlightStats(BaseModel):
+    in_flight: int
+    calls: int
+    shared: int
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[ResultType]]
+    ) -> ResultType:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.calls += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            # shield so that one caller going away (client disconnect,
+            # timeout) does not cancel the call for everyone else
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody is interested in the result anymore.
+                # Forget it right away so that a new caller starts afresh
+                # instead of joining a call that is being cancelled
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def get_stats(self) -> SingleFlightStats:
+        return SingleFlightStats(
+            in_flight=len(self._calls), calls=self.calls, shared=self.shared
+        )
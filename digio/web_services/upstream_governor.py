@@ -0,0 +1,339 @@
+# GiG
+# Keeps our calls to Digio within the vendor's per second and per day limits.
+# Every endpoint has a token bucket. A call that finds the bucket empty waits
+# in a queue ordered by priority, interactive calls before batch items, and is
+# refused with a 429 once it would wait past its deadline. Sending at the
+# vendor's pace beats sending a burst, getting 429s back and retrying them.
+# Daily counts are kept in upstream_quota_usage so a restart does not reset
+# them, and they are summed over all the workers sharing the DB.
+# The per second limits are for the whole server, each of its worker
+# processes gets an equal share of them.
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from enum import IntEnum
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from loguru import logger
+from pydantic import BaseModel
+from sqlalchemy import update
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from digio.models import db_engine
+from digio.models.config_models import UpstreamGovernorConfigs, UpstreamLimitConfigs
+from digio.models.db_schemas import UpstreamQuotaUsage
+from digio.utils.utils import utc_now
+
+
+# Raised when we hold a call back ourselves, as opposed to a 429 from Digio,
+# so that it is not retried or counted against Digio's health
+class UpstreamThrottled(HTTPException):
+    pass
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+# Set by the batch endpoint for its items, calls are interactive otherwise
+request_priority: ContextVar[Priority] = ContextVar(
+    "request_priority", default=Priority.INTERACTIVE
+)
+
+
+def get_utc_day() -> str:
+    return utc_now().date().isoformat()
+
+
+def seconds_until_next_utc_day() -> int:
+    now = datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    return math.ceil((tomorrow - now).total_seconds())
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until_token(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class EndpointGovernorStats(BaseModel):
+    tokens: float
+    waiting: Dict[str, int]
+    admitted: int
+    queued: int
+    rejected_deadline: int
+    rejected_quota: int
+    max_wait_ms: float
+    used_today: int
+    per_day: Optional[int]
+
+
+class EndpointGovernor:
+    def __init__(self, endpoint: str, limits: UpstreamLimitConfigs):
+        self.endpoint = endpoint
+        self.limits = limits
+        self.bucket = TokenBucket(limits.per_second, limits.burst)
+        # (priority, arrival order, future), the future is resolved on admission
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        # used_today is the DB count at the last flush plus our calls since
+        self.day = get_utc_day()
+        self.db_used = 0
+        self.unflushed: Dict[str, int] = {}
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_deadline = 0
+        self.rejected_quota = 0
+        self.max_wait_ms = 0.0
+
+    @property
+    def used_today(self) -> int:
+        return self.db_used + self.unflushed.get(self.day, 0)
+
+    def _roll_day(self):
+        day = get_utc_day()
+        if day != self.day:
+            self.day = day
+            self.db_used = 0
+
+    def _check_quota(self):
+        if self.limits.per_day is None:
+            return
+        self._roll_day()
+        # Calls already waiting will use the quota as well
+        if self.used_today + len(self._waiters) >= self.limits.per_day:
+            self.rejected_quota += 1
+            raise UpstreamThrottled(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"The daily quota of {self.limits.per_day} calls to Digio {self.endpoint} is used up",
+                headers={"Retry-After": str(seconds_until_next_utc_day())},
+            )
+
+    def _admit(self):
+        self._roll_day()
+        self.unflushed[self.day] = self.unflushed.get(self.day, 0) + 1
+        self.admitted += 1
+
+    def _reject_deadline(self, expected_wait: float):
+        self.rejected_deadline += 1
+        raise UpstreamThrottled(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many calls to Digio {self.endpoint}, please retry",
+            headers={"Retry-After": str(max(1, math.ceil(expected_wait)))},
+        )
+
+    async def acquire(self, priority: Priority, deadline: float):
+        self._check_quota()
+        if not self._waiters and self.bucket.try_take():
+            self._admit()
+            return
+
+        # Refuse straight away when the calls ahead of this one
+        # would already take longer than the deadline
+        ahead = sum(1 for waiter in self._waiters if waiter[0] <= priority)
+        expected_wait = self.bucket.time_until_token() + ahead / self.bucket.rate
+        if expected_wait > deadline:
+            self._reject_deadline(expected_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        self.queued += 1
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        start_time = time.perf_counter()
+        try:
+            # A timed out or cancelled wait cancels the future,
+            # which the dispatcher then skips
+            await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            self._reject_deadline(expected_wait)
+        self.max_wait_ms = max(
+            self.max_wait_ms, (time.perf_counter() - start_time) * 1000
+        )
+
+    async def _dispatch(self):
+        try:
+            while True:
+                while self._waiters and self._waiters[0][2].done():
+                    heapq.heappop(self._waiters)
+                if not self._waiters:
+                    return
+                if self.bucket.try_take():
+                    _, _, future = heapq.heappop(self._waiters)
+                    future.set_result(None)
+                    self._admit()
+                else:
+                    await asyncio.sleep(self.bucket.time_until_token())
+        finally:
+            self._dispatcher = None
+
+    def get_stats(self) -> EndpointGovernorStats:
+        waiting = {priority.name.lower(): 0 for priority in Priority}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                waiting[Priority(priority).name.lower()] += 1
+        return EndpointGovernorStats(
+            tokens=round(self.bucket.tokens, 3),
+            waiting=waiting,
+            admitted=self.admitted,
+            queued=self.queued,
+            rejected_deadline=self.rejected_deadline,
+            rejected_quota=self.rejected_quota,
+            max_wait_ms=round(self.max_wait_ms, 3),
+            used_today=self.used_today,
+            per_day=self.limits.per_day,
+        )
+
+
+def get_worker_limits(
+    limits: UpstreamLimitConfigs, workers: int
+) -> UpstreamLimitConfigs:
+    if workers <= 1:
+        return limits
+    return limits.model_copy(
+        update={
+            "per_second": limits.per_second / workers,
+            "burst": max(1, limits.burst // workers),
+        }
+    )
+
+
+class UpstreamGovernor:
+    def __init__(self, configs: UpstreamGovernorConfigs, workers: int = 1):
+        self.configs = configs
+        self.workers = workers
+        self.endpoints: Dict[str, EndpointGovernor] = {}
+        self.db_errors = 0
+
+    def get_endpoint(self, endpoint: str) -> EndpointGovernor:
+        endpoint_governor = self.endpoints.get(endpoint)
+        if endpoint_governor is None:
+            endpoint_governor = EndpointGovernor(
+                endpoint,
+                get_worker_limits(self.configs.get_limits(endpoint), self.workers),
+            )
+            self.endpoints[endpoint] = endpoint_governor
+        return endpoint_governor
+
+    async def acquire(self, endpoint: str):
+        priority = request_priority.get()
+        deadline = (
+            self.configs.batch_deadline
+            if priority == Priority.BATCH
+            else self.configs.interactive_deadline
+        )
+        await self.get_endpoint(endpoint).acquire(priority, deadline)
+
+    # Adds our calls since the last flush to the DB counts and reads back
+    # the totals, which include the calls of the other workers
+    def _flush(self, deltas: Dict[Tuple[str, str], int]) -> Dict[Tuple[str, str], int]:
+        totals = {}
+        with Session(db_engine.engine) as session:
+            for (endpoint, day), delta in deltas.items():
+                # An UPDATE adding to the count is atomic, a read then a
+                # write would lose the calls of a worker flushing in between
+                result = session.execute(
+                    update(UpstreamQuotaUsage)
+                    .where(UpstreamQuotaUsage.endpoint == endpoint)  # type: ignore
+                    .where(UpstreamQuotaUsage.day == day)  # type: ignore
+                    .values(used=UpstreamQuotaUsage.used + delta)
+                )
+                if result.rowcount == 0:
+                    session.add(
+                        UpstreamQuotaUsage(endpoint=endpoint, day=day, used=delta)
+                    )
+            session.commit()
+            today = get_utc_day()
+            for usage in session.exec(
+                select(UpstreamQuotaUsage).where(UpstreamQuotaUsage.day == today)
+            ):
+                totals[(usage.endpoint, usage.day)] = usage.used
+        return totals
+
+    async def flush(self):
+        if db_engine.engine is None:
+            return
+        deltas = {}
+        for endpoint_governor in self.endpoints.values():
+            for day, delta in endpoint_governor.unflushed.items():
+                deltas[(endpoint_governor.endpoint, day)] = delta
+            endpoint_governor.unflushed = {}
+        try:
+            totals = await run_in_threadpool(self._flush, deltas)
+        except Exception as e:
+            # Put the calls back so that the next flush writes them
+            for (endpoint, day), delta in deltas.items():
+                unflushed = self.get_endpoint(endpoint).unflushed
+                unflushed[day] = unflushed.get(day, 0) + delta
+            self.db_errors += 1
+            logger.warning(f"Cannot write upstream quota usage: {e}")
+            return
+        for (endpoint, day), used in totals.items():
+            endpoint_governor = self.get_endpoint(endpoint)
+            endpoint_governor._roll_day()
+            if day == endpoint_governor.day:
+                endpoint_governor.db_used = used
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.configs.quota_flush_interval)
+            await self.flush()
+
+    def get_stats(self) -> Dict[str, EndpointGovernorStats]:
+        return {
+            endpoint: endpoint_governor.get_stats()
+            for endpoint, endpoint_governor in self.endpoints.items()
+        }
+
+
+upstream_governor: Optional[UpstreamGovernor] = None
+
+
+def start_upstream_governor(
+    configs: UpstreamGovernorConfigs, workers: int = 1
+) -> Optional[UpstreamGovernor]:
+    global upstream_governor
+    upstream_governor = None
+    if configs.enabled:
+        upstream_governor = UpstreamGovernor(configs, workers)
+    return upstream_governor
+
+
+def get_upstream_governor() -> Optional[UpstreamGovernor]:
+    return upstream_governor
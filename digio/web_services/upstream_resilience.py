@@ -0,0 +1,291 @@
+# GiG
+# Retries, hedging and circuit breaking around each call to Digio, so that a
+# slow or failing Digio costs us a bounded amount of time per request instead
+# of tying up the workers until their timeouts.
+# - Idempotent calls are retried on 429, 502, 503 and 504 with jittered
+#   exponential backoff. Others are sent once, as a retried KYC request
+#   could create a second one.
+# - With hedging on, an idempotent call that has not answered within the
+#   endpoint's recent p95 is sent again and the first answer wins.
+# - After failure_threshold failures in a row the endpoint's breaker opens
+#   and calls fail straight away with a 503 until a trial call succeeds.
+
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from enum import Enum
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from fastapi import HTTPException, status
+from loguru import logger
+from pydantic import BaseModel
+
+from digio.models.config_models import UpstreamResilienceConfigs
+from digio.web_services.upstream_governor import UpstreamThrottled
+
+# Statuses that say Digio could not answer, rather than that the request was wrong
+UPSTREAM_FAILURE_STATUSES = frozenset([502, 503, 504])
+RETRY_STATUSES = UPSTREAM_FAILURE_STATUSES | {429}
+
+
+class CircuitOpenError(HTTPException):
+    pass
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int,
+        open_duration: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+        self.clock = clock
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.open_duration - self.clock())
+
+    def allow(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = CircuitState.HALF_OPEN
+        # Half open lets a single trial call through
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    # For a call that was let through but never made
+    def release(self):
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        self.state = CircuitState.CLOSED
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != CircuitState.OPEN:
+                self.times_opened += 1
+            self.state = CircuitState.OPEN
+            self.opened_at = self.clock()
+
+
+class EndpointResilienceStats(BaseModel):
+    state: CircuitState
+    consecutive_failures: int
+    times_opened: int
+    calls: int
+    failures: int
+    retries: int
+    hedges: int
+    hedge_wins: int
+    short_circuited: int
+    hedge_delay_ms: Optional[float]
+
+
+class EndpointPolicy:
+    def __init__(self, endpoint: str, configs: UpstreamResilienceConfigs):
+        self.endpoint = endpoint
+        self.configs = configs
+        self.breaker = CircuitBreaker(configs.failure_threshold, configs.open_duration)
+        # Latencies of recent successful calls, in seconds
+        self.latencies: Deque[float] = deque(maxlen=configs.latency_window)
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuited = 0
+
+    def get_hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < self.configs.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(
+            len(latencies) - 1, math.ceil(self.configs.hedge_quantile * len(latencies))
+        )
+        return max(self.configs.hedge_min_delay, latencies[index])
+
+    def get_retry_delay(self, retry_no: int) -> float:
+        # Full jitter, so that callers that failed together do not retry together
+        ceiling = min(
+            self.configs.retry_max_delay, self.configs.retry_base_delay * 2**retry_no
+        )
+        return random.uniform(0, ceiling)
+
+    def get_stats(self) -> EndpointResilienceStats:
+        hedge_delay = self.get_hedge_delay()
+        return EndpointResilienceStats(
+            state=self.breaker.state,
+            consecutive_failures=self.breaker.consecutive_failures,
+            times_opened=self.breaker.times_opened,
+            calls=self.calls,
+            failures=self.failures,
+            retries=self.retries,
+            hedges=self.hedges,
+            hedge_wins=self.hedge_wins,
+            short_circuited=self.short_circuited,
+            hedge_delay_ms=None
+            if hedge_delay is None
+            else round(hedge_delay * 1000, 3),
+        )
+
+
+class ResiliencePolicy:
+    def __init__(self, configs: UpstreamResilienceConfigs):
+        self.configs = configs
+        self.endpoints: Dict[str, EndpointPolicy] = {}
+
+    def get_endpoint(self, endpoint: str) -> EndpointPolicy:
+        policy = self.endpoints.get(endpoint)
+        if policy is None:
+            policy = EndpointPolicy(endpoint, self.configs)
+            self.endpoints[endpoint] = policy
+        return policy
+
+    async def call(
+        self,
+        endpoint: str,
+        attempt: Callable[[], Awaitable[Any]],
+        idempotent: bool,
+    ) -> Any:
+        policy = self.get_endpoint(endpoint)
+        max_attempts = 1 + (self.configs.max_retries if idempotent else 0)
+        for attempt_no in range(max_attempts):
+            if not policy.breaker.allow():
+                policy.short_circuited += 1
+                raise CircuitOpenError(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=f"Digio {endpoint} is failing, not calling it for now",
+                    headers={
+                        "Retry-After": str(
+                            max(1, math.ceil(policy.breaker.retry_after()))
+                        )
+                    },
+                )
+            try:
+                if idempotent and self.configs.hedging:
+                    result = await self._call_hedged(policy, attempt)
+                else:
+                    result = await self._call_timed(policy, attempt)
+            except UpstreamThrottled:
+                # Never reached Digio, so it says nothing about its health
+                policy.breaker.release()
+                raise
+            except HTTPException as e:
+                if e.status_code in UPSTREAM_FAILURE_STATUSES:
+                    policy.failures += 1
+                    policy.breaker.record_failure()
+                else:
+                    # Digio answered, the request was the problem
+                    policy.breaker.record_success()
+                if (
+                    e.status_code not in RETRY_STATUSES
+                    or attempt_no + 1 == max_attempts
+                ):
+                    raise
+                policy.retries += 1
+                delay = policy.get_retry_delay(attempt_no)
+                logger.info(
+                    f"Retrying Digio {endpoint} in {delay:.2f}s after {e.status_code}"
+                )
+                await asyncio.sleep(delay)
+            except BaseException:
+                # eg. the caller went away, which should not keep
+                # a half open breaker waiting for the trial call
+                policy.breaker.release()
+                raise
+            else:
+                policy.breaker.record_success()
+                return result
+
+    async def _call_timed(
+        self, policy: EndpointPolicy, attempt: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        policy.calls += 1
+        start_time = time.perf_counter()
+        result = await attempt()
+        policy.latencies.append(time.perf_counter() - start_time)
+        return result
+
+    async def _call_hedged(
+        self, policy: EndpointPolicy, attempt: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        hedge_delay = policy.get_hedge_delay()
+        if hedge_delay is None:
+            return await self._call_timed(policy, attempt)
+
+        first = asyncio.ensure_future(self._call_timed(policy, attempt))
+        pending = {first}
+        hedge = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if not done:
+                policy.hedges += 1
+                hedge = asyncio.ensure_future(self._call_timed(policy, attempt))
+                pending.add(hedge)
+            first_error: Optional[BaseException] = None
+            while True:
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        if task is hedge:
+                            policy.hedge_wins += 1
+                        return task.result()
+                    first_error = first_error or error
+                if not pending:
+                    assert first_error is not None
+                    raise first_error
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+        finally:
+            # The slower copy is not needed anymore
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self) -> Dict[str, EndpointResilienceStats]:
+        return {
+            endpoint: policy.get_stats() for endpoint, policy in self.endpoints.items()
+        }
+
+
+resilience_policy: Optional[ResiliencePolicy] = None
+
+
+def start_resilience_policy(
+    configs: UpstreamResilienceConfigs,
+) -> Optional[ResiliencePolicy]:
+    global resilience_policy
+    resilience_policy = None
+    if configs.enabled:
+        resilience_policy = ResiliencePolicy(configs)
+    return resilience_policy
+
+
+def get_resilience_policy() -> Optional[ResiliencePolicy]:
+    return resilience_policy
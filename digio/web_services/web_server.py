@@ -1,13 +1,137 @@
 # GiG
 
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+import httpx
+import orjson
 from fastapi import FastAPI
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 
 # from digio.web_services import faculty_routers
-from digio.web_services import digio_routers, idcard_routers
+from digio.models import db_engine
+from digio.models.auth_models import (
+    start_password_hasher,
+    start_token_service,
+    stop_password_hasher,
+)
+from digio.models.config_models import (
+    GlobalConfigs,
+    get_server_workers,
+    is_schema_created,
+)
+from digio.utils.blob_store import start_blob_store
+from digio.web_services import (
+    auth_routers,
+    blob_routers,
+    digio_routers,
+    idcard_analysis_routers,
+    idcard_routers,
+    import_routers,
+    list_routers,
+    ops_routers,
+)
+from digio.web_services.compression import CompressionMiddleware, start_compression
+from digio.web_services.digio_client import start_digio_client, stop_digio_client
+from digio.web_services.idcard_cache import start_idcard_cache
+from digio.web_services.idempotency import start_idempotency_store
+from digio.web_services.metrics import MetricsMiddleware, start_metrics
+from digio.web_services.responses import FastJSONResponse
+from digio.web_services.upstream_governor import start_upstream_governor
+from digio.web_services.upstream_resilience import start_resilience_policy
+
+
+# FastAPI builds the schema of every route on the first /openapi.json
+# or /docs request. A file written by digio.utils.startup_profile
+# --write-openapi saves each new worker from doing it again
+def load_openapi_schema(app: FastAPI, openapi_file: Optional[Path]):
+    if openapi_file is None:
+        return
+    if not openapi_file.exists():
+        logger.warning(
+            f"{openapi_file} not found, the OpenAPI schema is built on demand"
+        )
+        return
+    app.openapi_schema = orjson.loads(openapi_file.read_bytes())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The Digio client holds the pooled connections to Digio,
+    # so open it once per worker and close it on the way out
+    global_configs = GlobalConfigs.load_default()
+    app.state.global_configs = global_configs
+    server_workers = get_server_workers()
+    load_openapi_schema(app, global_configs.server_configs.openapi_file)
+    # Under main.py the launcher has created the schema already and each
+    # worker only needs its own engines. Started any other way (uvicorn,
+    # fastapi dev, TestClient) the schema is created here
+    if db_engine.engine is None:
+        db_engine.initialize_dbs(
+            global_configs.db_configs, create_schema=not is_schema_created()
+        )
+    metrics = start_metrics(global_configs.metrics_configs)
+    if metrics is not None:
+        metrics.prepare_routes(app.routes)
+        metrics.prepare_upstream(
+            [id_type.value for id_type in idcard_routers.IDCardType]
+        )
+    start_compression(global_configs.compression_configs)
+    start_blob_store(global_configs.data_dir / "blobs")
+    transport = None
+    if global_configs.fake_digio_configs.in_process:
+        # Only imported for load tests, the app never needs it otherwise
+        from digio.web_services.fake_digio import create_fake_digio_app
+
+        logger.warning("Digio calls are served by the in-process fake Digio")
+        transport = httpx.ASGITransport(
+            app=create_fake_digio_app(global_configs.fake_digio_configs)
+        )
+    start_digio_client(global_configs.digio_configs, transport=transport)
+    start_resilience_policy(global_configs.upstream_resilience_configs)
+    background_tasks = []
+    upstream_governor = start_upstream_governor(
+        global_configs.upstream_governor_configs, server_workers
+    )
+    if upstream_governor is not None:
+        # Loads today's counts, which may include calls before a restart
+        await upstream_governor.flush()
+        background_tasks.append(
+            asyncio.create_task(upstream_governor.flush_periodically())
+        )
+    password_hasher = start_password_hasher(
+        global_configs.password_hasher_configs, server_workers
+    )
+    await password_hasher.warm_up()
+    start_token_service(global_configs.auth_configs)
+    idcard_cache = start_idcard_cache(
+        global_configs.idcard_cache_configs,
+        idcard_routers.fetch_id_card_response_adapter,
+    )
+    if idcard_cache is not None:
+        purged = await run_in_threadpool(idcard_cache.purge_expired)
+        logger.info(f"Purged {purged} expired ID card results")
+    idempotency_store = start_idempotency_store(global_configs.idempotency_configs)
+    if idempotency_store is not None:
+        background_tasks.append(
+            asyncio.create_task(idempotency_store.compact_periodically())
+        )
+    yield
+    for task in background_tasks:
+        task.cancel()
+    if upstream_governor is not None:
+        await upstream_governor.flush()
+    await stop_digio_client()
+    stop_password_hasher()
+    await db_engine.dispose_async_db_engine()
+    db_engine.dispose_db_engine()
+
 
-app = FastAPI(name="digio")
+app = FastAPI(name="digio", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 origins = [
     "http://localhost:5173",
@@ -22,13 +146,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-# This will get triggered as long as the
-# output size is greater than 500 bytes.
-# you can customize by adding an argument minimum_size=1000
-# which will increase it to 1000 bytes
-app.add_middleware(GZipMiddleware)
+# Algorithms, levels and the minimum size are set in compression_configs
+app.add_middleware(CompressionMiddleware)
+# Outermost, so that request timings include the other middlewares
+app.add_middleware(MetricsMiddleware)
 
 # app.include_router(faculty_routers.router)
 
+app.include_router(auth_routers.router)
 app.include_router(digio_routers.router)
 app.include_router(idcard_routers.router)
+app.include_router(idcard_analysis_routers.router)
+app.include_router(blob_routers.router)
+app.include_router(ops_routers.router)
+app.include_router(import_routers.router)
+app.include_router(list_routers.router)
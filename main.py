@@ -1,33 +1,96 @@
 ################################
+# Starts the web server as configured in server_configs.
+# The schema is created here, once, and then uvicorn starts the workers,
+# each of which imports the app and opens its own DB engine. On SIGTERM
+# the workers stop accepting connections and finish the requests in flight
+# for up to timeout_graceful_shutdown seconds.
+#
+# python main.py [--config implementation/demo/configs.toml] [--workers 4]
+
+import argparse
+import os
+import secrets
+import sys
 from pathlib import Path
 
 import uvicorn
 from loguru import logger
 
-from digio.models.config_models import GlobalConfigs
-from digio.web_services.web_server import app
+from digio.models.config_models import (
+    CONFIG_PATH_ENV_VAR,
+    SCHEMA_CREATED_ENV_VAR,
+    SECRET_KEY_ENV_VAR,
+    SERVER_WORKERS_ENV_VAR,
+    GlobalConfigs,
+)
 
+APP_IMPORT_PATH = "digio.web_services.web_server:app"
 
 ################################
 
 
-def start_uvicorn():
-    port_no = 8000
-    # change to warning during prod
-    log_level = "debug"  # "warning"
-    # log_level='warning' prevents logging of all normal requests
-    uvicorn.run(app, host="127.0.0.1", port=port_no, log_level=log_level)
+def get_workers(gc: GlobalConfigs, workers: int) -> int:
+    if workers > 1 and gc.db_configs.is_in_memory():
+        logger.warning("An in-memory DB cannot be shared, starting a single worker")
+        return 1
+    return workers
+
+
+def setup_db(gc: GlobalConfigs, workers: int):
+    from digio.models import db_engine
+
+    db_engine.initialize_dbs(gc.db_configs)
+    os.environ[SCHEMA_CREATED_ENV_VAR] = "1"
+    if workers > 1:
+        # The workers open their own engines, this one is not needed
+        # and should not hold the DB open while they run
+        db_engine.dispose_db_engine()
+        db_engine.engine = None
+
+
+def start_uvicorn(gc: GlobalConfigs, workers: int):
+    server_configs = gc.server_configs
+    # Read by the workers, which are new processes that load the configs again
+    os.environ[SERVER_WORKERS_ENV_VAR] = str(workers)
+    logger.info(
+        f"Starting {workers} workers on {server_configs.host}:{server_configs.port}"
+    )
+    uvicorn.run(
+        APP_IMPORT_PATH,
+        host=server_configs.host,
+        port=server_configs.port,
+        workers=workers,
+        loop=server_configs.loop,
+        http=server_configs.http,
+        backlog=server_configs.backlog,
+        timeout_keep_alive=server_configs.timeout_keep_alive,
+        timeout_graceful_shutdown=server_configs.timeout_graceful_shutdown,
+        limit_concurrency=server_configs.limit_concurrency,
+        log_level=server_configs.log_level,
+        access_log=server_configs.access_log,
+        forwarded_allow_ips=server_configs.forwarded_allow_ips,
+    )
 
 
-def setup_db():
-    from digio.models.db_engine import initialize_dbs
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Start the Digio web server")
+    parser.add_argument("--config", type=Path, help="Config file, for the workers too")
+    parser.add_argument("--workers", type=int, help="Overrides server_configs.workers")
+    args = parser.parse_args()
+    if args.config:
+        os.environ[CONFIG_PATH_ENV_VAR] = str(args.config.resolve())
+    gc = GlobalConfigs.load_default()
 
-    gc = GlobalConfigs.load_from_path(Path("implementation/demo/configs.toml"))
-    initialize_dbs(gc.db_configs)
-    # configure_logging_client(gc.logging_configs, logger)
+    workers = get_workers(gc, args.workers or gc.server_configs.get_workers())
+    if workers > 1 and not gc.auth_configs.secret_key:
+        # Each worker would otherwise make up its own key and refuse the
+        # tokens of the others
+        logger.warning("auth_configs.secret_key is not set, using a random key")
+        os.environ[SECRET_KEY_ENV_VAR] = secrets.token_hex(32)
+    setup_db(gc, workers)
+    start_uvicorn(gc, workers)
+    return 0
 
 
 if __name__ == "__main__":
-    setup_db()
-    start_uvicorn()
-    logger.debug("engine started")
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# GiG
+# Tokens are signed and checked by TokenService itself, these are the
+# tokens it must refuse
+
+import asyncio
+
+import orjson
+import pytest
+
+from digio.models import auth_models
+from digio.models.auth_models import Principal, TokenService, _b64encode
+from digio.models.config_models import AuthConfigs
+from digio.models.db_schemas import Student
+
+PRINCIPAL = Principal(
+    user_type="student",
+    id=1,
+    username="alice",
+    first_name="Alice",
+    college_id=1,
+    department_id=1,
+    batch_id=1,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(auth_models.time, "time", fake_clock)
+    return fake_clock
+
+
+@pytest.fixture
+def service(clock: FakeClock) -> TokenService:
+    token_service = TokenService(
+        AuthConfigs(
+            secret_key="test-secret",
+            access_token_expire_minutes=1,
+            token_cache_ttl=300,
+        )
+    )
+    token_service.token_cache.clock = clock
+    token_service.principal_cache.clock = clock
+    # So that get_principal does not need the DB
+    token_service.principal_cache.set(("student", 1), PRINCIPAL)
+    return token_service
+
+
+def create_token(service: TokenService) -> str:
+    user = Student(
+        id=1,
+        username="alice",
+        first_name="Alice",
+        last_name=None,
+        email_id=None,
+        phone_number=None,
+        college_id=1,
+        department_id=1,
+        batch_id=1,
+    )
+    return service.create_access_token(user).access_token
+
+
+def sign(service: TokenService, claims: dict, header: bytes = b"") -> str:
+    signing_input = (
+        (header or service._header) + b"." + _b64encode(orjson.dumps(claims))
+    )
+    return (signing_input + b"." + service._sign(signing_input)).decode()
+
+
+def get_principal(service: TokenService, token: str):
+    return asyncio.run(service.get_principal(token))
+
+
+def test_valid_token(service: TokenService):
+    token = create_token(service)
+    assert service.decode(token)["uid"] == 1
+    assert get_principal(service, token) == PRINCIPAL
+
+
+def test_tampered_signature(service: TokenService):
+    signing_input, signature = create_token(service).rsplit(".", 1)
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert service.decode(f"{signing_input}.{flipped}") is None
+    assert service.decode(f"{signing_input}.") is None
+
+
+def test_tampered_payload(service: TokenService):
+    header, payload, signature = create_token(service).split(".")
+    claims = orjson.loads(auth_models._b64decode(payload.encode()))
+    forged = _b64encode(orjson.dumps({**claims, "uid": 2})).decode()
+    assert service.decode(f"{header}.{forged}.{signature}") is None
+
+
+def test_signed_with_another_key(service: TokenService, clock: FakeClock):
+    other_service = TokenService(AuthConfigs(secret_key="other-secret"))
+    assert service.decode(create_token(other_service)) is None
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        {"alg": "none", "typ": "JWT"},
+        {"alg": "HS512", "typ": "JWT"},
+        {"typ": "JWT", "alg": "HS256"},
+    ],
+)
+def test_other_header(service: TokenService, clock: FakeClock, header: dict):
+    claims = {"typ": "student", "uid": 1, "exp": int(clock.now) + 60}
+    token = sign(service, claims, _b64encode(orjson.dumps(header)))
+    assert service.decode(token) is None
+
+
+def test_alg_none_without_signature(service: TokenService, clock: FakeClock):
+    header = _b64encode(orjson.dumps({"alg": "none", "typ": "JWT"})).decode()
+    claims = {"typ": "student", "uid": 1, "exp": int(clock.now) + 60}
+    payload = _b64encode(orjson.dumps(claims)).decode()
+    assert service.decode(f"{header}.{payload}.") is None
+    assert service.decode(f"{header}.{payload}") is None
+
+
+def test_expired_token(service: TokenService, clock: FakeClock):
+    token = create_token(service)
+    clock.now += 61
+    assert service.decode(token) is None
+    assert get_principal(service, token) is None
+
+
+@pytest.mark.parametrize("exp", [None, "9999999999", 1e12, [1], True])
+def test_missing_or_non_int_exp(service: TokenService, exp):
+    claims = {"typ": "student", "uid": 1}
+    if exp is not None:
+        claims["exp"] = exp
+    assert service.decode(sign(service, claims)) is None
+
+
+@pytest.mark.parametrize("claims", [{"typ": "admin"}, {"uid": "1"}, {"uid": None}])
+def test_bad_claims(service: TokenService, clock: FakeClock, claims: dict):
+    token = sign(
+        service, {"typ": "student", "uid": 1, "exp": int(clock.now) + 60, **claims}
+    )
+    assert service.decode(token) is None
+
+
+def test_cache_entry_does_not_outlive_exp(service: TokenService, clock: FakeClock):
+    token = create_token(service)
+    assert get_principal(service, token) == PRINCIPAL
+    assert service.token_cache.get(token) == PRINCIPAL
+    # The token expires in 60s, well before the cache's TTL of 300s
+    clock.now += 61
+    assert service.token_cache.get(token) is None
+    assert get_principal(service, token) is None
+
+
+@pytest.mark.parametrize(
+    "token",
+    ["", ".", "..", "a.b.c.d", "ünïcödé", "é.é.é", "\x00.\x00.\x00", "a.b.c" + "é"],
+)
+def test_malformed_token(service: TokenService, token: str):
+    assert service.decode(token) is None
+    assert get_principal(service, token) is None
+
+
+def test_non_ascii_signature(service: TokenService):
+    signing_input, signature = create_token(service).rsplit(".", 1)
+    assert service.decode(f"{signing_input}.{signature[:-1]}é") is None
+
+
+def test_rejected_tokens_are_counted(service: TokenService):
+    get_principal(service, "not-a-token")
+    assert service.get_stats().rejected == 1
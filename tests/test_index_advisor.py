@@ -0,0 +1,19 @@
+# GiG
+# Every query in query_registry should be served by an index on a new database
+
+from sqlalchemy import create_engine
+
+from digio.utils.index_advisor import check_queries, is_scan
+
+
+def test_no_registered_query_scans():
+    engine = create_engine("sqlite://")
+    plans = check_queries(engine)
+    engine.dispose()
+
+    assert plans
+    scans = {
+        name: [detail for detail in details if is_scan(detail)]
+        for name, details in plans.items()
+    }
+    assert {name: details for name, details in scans.items() if details} == {}
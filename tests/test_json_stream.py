@@ -0,0 +1,129 @@
+# GiG
+# The parser must give the same result however the response is split into
+# chunks, and raise JSONStreamError for anything malformed
+
+import base64
+import io
+import json
+import random
+
+import pytest
+
+from digio.utils.json_stream import Base64FileSink, JSONStreamError, StreamingJSONParser
+
+IMAGE = bytes(range(256)) * 40
+
+DOCUMENT = {
+    "id": "KID123",
+    "count": 3,
+    "ratio": -1.5e-3,
+    "flags": [True, False, None],
+    "nested": {"empty_list": [], "empty_dict": {}, "deep": [[1, [2, {"x": "y"}]]]},
+    "text": 'quote " backslash \\ slash / \b\f\n\r\t tab',
+    "unicode": "நன்றி ünïcödé 😀  ",
+    "image": base64.b64encode(IMAGE).decode(),
+}
+
+
+def split_randomly(data: bytes, rng: random.Random) -> list:
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([1, 1, 2, 3, 5, 7, 64, 4096])
+        chunks.append(data[pos : pos + size])
+        pos += size
+    return chunks
+
+
+def parse_chunks(chunks: list, sinks: dict) -> object:
+    def sink_factory(key: str) -> Base64FileSink:
+        file_obj = io.BytesIO()
+        sinks[key] = file_obj
+        return Base64FileSink(file_obj, lambda size: {"size": size})
+
+    parser = StreamingJSONParser(frozenset(["image"]), sink_factory)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def parse(text: str) -> object:
+    parser = StreamingJSONParser()
+    parser.feed(text.encode())
+    return parser.close()
+
+
+@pytest.mark.parametrize("ensure_ascii", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunks(seed: int, ensure_ascii: bool):
+    data = json.dumps(DOCUMENT, ensure_ascii=ensure_ascii).encode()
+    sinks: dict = {}
+    result = parse_chunks(split_randomly(data, random.Random(seed)), sinks)
+
+    expected = {**DOCUMENT, "image": {"size": len(IMAGE)}}
+    assert result == expected
+    assert sinks["image"].getvalue() == IMAGE
+
+
+def test_one_byte_chunks():
+    data = json.dumps(DOCUMENT, indent=2).encode()
+    sinks: dict = {}
+    result = parse_chunks([data[i : i + 1] for i in range(len(data))], sinks)
+    assert result == {**DOCUMENT, "image": {"size": len(IMAGE)}}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '"\\ud83d\\ude00"',
+        '"\\ud800"',
+        '"\\ud800x"',
+        '"\\ud800\\u0041"',
+        '"\\udc00"',
+        "[1, 2.5, -3, true, false, null]",
+        '{"a": {"b": []}}',
+    ],
+)
+def test_matches_json_loads(text: str):
+    assert parse(text) == json.loads(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '"\\uzzzz"',
+        '"\\u12"',
+        '"\\u-123"',
+        '"\\u 123"',
+        '"\\ud800\\uzzzz"',
+        '"\\x"',
+        '{"a" 1}',
+        '{"a": 1,}',
+        "[1 2]",
+        "[1,]",
+        '{"a": tru}',
+        "{} {}",
+        '{"a": "b"',
+        '"open',
+    ],
+)
+def test_malformed_json(text: str):
+    with pytest.raises(JSONStreamError):
+        parse(text)
+
+
+@pytest.mark.parametrize(
+    "encoded",
+    ["QUJD*EFG", "QUJDR", "QUJDRA=", "QQ==QUJD", "QUJD====", "Q==="],
+)
+def test_malformed_base64(encoded: str):
+    with pytest.raises(JSONStreamError):
+        parse_chunks([json.dumps({"image": encoded}).encode()], {})
+
+
+def test_base64_with_line_breaks():
+    encoded = base64.encodebytes(IMAGE).decode()
+    sinks: dict = {}
+    result = parse_chunks([json.dumps({"image": encoded}).encode()], sinks)
+    assert result == {"image": {"size": len(IMAGE)}}
+    assert sinks["image"].getvalue() == IMAGE